@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Alert mails to the maintainers.
+
+alert() only puts the alert on a queue, so it can be called from the serial
+path or a timer callback. A single mailer thread reads the log tail and
+sends the mail, at most one every min_interval seconds; alerts raised in
+between are coalesced into one digest.
+"""
+from __future__ import absolute_import
+
+import logging
+import os
+import threading
+import time
+try:
+    # python3
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue
+
+# email shit taken from snowdayz
+try:
+    # python3
+    from email import charset as Charset
+except ImportError:
+    # python2
+    from email import Charset
+# without adding the utf-8+qp charset, utf-8 is always encoded base64
+Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
+from email.mime.text import MIMEText
+from smtplib import SMTP
+
+alert_logger = logging.getLogger("alerts")
+
+def tail_lines(path, count=10, block_size=4096):
+    """
+    Return the last count lines of the file at path as a string. Reads
+    backwards block by block, so the cost depends on the length of the tail,
+    not the size of the file.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        blocks = []
+        newlines = 0
+        # one newline more than lines wanted, the last line usually ends in one
+        while pos > 0 and newlines <= count:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos, os.SEEK_SET)
+            block = f.read(size)
+            newlines += block.count(b'\n')
+            blocks.append(block)
+    data = b''.join(reversed(blocks))
+    lines = data.splitlines(True)[-count:] if count > 0 else []
+    return b''.join(lines).decode('utf-8', 'replace')
+
+class LoggingSMTP(object):
+    """
+    Stand-in for smtplib.SMTP that logs mails instead of sending them and
+    keeps them in the class attribute sent. Used for tests and with
+    ``smtp_host = debug`` in the [alerts] config section.
+    """
+
+    sent = []
+
+    def __init__(self, host=None):
+        self.host = host
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        alert_logger.info("not sending mail from %s to %s:\n%s", from_addr, to_addrs, msg)
+        LoggingSMTP.sent.append((from_addr, to_addrs, msg))
+
+    def quit(self):
+        pass
+
+class AlertMailer(object):
+    """
+    Queued, rate limited alert mail sender.
+
+    :param sender: From address
+    :param recipient: To address
+    :param smtp_host: host passed to smtp_factory
+    :param min_interval: minimal number of seconds between two mails
+    :param log_path: if set, the last log_lines lines of this file are
+        attached to every mail
+    :param smtp_factory: callable returning an object with sendmail() and
+        quit(), smtplib.SMTP by default
+    :param max_pending: alerts queued beyond this are dropped (and counted)
+    """
+
+    def __init__(self, sender, recipient, smtp_host, min_interval=300, log_path=None,
+                 log_lines=10, smtp_factory=SMTP, max_pending=1000):
+        self.sender = sender
+        self.recipient = recipient
+        self.smtp_host = smtp_host
+        self.min_interval = min_interval
+        self.log_path = log_path
+        self.log_lines = log_lines
+        self.smtp_factory = smtp_factory
+        self.dropped = 0
+        self.sent = 0
+        self._queue = queue.Queue(max_pending)
+        self._last_sent = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def alert(self, subject, text):
+        """
+        Queue an alert. Never blocks.
+        """
+        if self._thread is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), subject, text))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="alerts")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _collect(self):
+        """
+        Wait for an alert, then keep collecting until the rate limit allows
+        the next mail.
+        """
+        pending = [self._queue.get()]
+        deadline = self._last_sent + self.min_interval
+        while True:
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    pending.append(self._queue.get(timeout=timeout))
+                else:
+                    pending.append(self._queue.get_nowait())
+            except queue.Empty:
+                return pending
+
+    def _run(self):
+        while True:
+            pending = self._collect()
+            try:
+                self._send(pending)
+            except Exception:
+                alert_logger.error("failed to send alert mail", exc_info=True)
+            self._last_sent = time.time()
+
+    def format_digest(self, pending):
+        """
+        Return (subject, text) of the mail for the given queued alerts.
+        Identical alerts are listed once with a count.
+        """
+        groups = []
+        by_key = {}
+        for when, subject, text in pending:
+            key = subject, text
+            if key not in by_key:
+                by_key[key] = [when, when, 0]
+                groups.append(key)
+            by_key[key][1] = when
+            by_key[key][2] += 1
+
+        if len(pending) == 1:
+            subject, text = pending[0][1], pending[0][2]
+        else:
+            subject = "%s (%d alerts)" % (groups[0][0], len(pending))
+            lines = []
+            for key in groups:
+                first, last, n = by_key[key]
+                lines.append("%dx %s: %s (first %s, last %s)" % (
+                    n, key[0], key[1].strip(), time.strftime("%H:%M:%S", time.localtime(first)),
+                    time.strftime("%H:%M:%S", time.localtime(last))))
+            text = "\n".join(lines) + "\n"
+
+        if self.log_path:
+            try:
+                text += "log tail:\n" + tail_lines(self.log_path, self.log_lines)
+            except (IOError, OSError) as e:
+                text += "could not read log tail: %s\n" % e
+        return subject, text
+
+    def _send(self, pending):
+        subject, text = self.format_digest(pending)
+        msg = MIMEText(text, 'plain', 'utf-8')
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = self.recipient
+
+        s = self.smtp_factory(self.smtp_host)
+        s.sendmail(self.sender, self.recipient, msg.as_string())
+        s.quit()
+        self.sent += 1
+
+_mailer = None
+_mailer_lock = threading.Lock()
+
+def get_mailer():
+    """
+    Return the process wide AlertMailer, configured from the [alerts]
+    config section.
+    """
+    global _mailer
+    if _mailer is None:
+        with _mailer_lock:
+            if _mailer is None:
+                from .system import get_option
+                smtp_host = get_option('alerts', 'smtp_host', 'mail.vis.ethz.ch')
+                _mailer = AlertMailer(
+                    get_option('alerts', 'from', 'root@kafi.vis.ethz.ch'),
+                    get_option('alerts', 'to', 'nev@vis.ethz.ch'),
+                    smtp_host,
+                    min_interval=get_option('alerts', 'min_interval', 300),
+                    log_path=get_option('alerts', 'log_file', '/var/log/kaffi.log'),
+                    smtp_factory=LoggingSMTP if smtp_host == 'debug' else SMTP)
+    return _mailer
+
+def alert(subject, text):
+    """
+    Queue an alert mail. Never blocks.
+    """
+    get_mailer().alert(subject, text)
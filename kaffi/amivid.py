@@ -15,14 +15,15 @@ except ImportError:
     import simplejson as json
 try:
     # python3
-    from urllib.request import urlopen
     from urllib.parse import urlencode
 except ImportError:
-    # python3
-    from urllib import urlopen, urlencode
+    # python2
+    from urllib import urlencode
 from operator import itemgetter
 import logging
 
+from .httppool import urlopen
+
 logger = logging.getLogger("amivid")
 
 class AmivID:
@@ -51,10 +52,11 @@ class AmivID:
         finalRequest = '%s?%s'%(item, urlencode(request))
         return finalRequest
 
-    def getUser(self,rfid):
+    def getUser(self,rfid,timeout=None):
         """Gets a User-Dict based on a rfid-code
 
         :param rfid: 6-Digit RFID number from Legi
+        :param timeout: Optional, seconds to wait for the server
         :returns: dict with user-infos
         """
         #Create request
@@ -66,7 +68,7 @@ class AmivID:
         finalRequest = self.__sign("%06d"%(rfid), request)
 
         try:
-            return json.load(urlopen(self.baseurl+finalRequest))
+            return json.load(urlopen(self.baseurl+finalRequest, timeout))
         except ValueError as e:
             logger.error("Error in amivID.getUser(), %s", e)
         return None
@@ -9,14 +9,17 @@ logger = logging.getLogger("status.amiv")
 
 nethz_cache = {}
 
-def get_status(rfidnr):
+def get_user(rfidnr, timeout=None):
     from .system import get_config
     config = get_config()
     aid = amivid.AmivID(
             config.get('amivid', 'apikey'),
             config.get('amivid', 'secret'),
             config.get('amivid', 'baseurl'))
-    user = aid.getUser(int(rfidnr))
+    return aid.getUser(int(rfidnr), timeout)
+
+def get_status(rfidnr, timeout=None):
+    user = get_user(rfidnr, timeout)
     if user and isinstance(user, dict):
         try:
             nethz_cache[rfidnr] = user['nethz']
@@ -53,12 +56,41 @@ def get_connection():
 
     return dbengine
 
+def get_nethz(rfidnr):
+    nethz = nethz_cache.get(rfidnr)
+    if nethz is None:
+        # authorized from the snapshot without asking amivid
+        user = get_user(rfidnr)
+        nethz = nethz_cache[rfidnr] = user['nethz']
+    return nethz
+
 def report_dispensed(rfidnr, item):
 
-    nethz = nethz_cache[rfidnr]
+    nethz = get_nethz(rfidnr)
     slot = item + 10
 
     logger.info("dispensed %(item)s (%(slot)s) for %(rfidnr)s (%(nethz)s), AMIV" % locals())
 
     engine = get_connection()
     engine.execute(insert, username=nethz, slot=slot)
+
+def report_dispensed_batch(dispenses):
+    """
+    Report a list of (rfidnr, item) with a single executemany. Returns the
+    indexes in dispenses of the ones that could not be reported because
+    their nethz is unknown; raises if the insert failed.
+    """
+    rows = []
+    failed = []
+    for i, (rfidnr, item) in enumerate(dispenses):
+        try:
+            rows.append(dict(username=get_nethz(rfidnr), slot=item + 10))
+        except Exception:
+            logger.warning("could not get nethz of %s", rfidnr, exc_info=True)
+            failed.append(i)
+
+    if rows:
+        logger.info("dispensed %d items, AMIV", len(rows))
+        engine = get_connection()
+        engine.execute(insert, rows)
+    return failed
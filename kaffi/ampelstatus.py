@@ -1,8 +1,8 @@
 #-*- coding: utf-8 -*- 
-import httplib
-
 import logging
 
+from .httppool import urlopen
+
 logger = logging.getLogger("status.ampel")
 
 def get_status():
@@ -11,10 +11,7 @@ def get_status():
     ampel_host = config.get('ampel', 'host')
     ampel_suffix = config.get('ampel', 'suffix')
     try:
-        connection = httplib.HTTPSConnection(ampel_host, timeout=5.0)
-        connection.request('GET', ampel_suffix)
-        response = connection.getresponse()
-        result = response.read()
+        result = urlopen('https://' + ampel_host + ampel_suffix, timeout=5.0).read()
         logger.info("ampel result: " + result)
 
         return result in [u'green', u'yellow']
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    # python 2.6
+    from ordereddict import OrderedDict
+
+from . import pool
+
+cache_logger = logging.getLogger("authcache")
+
+class AuthCache(object):
+    """
+    LRU cache of authorization answers with separate TTLs for positive
+    answers (an org) and negative ones (None).
+
+    An expired positive answer is still returned for up to max_stale
+    seconds while it is refreshed in the background, so regulars are
+    served through short backend outages. Expired negative answers are
+    looked up again right away, the user might just have paid the fee.
+
+    :param lookup: lookup(key) returning (answer, certain). Answers that
+        are not certain (None because a backend failed) are not cached.
+    :param refresher: WorkerPool running the background refreshes
+    """
+
+    def __init__(self, lookup, ttl=3600, negative_ttl=60, max_stale=86400, max_size=1000,
+                 refresher=None, clock=time.time):
+        self.lookup = lookup
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_stale = max_stale
+        self.max_size = max_size
+        self.refresher = refresher or pool.WorkerPool(1, name="authcache")
+        self.clock = clock
+        self.hits = self.stale_hits = self.misses = self.refreshes = 0
+        # key -> (answer, expires)
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        now = self.clock()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                # most recently used last
+                self._entries[key] = entry
+                answer, expires = entry
+                if now < expires:
+                    self.hits += 1
+                    return answer
+                if answer is not None and now < expires + self.max_stale:
+                    self.stale_hits += 1
+                    refresh = key not in self._refreshing
+                    if refresh:
+                        self._refreshing.add(key)
+                else:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+        if entry is None:
+            return self.fetch(key)
+        if refresh:
+            self.refresher.submit(self._refresh, key)
+        return answer
+
+    def fetch(self, key):
+        """
+        Look key up, bypassing and updating the cache.
+        """
+        answer, certain = self.lookup(key)
+        if certain:
+            self.put(key, answer)
+        return answer
+
+    def _refresh(self, key):
+        try:
+            self.refreshes += 1
+            self.fetch(key)
+        except Exception:
+            cache_logger.error("caught exception while refreshing %s", key, exc_info=True)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def put(self, key, answer):
+        expires = self.clock() + (self.ttl if answer is not None else self.negative_ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (answer, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key=None):
+        """
+        Forget key, or everything if key is None.
+        """
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
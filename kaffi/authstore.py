@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk snapshot of the authorizations confirmed by the org backends, so
+swipes can still be answered when the backends are slow or unreachable.
+"""
+from __future__ import absolute_import
+
+import logging
+import sqlite3
+import threading
+import time
+
+from . import pool
+
+store_logger = logging.getLogger("authstore")
+
+class AuthStore(object):
+    """
+    SQLite table of legi number -> (org, last verified). Lookups are point
+    queries on the primary key and need no warm up after a restart.
+
+    Writes are done on a single writer thread, so recording a lookup never
+    delays the swipe it belongs to.
+
+    :param path: database file, created if missing
+    :param max_age: entries last verified longer ago are not used
+    """
+
+    def __init__(self, path, max_age=30 * 24 * 3600.0, clock=time.time):
+        self.path = path
+        self.max_age = max_age
+        self.clock = clock
+        self.hits = self.misses = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._writer = pool.WorkerPool(1, name="authstore")
+        with self._lock:
+            try:
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            except sqlite3.DatabaseError:
+                store_logger.warning("could not switch %s to WAL mode", path, exc_info=True)
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS authorizations ("
+                               "legi TEXT PRIMARY KEY, org TEXT NOT NULL, verified REAL NOT NULL)")
+            self._conn.commit()
+
+    def get(self, legi):
+        """
+        Return the org legi was last verified for, or None.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT org, verified FROM authorizations WHERE legi = ?",
+                                     (legi,)).fetchone()
+        if row and self.clock() - row[1] <= self.max_age:
+            self.hits += 1
+            return row[0]
+        self.misses += 1
+        return None
+
+    def record(self, legi, org):
+        """
+        Record the answer of the backends for legi: an org, or None if it
+        was denied.
+        """
+        self._writer.submit(self._write, legi, org, self.clock())
+
+    def _write(self, legi, org, verified):
+        try:
+            with self._lock:
+                if org is None:
+                    self._conn.execute("DELETE FROM authorizations WHERE legi = ?", (legi,))
+                else:
+                    self._conn.execute("INSERT OR REPLACE INTO authorizations (legi, org, verified) "
+                                       "VALUES (?, ?, ?)", (legi, org, verified))
+                self._conn.commit()
+        except sqlite3.Error:
+            store_logger.error("could not record %s for %s", org, legi, exc_info=True)
+
+    def flush(self, timeout=None):
+        """
+        Wait until the recorded answers are written.
+        """
+        return self._writer.submit(lambda: None).wait(timeout)
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM authorizations").fetchone()[0]
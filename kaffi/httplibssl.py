@@ -4,6 +4,7 @@ from __future__ import absolute_import
 
 import socket
 import ssl
+import threading
 try:
     # python3
     from http.client import HTTPSConnection
@@ -11,34 +12,96 @@ except ImportError:
     # python2
     from httplib import HTTPSConnection
 
+_contexts = {}
+_sessions = {}
+_lock = threading.Lock()
+
+def get_context(key_file, cert_file, ca_file, verify=False):
+    """
+    Return the SSLContext for the given client certificate and CA file,
+    building it on first use. Key, certificate and CA files are read once.
+    """
+    context_key = (key_file, cert_file, ca_file, bool(verify))
+    with _lock:
+        context = _contexts.get(context_key)
+        if context is None:
+            if ca_file:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                context.verify_mode = ssl.CERT_REQUIRED
+                context.load_verify_locations(ca_file)
+            elif verify:
+                context = ssl.create_default_context()
+            else:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                context.load_cert_chain(cert_file, key_file)
+            _contexts[context_key] = context
+        return context
+
 class HTTPSClientAuthConnection(HTTPSConnection):
-    """ Class to make a HTTPS connection, with support for full client-based SSL Authentication"""
+    """ Class to make a HTTPS connection, with support for full client-based SSL Authentication
+
+        The SSLContext is shared by all connections with the same key, cert
+        and CA files. Where the ssl module supports it (python 3.6+), the TLS
+        session of the last connection to the same host is resumed.
+    """
 
-    def __init__(self, host, port, key_file, cert_file, ca_file, timeout=None):
-        HTTPSConnection.__init__(self, host, key_file=key_file, cert_file=cert_file)
+    def __init__(self, host, port, key_file, cert_file, ca_file, timeout=None, verify=False):
+        self.context = get_context(key_file, cert_file, ca_file, verify)
+        try:
+            # don't let HTTPSConnection build a default context of its own
+            HTTPSConnection.__init__(self, host, context=self.context)
+        except TypeError:
+            # python < 2.7.9
+            HTTPSConnection.__init__(self, host)
         self.key_file = key_file
         self.cert_file = cert_file
         self.ca_file = ca_file
         self.timeout = timeout
         self.port = port
+        # without ca_file, check the server certificate against the system CAs
+        self.verify = verify
+
+    def _session_key(self):
+        return (self.host, self.port, id(self.context))
 
     def connect(self):
         """ Connect to a host on a given (SSL) port.
-            If ca_file is pointing somewhere, use it to check Server Certificate.
+            If ca_file is pointing somewhere, use it to check Server Certificate,
+            otherwise use the system CAs if verify is set.
 
             Redefined/copied and extended from httplib.py:1105 (Python 2.6.x).
-            This is needed to pass cert_reqs=ssl.CERT_REQUIRED as parameter to ssl.wrap_socket(),
-            which forces SSL to check server certificate against our client certificate.
+            This is needed to check the server certificate against our CA file
+            (cert_reqs=ssl.CERT_REQUIRED), see get_context.
         """
         sock = socket.create_connection((self.host, self.port), self.timeout)
         if self._tunnel_host:
             self.sock = sock
             self._tunnel()
-        # If there's no CA File, don't force Server Certificate Check
-        if self.ca_file:
-            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file, ca_certs=self.ca_file, cert_reqs=ssl.CERT_REQUIRED)
-        else:
-            self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file, cert_reqs=ssl.CERT_NONE)
+        kwargs = {}
+        if ssl.HAS_SNI:
+            kwargs['server_hostname'] = self.host
+        session = _sessions.get(self._session_key())
+        if session is not None:
+            kwargs['session'] = session
+        self.sock = self.context.wrap_socket(sock, **kwargs)
+        self._remember_session()
+
+    def _remember_session(self):
+        # TLS 1.3 sends the session ticket after the handshake, so this is
+        # done again when the connection is closed
+        session = getattr(self.sock, 'session', None)
+        if session is not None:
+            _sessions[self._session_key()] = session
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self._remember_session()
+            except (ssl.SSLError, ValueError):
+                pass
+        HTTPSConnection.close(self)
 
 if __name__ == '__main__':
     # Little test-case of our class
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Shared pool of persistent HTTP(S) connections to the org backends.
+
+Every status check and billing report used to open a new connection, paying
+for DNS, TCP and a TLS handshake each time. urlopen() here reuses idle
+connections to the same host instead.
+"""
+from __future__ import absolute_import
+
+import collections
+import errno
+import logging
+import socket
+import threading
+import time
+try:
+    # python3
+    from http.client import HTTPConnection, BadStatusLine
+    from urllib.parse import urlsplit
+except ImportError:
+    # python2
+    from httplib import HTTPConnection, BadStatusLine
+    from urlparse import urlsplit
+
+from .httplibssl import HTTPSClientAuthConnection
+
+pool_logger = logging.getLogger("httppool")
+
+class PoolTimeout(Exception):
+    pass
+
+class Response(object):
+    """
+    A fully read response. Can be used like the file returned by urllib's
+    urlopen (read(), getcode()).
+    """
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def getcode(self):
+        return self.status
+
+    def read(self, size=-1):
+        return self.data
+
+# errors of a request on a reused connection that mean the server closed it
+# while it was idle, before it saw the request
+_STALE_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+class ConnectionPool(object):
+    """
+    Idle connections per (scheme, host, port), at most max_per_host in use
+    per host at a time. Connections idle for longer than idle_timeout
+    seconds are closed.
+
+    HTTPS connections are HTTPSClientAuthConnections using key_file and
+    cert_file as client certificate if given. Without ca_file the server is
+    verified against the system CAs.
+    """
+
+    def __init__(self, max_per_host=4, idle_timeout=60.0, timeout=5.0,
+                 key_file=None, cert_file=None, ca_file=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.ca_file = ca_file
+        self.created = self.reused = 0
+        self._idle = collections.defaultdict(collections.deque)
+        self._in_use = collections.defaultdict(int)
+        self._lock = threading.Condition()
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        self.created += 1
+        if scheme == 'https':
+            return HTTPSClientAuthConnection(host, port or 443, self.key_file, self.cert_file,
+                                             self.ca_file, timeout, verify=True)
+        return HTTPConnection(host, port or 80, timeout=timeout)
+
+    def _checkout(self, key):
+        """
+        Return an idle connection to key or None, closing expired ones.
+        """
+        now = time.time()
+        with self._lock:
+            idle = self._idle[key]
+            while idle:
+                conn, since = idle.pop()
+                if now - since < self.idle_timeout:
+                    return conn
+                conn.close()
+            return None
+
+    def _checkin(self, key, conn):
+        with self._lock:
+            self._idle[key].append((conn, time.time()))
+
+    def evict_idle(self):
+        """
+        Close all connections that were idle for longer than idle_timeout.
+        """
+        now = time.time()
+        with self._lock:
+            for idle in self._idle.values():
+                # oldest first
+                while idle and now - idle[0][1] >= self.idle_timeout:
+                    idle.popleft()[0].close()
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                while idle:
+                    idle.pop()[0].close()
+
+    def prewarm(self, url, timeout=None):
+        """
+        Make sure there is an idle connection to the host of url, so the next
+        request does not wait for the connection and TLS handshake.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        self.evict_idle()
+        with self._lock:
+            if self._idle[key]:
+                return False
+        conn = self._connect(key, timeout)
+        conn.connect()
+        self._checkin(key, conn)
+        return True
+
+    def _acquire(self, key, timeout):
+        deadline = time.time() + timeout
+        with self._lock:
+            while self._in_use[key] >= self.max_per_host:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._lock.wait(remaining)
+            self._in_use[key] += 1
+            return True
+
+    def _release(self, key):
+        with self._lock:
+            self._in_use[key] -= 1
+            self._lock.notify()
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        """
+        Send a request and read the response. Raises PoolTimeout if no
+        connection to the host is free within timeout seconds.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        if not self._acquire(key, timeout):
+            raise PoolTimeout("no free connection to %s within %s seconds" % (parts.hostname, timeout))
+        try:
+            self.evict_idle()
+            conn = self._checkout(key)
+            if conn is not None:
+                self.reused += 1
+                try:
+                    return self._send(key, conn, method, path, body, headers, timeout)
+                except (BadStatusLine, socket.error) as e:
+                    if isinstance(e, socket.error) and getattr(e, 'errno', None) not in _STALE_ERRNOS:
+                        raise
+                    pool_logger.debug("connection to %s went stale, reconnecting", parts.hostname)
+            conn = self._connect(key, timeout)
+            return self._send(key, conn, method, path, body, headers, timeout)
+        finally:
+            self._release(key)
+
+    def _send(self, key, conn, method, path, body, headers, timeout):
+        try:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            conn.request(method, path, body, headers or {})
+            response = conn.getresponse()
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        return Response(response.status, response.reason, response.getheaders(), data)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """
+    Return the process wide ConnectionPool, configured from the [http]
+    config section.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                from .system import get_option
+                def option(name, default):
+                    try:
+                        return get_option('http', name, default)
+                    except ValueError:
+                        # no config file
+                        return default
+                _pool = ConnectionPool(option('max_per_host', 4), option('idle_timeout', 60.0),
+                                       option('timeout', 5.0), option('key_file', None),
+                                       option('cert_file', None), option('ca_file', None))
+    return _pool
+
+def _keep_warm(urls, interval):
+    while True:
+        for url in urls:
+            try:
+                if get_pool().prewarm(url):
+                    pool_logger.debug("prewarmed connection for %s", url)
+            except Exception:
+                pool_logger.warning("could not prewarm connection for %s", url, exc_info=True)
+        time.sleep(interval)
+
+def start_prewarm():
+    """
+    Start a thread that keeps an idle connection open to each of the URLs
+    in [http] prewarm (whitespace separated), so the first swipe after a
+    quiet period does not pay for a handshake. Does nothing if the option
+    is not set.
+    """
+    from .system import get_option
+    urls = get_option('http', 'prewarm', '').split()
+    if not urls:
+        return None
+    interval = get_option('http', 'prewarm_interval', get_pool().idle_timeout / 2)
+    thread = threading.Thread(target=_keep_warm, args=(urls, interval), name="prewarm")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def urlopen(url, timeout=None):
+    """
+    GET url through the shared pool. Returns a Response.
+    """
+    return get_pool().request('GET', url, timeout=timeout)
@@ -3,14 +3,234 @@ from __future__ import absolute_import
 
 import serial
 import binascii
+import collections
 import logging
 import threading
+import time
 
 legi_logger = logging.getLogger("legi")
 
 tohex = binascii.hexlify
 fromhex = binascii.unhexlify
 
+class LegiFrameDecoder(object):
+    """
+    Streaming decoder for the frames of the legi reader: 14 bytes starting
+    with 0d80, the legi number in bytes 10 to 12.
+
+    Bytes can be fed in chunks of any size. Bytes that can't be the start
+    of a frame are skipped up to the next header, which counts as a resync.
+    A partial frame followed by no data for stale_after seconds (a frame
+    cut off by the reader) is dropped as well, so it can't swallow the
+    start of the next frame.
+    """
+
+    HEADER = fromhex("0d80")
+    FRAME_SIZE = 14
+
+    def __init__(self, stale_after=0.5, clock=time.time):
+        self.stale_after = stale_after
+        self.clock = clock
+        self.resyncs = 0
+        self.discarded = 0
+        self._buf = bytearray()
+        self._last_data = None
+
+    def _discard(self, count):
+        if count:
+            legi_logger.debug("discarding %s", tohex(bytes(self._buf[:count])))
+            del self._buf[:count]
+            self.resyncs += 1
+            self.discarded += count
+
+    def feed(self, data):
+        """
+        Add the bytes in data, return the list of complete frames.
+        """
+        now = self.clock()
+        if self._buf and self._last_data is not None and now - self._last_data > self.stale_after:
+            self._discard(len(self._buf))
+        if not data:
+            return []
+        self._last_data = now
+        buf = self._buf
+        buf.extend(data)
+
+        frames = []
+        while len(buf) >= len(self.HEADER):
+            start = buf.find(self.HEADER)
+            if start < 0:
+                # keep a trailing first header byte, the rest can't be a frame
+                keep = 1 if buf[-1:] == self.HEADER[:1] else 0
+                self._discard(len(buf) - keep)
+                break
+            self._discard(start)
+            if len(buf) < self.FRAME_SIZE:
+                break
+            frames.append(bytes(buf[:self.FRAME_SIZE]))
+            del buf[:self.FRAME_SIZE]
+        return frames
+
+    @staticmethod
+    def legi(frame):
+        return tohex(frame[10:13])
+
+class SwipeDebouncer(object):
+    """
+    Filters swipes before they are authorized. The reader keeps sending the
+    number of a legi held on it, every repeat would be another lookup.
+
+    A legi seen again within window seconds of its last swipe is dropped
+    (debounced), as is a legi whose previous swipe has not been released
+    yet (in flight). Thread safe.
+    """
+
+    def __init__(self, window=2.0, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self.debounced = 0
+        self.in_flight_dropped = 0
+        self._last_seen = {}
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def admit(self, legi):
+        """
+        Return True if the swipe should be handled. The caller has to
+        release() every admitted legi once it is done with it.
+        """
+        now = self.clock()
+        with self._lock:
+            last = self._last_seen.get(legi)
+            self._last_seen[legi] = now
+            if len(self._last_seen) > 1000:
+                self._expire(now)
+            if legi in self._in_flight:
+                self.in_flight_dropped += 1
+                legi_logger.info("dropping swipe of %s, vend in flight", legi)
+                return False
+            if last is not None and now - last < self.window:
+                self.debounced += 1
+                legi_logger.info("dropping repeated swipe of %s", legi)
+                return False
+            self._in_flight.add(legi)
+            return True
+
+    def release(self, legi):
+        with self._lock:
+            self._in_flight.discard(legi)
+
+    def _expire(self, now):
+        for legi, seen in list(self._last_seen.items()):
+            if now - seen >= self.window:
+                del self._last_seen[legi]
+
+class Swipe(object):
+    """
+    A swipe waiting in a SwipeQueue.
+
+    :attribute lookup: optional pool.Result of the authorization lookup,
+        started when the swipe was queued
+    """
+
+    def __init__(self, legi, queued_at, lookup=None):
+        self.legi = legi
+        self.queued_at = queued_at
+        self.lookup = lookup
+
+class SwipeQueue(object):
+    """
+    Bounded FIFO of swipes waiting to be authorized. Thread safe.
+
+    If the queue is full the oldest swipe is dropped. Swipes older than
+    max_age seconds are dropped by get(), the user is most likely gone.
+    on_drop(swipe) is called for every dropped swipe. The time swipes
+    spent in the queue is recorded in wait_count, wait_total and wait_max.
+    """
+
+    def __init__(self, maxlen=8, max_age=30.0, on_drop=None, clock=time.time):
+        self.maxlen = maxlen
+        self.max_age = max_age
+        self.on_drop = on_drop
+        self.clock = clock
+        self.dropped = 0
+        self.expired = 0
+        self.wait_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._swipes = collections.deque()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._swipes)
+
+    def _drop(self, swipe):
+        if self.on_drop:
+            try:
+                self.on_drop(swipe)
+            except Exception:
+                legi_logger.error("caught exception while dropping swipe of %s", swipe.legi, exc_info=True)
+
+    def put(self, legi, lookup=None):
+        swipe = Swipe(legi, self.clock(), lookup)
+        dropped = None
+        with self._cond:
+            if len(self._swipes) >= self.maxlen:
+                dropped = self._swipes.popleft()
+                self.dropped += 1
+            self._swipes.append(swipe)
+            self._cond.notify()
+        if dropped:
+            legi_logger.warning("swipe queue full, dropping swipe of %s", dropped.legi)
+            self._drop(dropped)
+        return swipe
+
+    def is_expired(self, swipe, now=None):
+        now = self.clock() if now is None else now
+        return now - swipe.queued_at > self.max_age
+
+    def remaining(self, swipe, now=None):
+        """
+        Return the seconds until swipe expires.
+        """
+        now = self.clock() if now is None else now
+        return swipe.queued_at + self.max_age - now
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest swipe that is not expired, waiting up
+        to timeout seconds (forever if None) for one. Returns None on
+        timeout.
+        """
+        expired = []
+        try:
+            with self._cond:
+                deadline = None if timeout is None else time.time() + timeout
+                while True:
+                    while self._swipes:
+                        swipe = self._swipes.popleft()
+                        now = self.clock()
+                        if self.is_expired(swipe, now):
+                            self.expired += 1
+                            expired.append(swipe)
+                            continue
+                        waited = now - swipe.queued_at
+                        self.wait_count += 1
+                        self.wait_total += waited
+                        self.wait_max = max(self.wait_max, waited)
+                        return swipe
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            return None
+                        self._cond.wait(remaining)
+        finally:
+            for swipe in expired:
+                legi_logger.info("dropping swipe of %s, queued for too long", swipe.legi)
+                self._drop(swipe)
+
 class LegiListener(object):
 
     def __init__(self, serial, enable, legi_receiver):
@@ -18,20 +238,47 @@ class LegiListener(object):
         self.running = None
         self.legi_receiver = legi_receiver
         self.enable = enable
+        self.decoder = LegiFrameDecoder()
+
+    def _in_waiting(self):
+        try:
+            # pyserial 3
+            return self.serial.in_waiting
+        except AttributeError:
+            # pyserial 2
+            return self.serial.inWaiting()
+
+    def read_available(self):
+        """
+        Read the bytes currently waiting on the reader without blocking.
+        """
+        return self.serial.read(self._in_waiting())
+
+    def feed(self, data):
+        """
+        Handle bytes read from the reader, in chunks of any size. The reader
+        is enabled again after each complete frame.
+        """
+        if data:
+            legi_logger.debug("got input %s", tohex(data))
+        for frame in self.decoder.feed(data):
+            self._handle_frame(frame)
 
     def _do_read(self):
-        ans = self.serial.read(size=14)
-        if ans:
-            legi_logger.debug("got input %s", tohex(ans))
-        if ans and len(ans) == 14 and ans[:2] == fromhex("0d80"):
-            legi = tohex(ans[10:13])
-            legi_logger.info("got legi %r" % legi)
-            try:
-                self.legi_receiver(legi)
-            except Exception:
-                legi_logger.error("caught exception while handling legi %s", legi, exc_info=True)
-        if ans:
-            self.serial.write(self.enable)
+        # Block for one byte at most, then take what is there. Waiting for a
+        # whole frame's worth would hold the rest of a frame that followed
+        # some garbage until the read timeout, and the decoder would drop
+        # its start as stale.
+        self.feed(self.serial.read(max(1, self._in_waiting())))
+
+    def _handle_frame(self, frame):
+        legi = LegiFrameDecoder.legi(frame)
+        legi_logger.info("got legi %r" % legi)
+        try:
+            self.legi_receiver(legi)
+        except Exception:
+            legi_logger.error("caught exception while handling legi %s", legi, exc_info=True)
+        self.serial.write(self.enable)
 
     def run(self):
         self.running = True
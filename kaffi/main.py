@@ -28,6 +28,10 @@ def main(args=None):
     sqllogger = sqllogging.SqlLogHandler(logging.WARNING)
     logging.getLogger().addHandler(sqllogger)
 
+    from . import status
+    # deliver the bills left over from the last run
+    status.get_outbox()
+
     logging.getLogger("system").setLevel(logging.DEBUG)
     logging.getLogger("mdb").setLevel(logging.DEBUG)
     logging.getLogger("translator").setLevel(logging.DEBUG)
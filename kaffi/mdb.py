@@ -2,19 +2,212 @@
 from __future__ import absolute_import
 
 import binascii
+import collections
 import logging
 import threading
+import time
 
 tohex = binascii.hexlify
 fromhex = binascii.unhexlify
 
 mdb_logger = logging.getLogger("mdb")
 
+# marks the idle poll fast path as unusable, see MdbL1Stm.received_data
+_NO_FAST_POLL = object()
+
+def _dispatch_table(handlers, fallback):
+    """
+    Build a state's dispatch table from a {command: handler} dict. The first
+    command byte may be offset by 50 (the subcommand stays the same), so every
+    command is entered under both forms. fallback is stored under None and
+    handles everything else.
+    """
+    table = {None: fallback}
+    for command, handler in handlers.items():
+        table[command] = handler
+        table[chr(ord(command[0]) + 50) + command[1:]] = handler
+    return table
+
+class VendTicket(object):
+    """
+    Authorization for one vend, handed from the authorizing thread to the
+    MDB state machine.
+
+    A ticket starts out pending and queued. The serial thread activates it
+    when it offers a session for it, approves it when the machine requests
+    a vend and then marks it succeeded or failed. The authorizing thread
+    waits for that with wait(). The ticket expires if its session is not
+    offered within queue_timeout seconds (other vends are ahead of it), if
+    it is not approved within approve_timeout seconds after that, or if it
+    has no result vend_timeout seconds after approval. The serial thread
+    enforces these deadlines with expire_due(), wait() as well in case the
+    machine stops talking. Each transition is a compare-and-set under a lock
+    that is only held for the update itself, so the serial thread never
+    blocks on the authorizing thread.
+
+    A vend success reported after the ticket of an approved vend failed or
+    expired still marks it succeeded, but wait() does not report it (it may
+    already have returned); late_success_callback(ticket) is called instead.
+
+    :attribute state: one of PENDING, APPROVED, SUCCEEDED, FAILED, EXPIRED
+    :attribute item_data: item data reported with the vend success
+    :attribute activated: time at which the ticket's session was offered,
+        None while it is still queued
+    :attribute approved_at: time at which the vend was approved, or None
+    :attribute late: whether the success was reported after the ticket
+        failed or expired
+    """
+
+    PENDING = 'pending'
+    APPROVED = 'approved'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    EXPIRED = 'expired'
+
+    FINAL_STATES = frozenset([SUCCEEDED, FAILED, EXPIRED])
+
+    def __init__(self, expired_callback=None, late_success_callback=None,
+                 approve_timeout=2.0, vend_timeout=60.0, queue_timeout=120.0):
+        self.state = self.PENDING
+        self.item_data = None
+        self.approve_timeout = approve_timeout
+        self.vend_timeout = vend_timeout
+        self.queue_deadline = time.time() + queue_timeout
+        self.activated = self.approved_at = None
+        self.late = False
+        self._changed = threading.Condition(threading.Lock())
+        self._expired_callback = expired_callback
+        self._late_success_callback = late_success_callback
+
+    def _transition(self, from_states, to_state):
+        with self._changed:
+            if self.state not in from_states:
+                return False
+            self.state = to_state
+            self._changed.notify_all()
+            return True
+
+    def is_pending(self):
+        return self.state == self.PENDING
+
+    def activate(self):
+        """
+        Start the approval window: a session is being offered for this
+        ticket.
+        """
+        with self._changed:
+            if self.activated is None:
+                self.activated = time.time()
+                self._changed.notify_all()
+
+    def approve(self):
+        """
+        Mark the ticket approved. Returns False if it is no longer pending.
+        """
+        with self._changed:
+            if self.state != self.PENDING:
+                return False
+            self.state = self.APPROVED
+            self.approved_at = time.time()
+            self._changed.notify_all()
+            return True
+
+    def succeed(self, item_data):
+        with self._changed:
+            previous = self.state
+            late = previous in (self.FAILED, self.EXPIRED) and self.approved_at is not None
+            if previous == self.APPROVED or late:
+                self.item_data = item_data
+                self.state = self.SUCCEEDED
+                self.late = late
+                self._changed.notify_all()
+            else:
+                previous = None
+        if previous is None:
+            mdb_logger.error("vend success for %s ticket, item data %s", self.state, tohex(item_data))
+            return False
+        if late:
+            mdb_logger.warning("vend success for %s ticket, item data %s", previous, tohex(item_data))
+            if self._late_success_callback:
+                self._late_success_callback(self)
+        return True
+
+    def fail(self):
+        return self._transition((self.APPROVED,), self.FAILED)
+
+    def expire(self, from_states=(PENDING,)):
+        """
+        Expire the ticket if it is in one of from_states. Returns whether it
+        did.
+        """
+        if not self._transition(from_states, self.EXPIRED):
+            return False
+        if self._expired_callback:
+            self._expired_callback(self)
+        return True
+
+    def expire_due(self, now=None):
+        """
+        Expire the ticket if one of its deadlines passed. Returns whether it
+        did.
+        """
+        now = time.time() if now is None else now
+        state, activated, approved_at = self.state, self.activated, self.approved_at
+        if state == self.PENDING:
+            if activated is None:
+                due = now >= self.queue_deadline
+            else:
+                due = now >= activated + self.approve_timeout
+            return due and self.expire()
+        if state == self.APPROVED and now >= approved_at + self.vend_timeout:
+            if self.expire((self.APPROVED,)):
+                mdb_logger.error("no vend result within %s seconds", self.vend_timeout)
+                return True
+        return False
+
+    def _wait_while(self, condition, deadline):
+        with self._changed:
+            while condition():
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    return False
+                self._changed.wait(timeout)
+            return True
+
+    def wait(self, approve_timeout=None, vend_timeout=None, queue_timeout=None):
+        """
+        Wait for the outcome of the vend, expiring the ticket at its
+        deadlines. The timeouts default to the ticket's own.
+
+        Returns (dispensed, item_data).
+        """
+        if approve_timeout is None:
+            approve_timeout = self.approve_timeout
+        if vend_timeout is None:
+            vend_timeout = self.vend_timeout
+        if queue_timeout is None:
+            queue_deadline = self.queue_deadline
+        else:
+            queue_deadline = time.time() + queue_timeout
+        queued = lambda: self.state == self.PENDING and self.activated is None
+        if not self._wait_while(queued, queue_deadline):
+            self.expire()
+        elif self.activated is not None:
+            deadline = self.activated + approve_timeout
+            if not self._wait_while(self.is_pending, deadline):
+                self.expire()
+        approved = lambda: self.state == self.APPROVED
+        if self.approved_at is not None and not self._wait_while(approved, self.approved_at + vend_timeout):
+            if self.expire((self.APPROVED,)):
+                mdb_logger.error("no vend result within %s seconds", vend_timeout)
+        with self._changed:
+            if self.state == self.SUCCEEDED and not self.late:
+                return True, self.item_data
+        return False, None
+
 class MdbL1Stm(object):
     """MDB state machine handler.
 
-    :attribute dispense_permitted: Set to True to allow next vend request, False to
-        deny it, None to reset session (and deny any requests)
     :attribute response_data: data to be sent after next receive. If set
         externally this will only have an effect if no other response is
         sent due to the receive (i.e. if you're debugging you can set this
@@ -91,31 +284,172 @@ class MdbL1Stm(object):
 
     ACK = fromhex('00')
 
+    #
+    # Constant replies
+    #
 
-    def __init__(self):
+    READER_CONF_DATA = ''.join([
+        RES_READER_CONF_DATA,
+        fromhex('01'), # feature level
+        fromhex('0001'), # US dollars... CHF -> 1756?
+        fromhex('01'), # scale factor
+        fromhex('02'), # decimal places
+        fromhex('01'), # application maximum response time - seconds
+        fromhex('00'), # misc options
+    ])
+
+    PERIPHERAL_ID_DATA = ''.join([
+        RES_PERIPHERAL_ID,
+        fromhex('414258'), # manufacturer code - ASCII
+        fromhex('202020202020202020202020'), # serial number - ASCII
+        fromhex('413320202020202020202020'), # model number - ASCII
+        fromhex('1531'), # software version - packed BCD
+    ])
+
+    BEGIN_SESS_DATA = RES_BEGIN_SESS + fromhex('FFFF')
+    VEND_APPROVED_DATA = RES_VEND_APPROVED + fromhex('FFFF')
+
+    # Every reply that never changes, mapped to the string actually sent (with
+    # the leading ACK). received_data returns these objects, so the translator
+    # can cache their encoded frames (see CONSTANT_RESPONSES).
+    _ACK_RESPONSES = {}
+    for _res in ["", RES_RESET, RES_END_SESSION, RES_CANCELLED, RES_MALFUNCTION,
+                 RES_SESS_CANCEL_REQ, RES_VEND_DENIED, READER_CONF_DATA,
+                 PERIPHERAL_ID_DATA, BEGIN_SESS_DATA, VEND_APPROVED_DATA]:
+        _ACK_RESPONSES[_res] = ACK + _res
+    del _res
+    CONSTANT_RESPONSES = tuple(_ACK_RESPONSES.values())
+
+    _ACK_POLL = ACK + CMD_POLL
+
+    # States whose poll handling depends on nothing but the pending
+    # authorization token, so a bare ACK reply can be repeated while the
+    # token does not change. Only used while there is no ticket, whose
+    # deadlines are checked on every slow path message.
+    _FAST_POLL_STATES = frozenset(['st_disabled', 'st_enabled', 'st_session_idle'])
+
+
+    def __init__(self, multi_vend=False, max_tickets=8):
         """
         Initialization.
+
+        :param multi_vend: queue authorizations and keep a session open
+            after a vend while further authorizations are pending, so the
+            next vend request is approved without ending and beginning a
+            session. Without it there is one authorization at a time, a new
+            one replaces a pending one.
+        :param max_tickets: maximal number of queued authorizations in
+            multi-vend mode, further ones expire right away
         """
         self.response_data = ""
         self.state = self.st_inactive
         self.config_data = self.maxmin_data = self.item_data = None
         self.send_reset = True
         self.cancel_countdown = 0
+        self.multi_vend = multi_vend
+        self.max_tickets = max_tickets
+
+        # Pending VendTickets in authorization order. _tickets_lock guards
+        # the compound updates of the queue and _pending_auth and is never
+        # held for longer than that.
+        self._tickets = collections.deque()
+        self._tickets_lock = threading.Lock()
+        # First pending VendTicket, if any. Read by the serial thread without
+        # a lock; a new ticket or clearing it is what the poll fast path
+        # watches for.
+        self._pending_auth = None
+        # Approved ticket of the running vend (only in st_vend).
+        self._vend_ticket = None
+        # _pending_auth value for which the last poll was answered with a
+        # bare ACK in the current state.
+        self._fast_poll_token = _NO_FAST_POLL
+
+    @property
+    def allow(self):
+        """
+        Whether a dispense is currently authorized.
+        """
+        ticket = self._pending_auth
+        return ticket is not None and ticket.is_pending()
 
-        # Whether we want to allow ONE dispense. Access guarded by _lock.
-        # _lock must be held while in state st_vend (between approve and success/cancel).
-        self.allow = False
-        self._lock = threading.Condition()
-
-    def allow_one_and_wait(self):
-        with self._lock:
-            assert not self.allow
-            self.allow = True
-            self._lock.wait(2) # Two second timeout.
-            dispensed = not self.allow
-            self.allow = False
-            item_data = self.item_data if dispensed else None
-            return dispensed, item_data
+    def authorize(self, late_success_callback=None, approve_timeout=2.0, vend_timeout=60.0,
+                  queue_timeout=120.0):
+        """
+        Allow ONE dispense, after the ones already authorized (multi-vend).
+        Returns the VendTicket to wait on.
+
+        :param late_success_callback: called with the ticket if the vend
+            succeeds after the ticket failed or expired, see VendTicket
+        """
+        ticket = VendTicket(self._ticket_expired, late_success_callback,
+                            approve_timeout, vend_timeout, queue_timeout)
+        with self._tickets_lock:
+            if self.multi_vend:
+                full = len(self._tickets) >= self.max_tickets
+                replaced = []
+            else:
+                full = False
+                replaced = list(self._tickets)
+            if not full:
+                self._tickets.append(ticket)
+                if self._pending_auth is None:
+                    self._pending_auth = ticket
+        for previous in replaced:
+            if previous.expire():
+                mdb_logger.warning("authorization replaced before it was used")
+        if full:
+            mdb_logger.warning("%d authorizations queued, dropping the new one", self.max_tickets)
+            ticket.expire()
+        return ticket
+
+    def _expire_tickets(self):
+        """
+        Internal method. Expire the queued tickets and the running vend's
+        ticket whose deadlines passed.
+        """
+        now = time.time()
+        with self._tickets_lock:
+            tickets = list(self._tickets)
+        vend_ticket = self._vend_ticket
+        if vend_ticket is not None:
+            tickets.append(vend_ticket)
+        for ticket in tickets:
+            ticket.expire_due(now)
+
+    def _next_ticket(self):
+        """
+        Internal method. Drop tickets that are no longer pending from the
+        front of the queue and publish the next one. _tickets_lock must be
+        held.
+        """
+        tickets = self._tickets
+        while tickets and not tickets[0].is_pending():
+            tickets.popleft()
+        self._pending_auth = tickets[0] if tickets else None
+
+    def _ticket_expired(self, ticket):
+        # runs on the authorizing thread
+        with self._tickets_lock:
+            try:
+                self._tickets.remove(ticket)
+            except ValueError:
+                pass
+            self._next_ticket()
+
+    def _take_ticket(self):
+        """
+        Internal method. Approve the first pending ticket and remove it from
+        the queue. Returns it, or None if there is none (or it just expired).
+        """
+        ticket = self._pending_auth
+        if ticket is None or not ticket.approve():
+            return None
+        with self._tickets_lock:
+            self._next_ticket()
+        return ticket
+
+    def allow_one_and_wait(self, approve_timeout=2.0, vend_timeout=60.0):
+        return self.authorize(approve_timeout=approve_timeout, vend_timeout=vend_timeout).wait()
 
     def _set_state(self, state):
         """
@@ -123,6 +457,8 @@ class MdbL1Stm(object):
         """
         mdb_logger.info("transitioning from %s to %s", self.state.__name__, state.__name__)
 
+        self._fast_poll_token = _NO_FAST_POLL
+
         # run "entry" method if present
         name = state.__name__
         if hasattr(self, 'enter_'+name):
@@ -146,11 +482,12 @@ class MdbL1Stm(object):
     def received_nack(self):
         mdb_logger.error("Received nack. Resetting...")
         if self.state == self.st_vend:
-            self._lock.release()
-            mdb_logger.error("Deadlock: Disabled     (by decision)")
+            mdb_logger.error("nack during vend, failing it")
+            self._end_vend().fail()
 
         self.response_data = ""
         self.state = self.st_inactive
+        self._fast_poll_token = _NO_FAST_POLL
         self.config_data = self.maxmin_data = self.item_data = None
         self.send_reset = True
         self.cancel_countdown = 0
@@ -159,136 +496,188 @@ class MdbL1Stm(object):
         """
         Handle received data, return data to send back.
         """
+        # Fast path for idle polls: if the last poll in this state was
+        # answered with a bare ACK and the pending authorization has not
+        # changed since, the answer is the same. No lock, no logging.
+        if (data == self._ACK_POLL and self._fast_poll_token is self._pending_auth
+                and not self.response_data):
+            return self.ACK
+
         if data.startswith(self.ACK):
             data = data[1:]
         else:
             mdb_logger.warning("data does not start with ACK")
 
         if data == self.CMD_POLL:
-            mdb_logger.debug("got message %s", tohex(data))
-        else:
+            if mdb_logger.isEnabledFor(logging.DEBUG):
+                mdb_logger.debug("got message %s", tohex(data))
+        elif mdb_logger.isEnabledFor(logging.INFO):
             mdb_logger.info("got message %s", tohex(data))
 
-        result = self.state(data)
+        if self._tickets or self._vend_ticket is not None:
+            self._expire_tickets()
+
+        # read before handling: if it changes meanwhile, the next poll takes
+        # the slow path again
+        token = self._pending_auth
+        state = self.state
+        result = state(data)
         data_to_send = self.response_data or result or ""
         self.response_data = ""
-        data_to_send = self.ACK + data_to_send
-
-        if data_to_send != self.ACK:
+        data_to_send = self._ACK_RESPONSES.get(data_to_send) or self.ACK + data_to_send
+
+        if data_to_send == self.ACK:
+            if (data == self.CMD_POLL and self.state == state and token is None
+                    and state.__name__ in self._FAST_POLL_STATES):
+                self._fast_poll_token = token
+            if mdb_logger.isEnabledFor(logging.DEBUG):
+                mdb_logger.debug("sending message %s", tohex(data_to_send))
+        elif mdb_logger.isEnabledFor(logging.INFO):
             mdb_logger.info("sending message %s", tohex(data_to_send))
-        else:
-            mdb_logger.debug("sending message %s", tohex(data_to_send))
         return data_to_send
 
-    def default_handler(self, data):
-        if self.is_command(data, self.CMD_SETUP_CONF_DATA):
-            return ''.join([
-                self.RES_READER_CONF_DATA,
-                fromhex('01'), # feature level
-                fromhex('0001'), # US dollars... CHF -> 1756?
-                fromhex('01'), # scale factor
-                fromhex('02'), # decimal places
-                fromhex('01'), # application maximum response time - seconds
-                fromhex('00'), # misc options
-            ])
-
-        elif self.is_command(data, self.CMD_SETUP_MAXMIN_PRICE):
-            self.maxmin_data = data[len(self.CMD_SETUP_MAXMIN_PRICE):]
-            return
+    def _dispatch(self, table, data):
+        """
+        Internal method. Look up the handler for data in a dispatch table
+        (see _dispatch_table) and run it. Two byte commands (command and
+        subcommand) are looked up before single byte ones.
+        """
+        handler = table.get(data[:2]) or table.get(data[:1]) or table[None]
+        return handler(self, data)
 
-        elif self.is_command(data, self.CMD_EXP_REQUEST_ID):
-            return ''.join([
-                self.RES_PERIPHERAL_ID,
-                fromhex('414258'), # manufacturer code - ASCII
-                fromhex('202020202020202020202020'), # serial number - ASCII
-                fromhex('413320202020202020202020'), # model number - ASCII
-                fromhex('1531'), # software version - packed BCD
-            ])
+    #
+    # Command handlers, shared by the states' dispatch tables
+    #
 
-        else:
-            return self._out_of_sequence(data)
+    def _ignore(self, data):
+        return
+
+    def _setup_conf_data(self, data):
+        return self.READER_CONF_DATA
+
+    def _setup_maxmin_price(self, data):
+        self.maxmin_data = data[len(self.CMD_SETUP_MAXMIN_PRICE):]
+        return
+
+    def _request_id(self, data):
+        return self.PERIPHERAL_ID_DATA
+
+    def _reset(self, data):
+        self._set_state(self.st_inactive)
+        return self.RES_RESET
+
+    def _enable(self, data):
+        self._set_state(self.st_enabled)
+        return
+
+    def _session_complete(self, data):
+        # reset current_dispense and return to enabled state
+        self._set_state(self.st_enabled)
+        return self.RES_END_SESSION
+
+    def _session_vend_cancel(self, data):
+        # this should not happend as we respond immediately to a
+        # vend_request.
+        mdb_logger.warning("got vend cancel command")
+        return self.RES_VEND_DENIED
+
+    def _session_reader_cancel(self, data):
+        # should not really happen in this state, handle anyway...
+        mdb_logger.warning("got reader cancel command")
+        self._set_state(self.st_enabled)
+        return self.RES_CANCELLED
+
+    def default_handler(self, data):
+        return self._dispatch(self._DEFAULT_TABLE, data)
 
     def _enter_st_inactive(self):
         self.send_reset = True
 
+    def _inactive_poll(self, data):
+        if self.send_reset:
+            self.send_reset = False
+            return self.RES_RESET
+
+    def _inactive_reset(self, data):
+        # set_state here despite already being in inactive state so enter
+        # method is executed.
+        self._set_state(self.st_inactive)
+        return
+
     def st_inactive(self, data):
         """
         Inactive state, expecting setup data or an enable command
         """
-        if self.is_command(data, self.CMD_POLL):
-            if self.send_reset:
-                self.send_reset = False
-                return self.RES_RESET
-
-        elif self.is_command(data, self.CMD_READER_ENABLE):
-            self._set_state(self.st_enabled)
-            return
-
-        elif self.is_command(data, self.CMD_RESET):
-            # set_state here despite already being in inactive state so enter
-            # method is executed.
-            self._set_state(self.st_inactive)
-            return
-
-        else:
-            return self.default_handler(data)
+        return self._dispatch(self._INACTIVE_TABLE, data)
 
     def st_disabled(self, data):
         """
         Disabled state, a sort of "standby" mode. No functions available, only
         resetting and transitioning to enabled state.
         """
-        if self.is_command(data, self.CMD_POLL):
+        return self._dispatch(self._DISABLED_TABLE, data)
+
+    def _enabled_poll(self, data):
+        # check for dispense request
+        ticket = self._pending_auth
+        if ticket is not None and ticket.is_pending():
+            # mark dispense request as current dispens and transition to
+            # session state
+            ticket.activate()
+            self._set_state(self.st_session_idle)
+            return self.BEGIN_SESS_DATA
+        else:
             return
 
-        elif self.is_command(data, self.CMD_RESET):
-            self._set_state(self.st_inactive)
-            return self.RES_RESET
+    def _disable(self, data):
+        self._set_state(self.st_disabled)
+        return
 
-        elif self.is_command(data, self.CMD_READER_ENABLE):
-            self._set_state(self.st_enabled)
-            return
-
-        else:
-            return self.default_handler(data)
+    def _enabled_reader_cancel(self, data):
+        # must handle this command, but does not really affect us.
+        return self.RES_CANCELLED
 
+    def _enabled_setup_conf_data(self, data):
+        # WORKAROUND: sometimes after a dispense the machine starts
+        # flooding setup conf data cmds.
+        mdb_logger.warning("got setup conf data in enabled state, sending malfunction")
+        return self.RES_MALFUNCTION
 
     def st_enabled(self, data):
         """
         Enabled state. Reacts to dispense notifications by starting a MDB
         "session", can also transition to disabled and reset state.
         """
+        return self._dispatch(self._ENABLED_TABLE, data)
 
-        if self.is_command(data, self.CMD_POLL):
-            # check for dispense request
-            with self._lock:
-                if self.allow:
-                    # mark dispense request as current dispens and transition to
-                    # session state
-                    self._set_state(self.st_session_idle)
-                    return self.RES_BEGIN_SESS + fromhex('FFFF')
-                else:
-                    return
-
-        elif self.is_command(data, self.CMD_READER_DISABLE):
-            self._set_state(self.st_disabled)
-            return
-
-        elif self.is_command(data, self.CMD_READER_CANCEL):
-            # must handle this command, but does not really affect us.
-            return self.RES_CANCELLED
+    def _session_idle_poll(self, data):
+        ticket = self._pending_auth
+        if ticket is None or not ticket.is_pending():
+            # No pending dispense request, cancel session
+            self._set_state(self.st_session_ending)
+            return self.RES_SESS_CANCEL_REQ
+        # the session is offered to the next ticket if the previous one
+        # expired
+        ticket.activate()
+        return
+
+    def _session_idle_vend_request(self, data):
+        item_data = data[len(self.CMD_VEND_REQUEST):]
+        mdb_logger.info("vend request item data: %s", tohex(item_data))
+
+        # determine if a coffee should be dispensed for the current request
+        ticket = self._take_ticket()
+        if ticket is None:
+            # no dispense notification
+            mdb_logger.info("Too slow.")
+            self._set_state(self.st_session_ending)
+            return self.RES_VEND_DENIED
 
-        elif self.is_command(data, self.CMD_RESET):
-            self._set_state(self.st_inactive)
-            return self.RES_RESET
-        
         else:
-            if self.is_command(data, self.CMD_SETUP_CONF_DATA):
-                # WORKAROUND: sometimes after a dispense the machine starts
-                # flooding setup conf data cmds.
-                mdb_logger.warning("got setup conf data in enabled state, sending malfunction")
-                return self.RES_MALFUNCTION
-            return self.default_handler(data)
+            # approve dispense, the ticket gets its result in st_vend
+            self._vend_ticket = ticket
+            self._set_state(self.st_vend)
+            return self.VEND_APPROVED_DATA
 
     def st_session_idle(self, data):
         """
@@ -297,60 +686,24 @@ class MdbL1Stm(object):
         the vend state. Otherwise, dispense requests are denied and the session
         is cancelled as soon as possible.
         """
+        return self._dispatch(self._SESSION_IDLE_TABLE, data)
 
-        if self.is_command(data, self.CMD_POLL):
-            with self._lock:
-                if not self.allow:
-                    # No pending dispense request, cancel session
-                    self._set_state(self.st_session_ending)
-                    return self.RES_SESS_CANCEL_REQ
-                return
-
-        elif self.is_command(data, self.CMD_VEND_REQUEST):
-            item_data = data[len(self.CMD_VEND_REQUEST):]
-            mdb_logger.info("vend request item data: %s", tohex(item_data))
-
-            self._lock.acquire();
-            # determine if a coffee should be dispensed for the current request
-            if not self.allow:
-                self._lock.release();
-                # no dispense notification
-                mdb_logger.info("Too slow.")
-                self._set_state(self.st_session_ending)
-                return self.RES_VEND_DENIED
-
-            else:
-                # approve dispense, keep lock. Lock will be cleared in st_vend
-                self._set_state(self.st_vend)
-                return self.RES_VEND_APPROVED + fromhex('FFFF')
-
-
-        elif self.is_command(data, self.CMD_VEND_CANCEL):
-            # this should not happend as we respond immediately to a
-            # vend_request.
-            mdb_logger.warning("got vend cancel command")
-            return self.RES_VEND_DENIED
-
-        elif self.is_command(data, self.CMD_VEND_SESS_COMPLETE):
-            # reset current_dispense and return to enabled state
-            self._set_state(self.st_enabled)
-            return self.RES_END_SESSION
-
-        elif self.is_command(data, self.CMD_READER_CANCEL):
-            # should not really happen in this state, handle anyway...
-            mdb_logger.warning("got reader cancel command")
-            self._set_state(self.st_enabled)
-            return self.RES_CANCELLED
-
-        elif self.is_command(data, self.CMD_RESET):
-            self._set_state(self.st_inactive)
-            return self.RES_RESET
+    def enter_st_session_ending(self):
+        self.cancel_countdown = 10
 
+    def _session_ending_poll(self, data):
+        if self.cancel_countdown > 0:
+            self.cancel_countdown -= 1
         else:
-            return self._out_of_sequence(data)
+            # XXX: is it ok to cancel a session like this?
+            return self.RES_SESS_CANCEL_REQ
 
-    def enter_st_session_ending(self):
-        self.cancel_countdown = 10
+    def _session_ending_vend_request(self, data):
+        return self.RES_VEND_DENIED
+
+    def _session_ending_vend_success(self, data):
+        mdb_logger.error("got vend_success in state session_ending")
+        return
 
     def st_session_ending(self, data):
         """
@@ -358,83 +711,124 @@ class MdbL1Stm(object):
         reported) or no dispense was requested (empty or false dispense
         status).
         """
+        return self._dispatch(self._SESSION_ENDING_TABLE, data)
 
-        if self.is_command(data, self.CMD_POLL):
-            if self.cancel_countdown > 0:
-                self.cancel_countdown -= 1
-            else:
-                # XXX: is it ok to cancel a session like this?
-                return self.RES_SESS_CANCEL_REQ
-
-        elif self.is_command(data, self.CMD_VEND_SESS_COMPLETE):
-            self._set_state(self.st_enabled)
-            return self.RES_END_SESSION
-
-        elif self.is_command(data, self.CMD_VEND_REQUEST):
-            return self.RES_VEND_DENIED
-
-        elif self.is_command(data, self.CMD_VEND_CANCEL):
-            mdb_logger.warning("got vend cancel command")
-            return self.RES_VEND_DENIED
-
-        elif self.is_command(data, self.CMD_READER_CANCEL):
-            # should not really happen in this state, handle anyway...
-            mdb_logger.warning("got reader cancel command")
-            self._set_state(self.st_enabled)
-            return self.RES_CANCELLED
-
-        elif self.is_command(data, self.CMD_VEND_SUCCESS):
-            mdb_logger.error("got vend_success in state session_ending")
-            return
-
-        elif self.is_command(data, self.CMD_RESET):
-            self._set_state(self.st_inactive)
-            return self.RES_RESET
+    def _end_vend(self):
+        """
+        Internal method. Return the running vend's ticket and forget it.
+        """
+        ticket, self._vend_ticket = self._vend_ticket, None
+        return ticket
 
+    def _after_vend(self):
+        """
+        Internal method. Leave st_vend after the vend result: stay in the
+        session for the next authorization (multi-vend), or end it.
+        """
+        ticket = self._pending_auth
+        if self.multi_vend and ticket is not None and ticket.is_pending():
+            mdb_logger.info("keeping session open for next vend")
+            ticket.activate()
+            self._set_state(self.st_session_idle)
         else:
-            return self._out_of_sequence(data)
+            self._set_state(self.st_session_ending)
+
+    def _vend_failure(self, data):
+        mdb_logger.warning("got vend_failure")
+        self._end_vend().fail()
+        self._after_vend()
+        return
+
+    def _vend_cancel(self, data):
+        mdb_logger.warning("got vend_cancel")
+        self._set_state(self.st_session_ending)
+        self._end_vend().fail()
+        return self.RES_VEND_DENIED
+
+    def _vend_success(self, data):
+        self.item_data = data[len(self.CMD_VEND_SUCCESS):]
+        mdb_logger.info("vend succes item data: %s", tohex(self.item_data))
+        self.itemdata = self.item_data
+        self._end_vend().succeed(self.item_data)
+        self._after_vend()
+        return
+
+    def _vend_reset(self, data):
+        mdb_logger.warning("got reset in st_vend")
+        self._set_state(self.st_inactive)
+        self._end_vend().fail()
+        return self.RES_RESET
+
+    def _vend_out_of_sequence(self, data):
+        # Does not change state, sends malefunction, reset should come next.
+        # The vend is failed now rather than at the vend timeout; should the
+        # machine still report a success, the ticket's late success callback
+        # bills it.
+        mdb_logger.warning("got out of sequence in st_vend")
+        self._vend_ticket.fail()
+        return self._out_of_sequence(data)
 
     def st_vend(self, data):
         """
         Inside dispense sequence. Expencts to be notified of the result of the
         dispense.
         """
-        assert self.allow #lock is held
-
-        if self.is_command(data, self.CMD_POLL):
-            pass
-
-        elif self.is_command(data, self.CMD_VEND_FAILURE):
-            mdb_logger.warning("got vend_failure")
-            self._set_state(self.st_session_ending)
-            self._lock.release()
-            return
-
-        elif self.is_command(data, self.CMD_VEND_CANCEL):
-            mdb_logger.warning("got vend_cancel")
-            self._set_state(self.st_session_ending)
-            self._lock.release()
-            return self.RES_VEND_DENIED
+        assert self._vend_ticket is not None
+        return self._dispatch(self._VEND_TABLE, data)
 
-        elif self.is_command(data, self.CMD_VEND_SUCCESS):
-            self.item_data = data[len(self.CMD_VEND_SUCCESS):]
-            mdb_logger.info("vend succes item data: %s", tohex(self.item_data))
-            self.allow = False
-            self.itemdata = self.item_data
-            self._lock.notify()
-            self._lock.release()
-            self._set_state(self.st_session_ending)
-            return
-
-        elif self.is_command(data, self.CMD_RESET):
-            mdb_logger.warning("got reset in st_vend")
-            self._set_state(self.st_inactive)
-            self._lock.release()
-            return self.RES_RESET
-
-        else:
-            # Does not change state, sends malefunction, reset should come next.
-            mdb_logger.warning("got out of sequence in st_vend (NOT releasing lock, will it deadlock)")
-            #self._lock.release()
-            return self._out_of_sequence(data)
+    #
+    # Dispatch tables, one per state
+    #
 
+    _DEFAULT_TABLE = _dispatch_table({
+        CMD_SETUP_CONF_DATA: _setup_conf_data,
+        CMD_SETUP_MAXMIN_PRICE: _setup_maxmin_price,
+        CMD_EXP_REQUEST_ID: _request_id,
+    }, _out_of_sequence)
+
+    _INACTIVE_TABLE = _dispatch_table({
+        CMD_POLL: _inactive_poll,
+        CMD_READER_ENABLE: _enable,
+        CMD_RESET: _inactive_reset,
+    }, default_handler)
+
+    _DISABLED_TABLE = _dispatch_table({
+        CMD_POLL: _ignore,
+        CMD_RESET: _reset,
+        CMD_READER_ENABLE: _enable,
+    }, default_handler)
+
+    _ENABLED_TABLE = _dispatch_table({
+        CMD_POLL: _enabled_poll,
+        CMD_READER_DISABLE: _disable,
+        CMD_READER_CANCEL: _enabled_reader_cancel,
+        CMD_RESET: _reset,
+        CMD_SETUP_CONF_DATA: _enabled_setup_conf_data,
+    }, default_handler)
+
+    _SESSION_IDLE_TABLE = _dispatch_table({
+        CMD_POLL: _session_idle_poll,
+        CMD_VEND_REQUEST: _session_idle_vend_request,
+        CMD_VEND_CANCEL: _session_vend_cancel,
+        CMD_VEND_SESS_COMPLETE: _session_complete,
+        CMD_READER_CANCEL: _session_reader_cancel,
+        CMD_RESET: _reset,
+    }, _out_of_sequence)
+
+    _SESSION_ENDING_TABLE = _dispatch_table({
+        CMD_POLL: _session_ending_poll,
+        CMD_VEND_SESS_COMPLETE: _session_complete,
+        CMD_VEND_REQUEST: _session_ending_vend_request,
+        CMD_VEND_CANCEL: _session_vend_cancel,
+        CMD_READER_CANCEL: _session_reader_cancel,
+        CMD_VEND_SUCCESS: _session_ending_vend_success,
+        CMD_RESET: _reset,
+    }, _out_of_sequence)
+
+    _VEND_TABLE = _dispatch_table({
+        CMD_POLL: _ignore,
+        CMD_VEND_FAILURE: _vend_failure,
+        CMD_VEND_CANCEL: _vend_cancel,
+        CMD_VEND_SUCCESS: _vend_success,
+        CMD_RESET: _vend_reset,
+    }, _vend_out_of_sequence)
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Durable queue of records that have to be delivered somewhere, e.g. the
+dispenses to bill.
+
+put() appends the record to a log file and syncs it to disk before it
+returns, a worker thread then delivers the records, retrying failed ones
+with exponential backoff. Delivered records are marked done in the same
+log, so after a restart only the undelivered records are delivered again.
+
+Records with the same batch key can be delivered together: a record waits
+up to flush_window seconds for others to join its batch.
+"""
+from __future__ import absolute_import
+
+import json
+import logging
+import os
+import threading
+import time
+
+outbox_logger = logging.getLogger("outbox")
+
+class Entry(object):
+
+    def __init__(self, id, record, next_try=0):
+        self.id = id
+        self.record = record
+        self.attempts = 0
+        self.next_try = next_try
+
+class BatchStats(object):
+    """
+    Delivery metrics of the records with one batch key.
+    """
+
+    def __init__(self):
+        self.batches = self.records = self.failed = self.max_batch = 0
+        # seconds between put() and the delivery of the records
+        self.wait_total = self.wait_max = 0.0
+        # seconds spent in deliver_batch()
+        self.flush_total = self.flush_max = 0.0
+
+    def as_dict(self):
+        return dict(batches=self.batches, records=self.records, failed=self.failed,
+                    max_batch=self.max_batch,
+                    avg_batch=float(self.records) / self.batches if self.batches else 0.0,
+                    avg_wait=self.wait_total / self.records if self.records else 0.0,
+                    max_wait=self.wait_max,
+                    avg_flush=self.flush_total / self.batches if self.batches else 0.0,
+                    max_flush=self.flush_max)
+
+class Outbox(object):
+    """
+    :param path: log file, created if missing
+    :param deliver: deliver(record), raises if the record could not be
+        delivered
+    :param base_delay: seconds to wait before the first retry, doubled for
+        every further one up to max_delay
+    :param compact_after: rewrite the log once it holds this many delivered
+        records
+    :param deliver_batch: deliver_batch(key, records) delivers records with
+        the same batch_key(record) at once and returns the list of those
+        that failed, or raises if all of them failed. Used instead of
+        deliver if given.
+    :param batch_size: maximal number of records per batch, a batch this
+        big is delivered without waiting for the flush window
+    :param flush_window: seconds a new record waits for others to join its
+        batch
+    """
+
+    def __init__(self, path, deliver, base_delay=1.0, max_delay=600.0, compact_after=1000,
+                 clock=time.time, deliver_batch=None, batch_key=None, batch_size=1,
+                 flush_window=0.0):
+        self.path = path
+        self.deliver = deliver
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.compact_after = compact_after
+        self.clock = clock
+        self.deliver_batch = deliver_batch
+        self.batch_key = batch_key or (lambda record: None)
+        self.batch_size = batch_size
+        self.flush_window = flush_window
+        self.delivered = self.failures = 0
+        self.stats = {}
+        self._pending = []
+        self._done_in_log = 0
+        self._next_id = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._load()
+        self._file = open(path, 'ab')
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        pending = {}
+        done = 0
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if data and not data.endswith(b'\n'):
+            # the last line was cut off by a crash while it was written, drop
+            # it so the next one is not appended to it
+            outbox_logger.warning("dropping incomplete line in %s: %r", self.path,
+                                  data[data.rfind(b'\n') + 1:])
+            with open(self.path, 'r+b') as f:
+                f.truncate(data.rfind(b'\n') + 1)
+        for line in data.splitlines(True):
+            if not line.endswith(b'\n'):
+                break
+            try:
+                item = json.loads(line.decode('utf-8'))
+            except ValueError:
+                outbox_logger.warning("skipping broken line in %s: %r", self.path, line)
+                continue
+            self._next_id = max(self._next_id, item['id'] + 1)
+            if 'record' in item:
+                pending[item['id']] = entry = Entry(item['id'], item['record'])
+                entry.queued_at = self.clock()
+            else:
+                pending.pop(item['id'], None)
+                done += 1
+        self._pending = sorted(pending.values(), key=lambda e: e.id)
+        self._done_in_log = done
+        if self._pending:
+            outbox_logger.info("%d undelivered records in %s", len(self._pending), self.path)
+
+    def _write(self, item):
+        self._file.write(json.dumps(item, sort_keys=True).encode('utf-8') + b'\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, record):
+        """
+        Store record on disk and queue it for delivery.
+        """
+        with self._cond:
+            entry = Entry(self._next_id, record, self.clock() + self.flush_window)
+            entry.queued_at = self.clock()
+            self._next_id += 1
+            self._write({'id': entry.id, 'record': record})
+            self._pending.append(entry)
+            self._cond.notify()
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="outbox")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def stop(self):
+        """
+        Stop delivering. Pending records stay in the log.
+        """
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+
+    def _next_batch(self):
+        """
+        Wait for records that are due for delivery and return their batch
+        key and entries, or None once stopped.
+        """
+        with self._cond:
+            while not self._stopped:
+                now = self.clock()
+                wait = None
+                new = {}
+                for entry in self._pending:
+                    key = self.batch_key(entry.record)
+                    if entry.next_try <= now:
+                        return key, self._collect(key, now)
+                    if entry.attempts == 0:
+                        new[key] = new.get(key, 0) + 1
+                        if new[key] >= self.batch_size:
+                            # full batch, no need to wait
+                            return key, self._collect(key, now)
+                    if wait is None or entry.next_try - now < wait:
+                        wait = entry.next_try - now
+                self._cond.wait(wait)
+            return None
+
+    def _collect(self, key, now):
+        """
+        Return up to batch_size entries with batch key that are due or new.
+        """
+        batch = []
+        for entry in self._pending:
+            if (entry.next_try <= now or entry.attempts == 0) and self.batch_key(entry.record) == key:
+                batch.append(entry)
+                if len(batch) >= self.batch_size:
+                    break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            key, entries = batch
+            start = self.clock()
+            failed = self._deliver(key, entries)
+            self._update_stats(key, entries, failed, start)
+            for entry in entries:
+                if entry in failed:
+                    self._failed(entry)
+                else:
+                    self._done(entry)
+
+    def _deliver(self, key, entries):
+        """
+        Deliver entries, return the list of those that failed.
+        """
+        if self.deliver_batch is None:
+            failed = []
+            for entry in entries:
+                try:
+                    self.deliver(entry.record)
+                except Exception:
+                    outbox_logger.warning("delivery of %r failed", entry.record, exc_info=True)
+                    failed.append(entry)
+            return failed
+        try:
+            failed_records = self.deliver_batch(key, [entry.record for entry in entries])
+        except Exception:
+            outbox_logger.warning("delivery of %d records for %r failed", len(entries), key, exc_info=True)
+            return list(entries)
+        failed_ids = set(id(record) for record in failed_records)
+        return [entry for entry in entries if id(entry.record) in failed_ids]
+
+    def _update_stats(self, key, entries, failed, start):
+        now = self.clock()
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = BatchStats()
+        stats.batches += 1
+        stats.records += len(entries)
+        stats.failed += len(failed)
+        stats.max_batch = max(stats.max_batch, len(entries))
+        stats.flush_total += now - start
+        stats.flush_max = max(stats.flush_max, now - start)
+        for entry in entries:
+            waited = start - entry.queued_at
+            stats.wait_total += waited
+            stats.wait_max = max(stats.wait_max, waited)
+        outbox_logger.info("delivered %d of %d records for %r in %.3f seconds",
+                           len(entries) - len(failed), len(entries), key, now - start)
+
+    def _failed(self, entry):
+        with self._cond:
+            self.failures += 1
+            entry.attempts += 1
+            delay = min(self.base_delay * 2 ** (entry.attempts - 1), self.max_delay)
+            entry.next_try = self.clock() + delay
+        outbox_logger.warning("delivery of %r failed (%d attempts), retrying in %s seconds",
+                              entry.record, entry.attempts, delay)
+
+    def _done(self, entry):
+        with self._cond:
+            self.delivered += 1
+            self._pending.remove(entry)
+            self._write({'id': entry.id})
+            self._done_in_log += 1
+            if self._done_in_log >= self.compact_after:
+                self._compact()
+
+    def _compact(self):
+        """
+        Rewrite the log with the pending records only.
+        """
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            for entry in self._pending:
+                f.write(json.dumps({'id': entry.id, 'record': entry.record}, sort_keys=True).encode('utf-8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, 'ab')
+        self._done_in_log = 0
+
+    def flush(self, timeout=None):
+        """
+        Wait until all records are delivered. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while self._pending:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
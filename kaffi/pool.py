@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import logging
+import threading
+import sys
+try:
+    # python3
+    import queue
+except ImportError:
+    # python2
+    import Queue as queue
+
+pool_logger = logging.getLogger("pool")
+
+class TimeoutError(Exception):
+    pass
+
+class Result(object):
+    """
+    Outcome of a job submitted to a WorkerPool.
+
+    :attribute value: return value of the job, once it is done
+    :attribute exc_info: sys.exc_info() of the exception raised by the job,
+        if any
+    """
+
+    def __init__(self):
+        self.value = self.exc_info = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the job is done. Returns False if it did not finish within
+        timeout seconds.
+        """
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        Return the value of the job, raising its exception if it failed or
+        TimeoutError if it is not done within timeout seconds.
+        """
+        if not self._event.wait(timeout):
+            raise TimeoutError("job not done within %s seconds" % timeout)
+        if self.exc_info:
+            raise self.exc_info[1]
+        return self.value
+
+    def add_done_callback(self, fn):
+        """
+        Call fn(result) once the job is done. If it already is, fn is called
+        immediately on the calling thread, otherwise on the worker thread.
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def set(self, value=None, exc_info=None):
+        with self._lock:
+            self.value, self.exc_info = value, exc_info
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pool_logger.error("caught exception in done callback", exc_info=True)
+
+class WorkerPool(object):
+    """
+    A small fixed set of daemon threads running jobs for blocking work
+    (network lookups, database writes) that must not run on the caller's
+    thread. Threads are started on first use.
+    """
+
+    def __init__(self, size=2, name="worker"):
+        self.size = size
+        self.name = name
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.size:
+                thread = threading.Thread(target=self._work,
+                        name="%s-%d" % (self.name, len(self._threads)))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            result, fn, args, kwargs = job
+            try:
+                value = fn(*args, **kwargs)
+            except Exception:
+                result.set(exc_info=sys.exc_info())
+            else:
+                result.set(value)
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) on a worker thread, return a Result.
+        """
+        if len(self._threads) < self.size:
+            self._start()
+        result = Result()
+        self._queue.put((result, fn, args, kwargs))
+        return result
+
+    def stop(self):
+        """
+        Let the worker threads exit once the queued jobs are done.
+        """
+        with self._lock:
+            for thread in self._threads:
+                self._queue.put(None)
+            self._threads = []
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import collections
+import errno
+import fcntl
+import logging
+import os
+import select
+import threading
+import time
+
+from . import pool, timers
+
+reactor_logger = logging.getLogger("reactor")
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def register(self, fd):
+        self._epoll.register(fd, select.EPOLLIN)
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        return [fd for fd, event in self._epoll.poll(-1 if timeout is None else timeout)]
+
+class _PollPoller(object):
+
+    def __init__(self):
+        self._poll = select.poll()
+
+    def register(self, fd):
+        self._poll.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        return [fd for fd, event in self._poll.poll(None if timeout is None else timeout * 1000)]
+
+class Reactor(object):
+    """
+    Single threaded event loop for the serial lines and periodic jobs.
+
+    File descriptors registered with add_reader() and timers scheduled with
+    call_later() are all handled on the thread running run(). Blocking work
+    (network requests, subprocesses) is handed to a small WorkerPool with
+    run_in_executor(); its completion callback is run on the loop thread
+    again.
+    """
+
+    def __init__(self, workers=2):
+        self._poller = _EpollPoller() if hasattr(select, 'epoll') else _PollPoller()
+        self._readers = {}
+        self._timers = timers.TimerQueue()
+        self._ready = collections.deque()
+        self.pool = pool.WorkerPool(workers, name="reactor-worker")
+        self.running = False
+        self.thread = None
+
+        # self-pipe, written to by call_soon_threadsafe to wake up poll()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        for fd in (self._wakeup_r, self._wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self._wakeup_r, self._drain_wakeup)
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self._wakeup_r, 512):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def add_reader(self, fd, callback, *args):
+        """
+        Call callback(*args) on the loop thread whenever fd is readable.
+        """
+        if fd not in self._readers:
+            self._poller.register(fd)
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._poller.unregister(fd)
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) on the loop thread after delay seconds. Must be
+        called on the loop thread. Returns a timers.Timer.
+        """
+        return self._timers.call_later(delay, callback, *args)
+
+    def call_soon_threadsafe(self, callback, *args):
+        """
+        Call callback(*args) on the loop thread as soon as possible. May be
+        called from any thread.
+        """
+        self._ready.append((callback, args))
+        try:
+            os.write(self._wakeup_w, b'\0')
+        except OSError as e:
+            # pipe full, the loop is going to wake up anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def run_in_executor(self, fn, args=(), callback=None):
+        """
+        Run fn(*args) in the worker pool. If given, callback(result) is called
+        on the loop thread with the pool.Result once fn is done.
+        """
+        result = self.pool.submit(fn, *args)
+        if callback is not None:
+            result.add_done_callback(lambda result: self.call_soon_threadsafe(callback, result))
+        return result
+
+    def _run_callback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception:
+            reactor_logger.error("caught exception in callback %r", callback, exc_info=True)
+
+    def _next_timeout(self):
+        if self._ready:
+            return 0
+        deadline = self._timers.next_deadline()
+        if deadline is None:
+            return None
+        return max(0, deadline - time.time())
+
+    def run_once(self):
+        try:
+            fds = self._poller.poll(self._next_timeout())
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            fds = []
+
+        for fd in fds:
+            reader = self._readers.get(fd)
+            if reader is not None:
+                self._run_callback(*reader)
+
+        for timer in self._timers.pop_due():
+            self._run_callback(timer.callback, timer.args)
+
+        for i in range(len(self._ready)):
+            self._run_callback(*self._ready.popleft())
+
+    def run(self):
+        """
+        Run the event loop until stop() is called.
+        """
+        self.running = True
+        self.thread = threading.current_thread()
+        try:
+            while self.running:
+                self.run_once()
+        except Exception:
+            reactor_logger.critical("uncaught exception", exc_info=True)
+            self.running = False
+            raise
+
+    def stop(self):
+        """
+        Stop the event loop. May be called from any thread.
+        """
+        def _stop():
+            self.running = False
+        self.call_soon_threadsafe(_stop)
+        self.pool.stop()
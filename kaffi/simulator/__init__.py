@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Simulated vending machine controller and legi reader for load tests.
+
+Both simulators sit on the master side of a pseudo-terminal. The slave side
+is a regular tty, so SerialStream and LegiListener can be pointed at it
+unchanged (see the [serial] mdb_port and legi_port config options). Run
+``python -m kaffi.simulator --help`` for the command line interface.
+"""
+from __future__ import absolute_import
+
+import os
+import pty
+import tty
+
+from .stats import LatencyStats
+from .vmc import VmcSimulator
+from .legireader import LegiSimulator
+
+__all__ = ['open_pty', 'LatencyStats', 'VmcSimulator', 'LegiSimulator']
+
+def open_pty():
+    """
+    Open a pseudo-terminal in raw mode. Returns (master_fd, slave_fd,
+    slave_path). The slave fd is kept open by the caller so the master does
+    not see EIO before the system under test has opened the slave.
+    """
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    return master, slave, os.ttyname(slave)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Soak test the kaffi system against a simulated vending machine and legi
+reader.
+
+Without --system the pty paths are printed and the simulators wait for a
+separately started kaffi whose [serial] mdb_port and legi_port options point
+at them.
+"""
+from __future__ import absolute_import
+
+import argparse
+import logging
+import os
+import sys
+import time
+
+from . import open_pty, VmcSimulator, LegiSimulator
+
+def _start_system(mdb_port, legi_port, offline, runtime, multi_vend):
+    from .. import system, status, ampelstatus, usb_ampel
+    try:
+        config = system.get_config()
+    except ValueError:
+        try:
+            # python3
+            import configparser
+        except ImportError:
+            # python2
+            import ConfigParser as configparser
+        config = system.config = configparser.RawConfigParser()
+    if not config.has_section('serial'):
+        config.add_section('serial')
+    config.set('serial', 'mdb_port', mdb_port)
+    config.set('serial', 'legi_port', legi_port)
+    if runtime:
+        if not config.has_section('system'):
+            config.add_section('system')
+        config.set('system', 'runtime', runtime)
+    if multi_vend:
+        if not config.has_section('mdb'):
+            config.add_section('mdb')
+        config.set('mdb', 'multi_vend', 'true')
+
+    if offline:
+        # authorize every swipe without talking to any backend
+        status.check_legi = lambda leginr: 'VIS'
+        status.report_dispense = lambda rfidnr, org, item: None
+        ampelstatus.get_status = lambda: True
+        usb_ampel.update = lambda old_status: None
+        usb_ampel.switch = lambda status, old_status: None
+
+    legi_enable = None
+    if not config.has_option('legi', 'enable'):
+        legi_enable = b'\0'
+    s = system.System(legi_enable)
+    s.start()
+    return s
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--duration', type=float, default=60, help="seconds to run")
+    parser.add_argument('--poll-interval', type=float, default=0.1, help="seconds between VMC polls")
+    parser.add_argument('--swipe-rate', type=float, default=6, help="legi swipes per minute")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="probability of a vend failure")
+    parser.add_argument('--nak-rate', type=float, default=0.0, help="probability of a NAK instead of a poll")
+    parser.add_argument('--multi-vend', action='store_true', help="request further vends within a session"
+                        " (and enable multi-vend in the system with --system)")
+    parser.add_argument('--legi', action='append', default=[], help="legi number (6 hex digits) to swipe")
+    parser.add_argument('--system', action='store_true', help="run the kaffi system in this process")
+    parser.add_argument('--offline', action='store_true', help="with --system, authorize every legi locally")
+    parser.add_argument('--runtime', choices=['threads', 'reactor'], help="with --system, override [system] runtime")
+    opts = parser.parse_args(args)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    vmc_master, vmc_slave, vmc_path = open_pty()
+    legi_master, legi_slave, legi_path = open_pty()
+    print("mdb_port = %s" % vmc_path)
+    print("legi_port = %s" % legi_path)
+
+    vmc = VmcSimulator(vmc_master, poll_interval=opts.poll_interval,
+                       failure_rate=opts.failure_rate, nak_rate=opts.nak_rate,
+                       multi_vend=opts.multi_vend)
+    # many different users by default, repeated swipes are debounced
+    legis = opts.legi or ['%06d' % (46631 + i) for i in range(100)]
+    reader = LegiSimulator(legi_master, legis, opts.swipe_rate)
+
+    system = None
+    if opts.system:
+        system = _start_system(vmc_path, legi_path, opts.offline, opts.runtime, opts.multi_vend)
+
+    start = time.time()
+    threads = [vmc.start(opts.duration), reader.start(opts.duration)]
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+    elapsed = time.time() - start
+
+    summary = vmc.latency.summary()
+    print("frames: %(count)d, timeouts: %(timeouts)d" % summary)
+    if summary['count']:
+        print("latency ms: p50 %.2f  p90 %.2f  p99 %.2f  max %.2f" % tuple(
+            1000 * summary[k] for k in ('p50', 'p90', 'p99', 'max')))
+    print("swipes: %d, dispensed: %d, failed: %d, denied: %d, naks: %d" % (
+        reader.swipes, vmc.dispensed, vmc.failed, vmc.denied, vmc.naks))
+    print("dispenses per minute: %.2f" % (vmc.dispensed * 60.0 / elapsed))
+
+    if system is not None:
+        debouncer = system.main.debouncer
+        print("debounced swipes: %d, dropped in flight: %d" % (
+            debouncer.debounced, debouncer.in_flight_dropped))
+        swipes = system.main.swipes
+        print("swipe queue: dropped %d, expired %d, wait ms: avg %.2f  max %.2f" % (
+            swipes.dropped, swipes.expired,
+            1000 * swipes.wait_total / max(swipes.wait_count, 1), 1000 * swipes.wait_max))
+        # the system's threads are not daemonic and it has no clean shutdown
+        sys.stdout.flush()
+        os._exit(0)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
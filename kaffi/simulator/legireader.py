@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import binascii
+import logging
+import os
+import random
+import select
+import threading
+import time
+
+tohex = binascii.hexlify
+fromhex = binascii.unhexlify
+
+legi_logger = logging.getLogger("simulator.legi")
+
+class LegiSimulator(object):
+    """
+    Legi reader on the master side of a pty. Emits 14 byte frames starting
+    with 0d80 (the format LegiListener expects) at a configurable rate and
+    discards the enable commands written back by the listener.
+
+    :param fd: master fd of the pty
+    :param legis: legi numbers to swipe, as 6 digit hex strings (e.g.
+        '046631'); chosen at random for every swipe
+    :param swipes_per_minute: average swipe rate, swipes are spaced
+        exponentially
+    """
+
+    HEADER = fromhex('0d80')
+
+    def __init__(self, fd, legis, swipes_per_minute=6.0, seed=None):
+        self.fd = fd
+        self.legis = list(legis)
+        self.swipes_per_minute = swipes_per_minute
+        self.random = random.Random(seed)
+        self.swipes = 0
+        self.running = False
+
+    def frame(self, legi):
+        return self.HEADER + b'\0' * 8 + fromhex(legi) + b'\0'
+
+    def swipe(self, legi=None):
+        legi = legi or self.random.choice(self.legis)
+        legi_logger.debug("swiping %s", legi)
+        os.write(self.fd, self.frame(legi))
+        self.swipes += 1
+
+    def _drain(self, timeout):
+        if select.select([self.fd], [], [], max(0, timeout))[0]:
+            os.read(self.fd, 1024)
+            return True
+        return False
+
+    def run(self, duration=None):
+        self.running = True
+        end = None if duration is None else time.time() + duration
+        next_swipe = time.time() + self.random.expovariate(self.swipes_per_minute / 60.0)
+        while self.running and (end is None or time.time() < end):
+            now = time.time()
+            if now >= next_swipe:
+                self.swipe()
+                next_swipe = now + self.random.expovariate(self.swipes_per_minute / 60.0)
+            self._drain(min(next_swipe - now, 0.5))
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def start(self, duration=None):
+        thread = threading.Thread(target=self.run, args=(duration,))
+        thread.daemon = True
+        thread.start()
+        return thread
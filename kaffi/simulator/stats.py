@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import threading
+
+class LatencyStats(object):
+    """
+    Collects response latencies (in seconds) and reports percentiles.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = []
+        self.timeouts = 0
+
+    def record(self, latency):
+        with self._lock:
+            self.samples.append(latency)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def percentile(self, p):
+        with self._lock:
+            samples = sorted(self.samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+        return samples[index]
+
+    def summary(self):
+        return dict(count=len(self.samples), timeouts=self.timeouts,
+                    p50=self.percentile(50), p90=self.percentile(90),
+                    p99=self.percentile(99), max=self.percentile(100))
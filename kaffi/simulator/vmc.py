@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import binascii
+import logging
+import os
+import random
+import select
+import threading
+import time
+
+from ..translator import TranslatorStm
+from ..mdb import MdbL1Stm
+from .stats import LatencyStats
+
+tohex = binascii.hexlify
+fromhex = binascii.unhexlify
+
+vmc_logger = logging.getLogger("simulator.vmc")
+
+T = TranslatorStm
+M = MdbL1Stm
+
+class VmcSimulator(object):
+    """
+    Vending machine controller talking to the cashless device (kaffi) over
+    the master side of a pty, using the TranslatorStm framing.
+
+    Runs the MDB setup sequence, enables the reader and then polls. A
+    BEGIN_SESSION reply is answered with a vend request, an approved vend
+    with a vend success (or failure, see failure_rate) and a session cancel
+    request with a session complete. Every request frame's response latency
+    is recorded in self.latency.
+
+    :param fd: master fd of the pty
+    :param poll_interval: seconds between two polls
+    :param failure_rate: probability of reporting a vend failure instead of
+        a vend success
+    :param nak_rate: probability of sending a NAK instead of a poll
+    :param item: item number sent with vend requests
+    :param multi_vend: after a vend, request the next one in the same
+        session until one is denied
+    :param response_timeout: seconds to wait for a response frame
+    """
+
+    # VMC setup config data: feature level 1, 2x16 display, full ASCII
+    VMC_CONF_DATA = fromhex('01100201')
+    VMC_MAXMIN_DATA = fromhex('FFFF0000')
+    VMC_REQUEST_ID_DATA = fromhex('414258') + b' ' * 12 + b' ' * 12 + fromhex('0100')
+    VEND_PRICE = fromhex('0001')
+
+    def __init__(self, fd, poll_interval=0.1, failure_rate=0.0, nak_rate=0.0,
+                 item=1, response_timeout=1.0, seed=None, multi_vend=False):
+        self.fd = fd
+        self.poll_interval = poll_interval
+        self.failure_rate = failure_rate
+        self.nak_rate = nak_rate
+        self.item = fromhex('%04x' % item)
+        self.response_timeout = response_timeout
+        self.multi_vend = multi_vend
+        self.random = random.Random(seed)
+        self.latency = LatencyStats()
+        self.dispensed = self.failed = self.denied = self.naks = 0
+        self.running = False
+        self._buf = b""
+
+    def _write_frame(self, payload):
+        data = M.ACK + payload
+        os.write(self.fd, T.STX + data.replace(T.DLE, T.DLE + T.DLE) + T.DLE + T.ETX)
+
+    def _read(self, deadline):
+        timeout = deadline - time.time()
+        if timeout <= 0 or not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        self._buf += os.read(self.fd, 1024)
+        return True
+
+    def _read_frame(self, deadline):
+        """
+        Read the ACK and response frame sent by the cashless device, return
+        the unescaped payload or None on timeout.
+        """
+        while True:
+            start = self._buf.find(T.STX)
+            if start >= 0:
+                end = start + 1
+                payload = []
+                while True:
+                    idx = self._buf.find(T.DLE, end)
+                    if idx < 0 or idx + 1 >= len(self._buf):
+                        break
+                    payload.append(self._buf[end:idx])
+                    if self._buf[idx+1:idx+2] == T.ETX:
+                        self._buf = self._buf[idx+2:]
+                        return b''.join(payload)
+                    payload.append(self._buf[idx+1:idx+2])
+                    end = idx + 2
+            if not self._read(deadline):
+                return None
+
+    def transact(self, command):
+        """
+        Send a command frame and wait for the response. Returns the response
+        payload without the leading MDB ACK, or None on timeout.
+        """
+        self._buf = b""
+        sent = time.time()
+        self._write_frame(command)
+        response = self._read_frame(sent + self.response_timeout)
+        if response is None:
+            vmc_logger.warning("no response to %s", tohex(command))
+            self.latency.record_timeout()
+            return None
+        self.latency.record(time.time() - sent)
+        if response[:1] == M.ACK:
+            response = response[1:]
+        return response
+
+    def send_nak(self):
+        self.naks += 1
+        os.write(self.fd, T.NAK)
+
+    def setup(self):
+        """
+        Run the reset/setup/enable sequence.
+        """
+        self.transact(M.CMD_RESET)
+        self.transact(M.CMD_POLL)
+        self.transact(M.CMD_SETUP_CONF_DATA + self.VMC_CONF_DATA)
+        self.transact(M.CMD_SETUP_MAXMIN_PRICE + self.VMC_MAXMIN_DATA)
+        self.transact(M.CMD_EXP_REQUEST_ID + self.VMC_REQUEST_ID_DATA)
+        self.transact(M.CMD_READER_ENABLE)
+
+    def _handle_response(self, response):
+        """
+        React to a poll response like a vending machine would. Returns False
+        if the device needs to be set up again.
+        """
+        code = response[:1]
+        if response.startswith(M.RES_RESET):
+            return False
+
+        elif code == M.RES_BEGIN_SESS:
+            return self._session()
+
+        elif code == M.RES_SESS_CANCEL_REQ:
+            self.transact(M.CMD_VEND_SESS_COMPLETE)
+
+        elif code == M.RES_MALFUNCTION:
+            self.transact(M.CMD_RESET)
+            return False
+
+        return True
+
+    def _session(self):
+        """
+        Run the vends of a session. The user preselected an item, so the
+        vend is requested right away. In multi-vend mode the next vend is
+        requested in the same session; if it is denied (nobody else is
+        authorized) the session is completed.
+        """
+        follow_up = False
+        while True:
+            response = self.transact(M.CMD_VEND_REQUEST + self.VEND_PRICE + self.item)
+            if response is None:
+                return True
+            if response[:1] != M.RES_VEND_APPROVED:
+                if follow_up and response[:1] == M.RES_VEND_DENIED:
+                    self.transact(M.CMD_VEND_SESS_COMPLETE)
+                    return True
+                self.denied += 1
+                return self._handle_response(response)
+            if self.random.random() < self.failure_rate:
+                self.failed += 1
+                self.transact(M.CMD_VEND_FAILURE)
+            else:
+                self.dispensed += 1
+                self.transact(M.CMD_VEND_SUCCESS + self.item)
+            if not self.multi_vend:
+                return True
+            follow_up = True
+
+    def run(self, duration=None):
+        """
+        Set up the device and poll it until stop() is called or duration
+        seconds have passed.
+        """
+        self.running = True
+        end = None if duration is None else time.time() + duration
+        needs_setup = True
+        while self.running and (end is None or time.time() < end):
+            if needs_setup:
+                self.setup()
+                needs_setup = False
+            if self.nak_rate and self.random.random() < self.nak_rate:
+                # the device resets on NAK, so the setup must be redone
+                self.send_nak()
+                needs_setup = True
+            else:
+                response = self.transact(M.CMD_POLL)
+                if response:
+                    needs_setup = not self._handle_response(response)
+            time.sleep(self.poll_interval)
+        self.running = False
+
+    def stop(self):
+        self.running = False
+
+    def start(self, duration=None):
+        thread = threading.Thread(target=self.run, args=(duration,))
+        thread.daemon = True
+        thread.start()
+        return thread
@@ -2,7 +2,16 @@
 from __future__ import absolute_import
 
 from sqlalchemy import sql, schema, create_engine, exc
+import collections
+import json
 import logging
+import os
+import random
+import struct
+import threading
+import time
+
+from . import pool, timers
 
 metadata = schema.MetaData()
 log_dbengine = None
@@ -11,6 +20,10 @@ config = None
 
 fail_logger = logging.getLogger("fail")
 reconnect_timer = None
+# seconds until the next connection attempt, doubled after every failure
+retry_delay = None
+# connecting blocks, so the reconnect timer only hands it to this thread
+_connector = pool.WorkerPool(1, name="sqlconnect")
 
 def init():
     global config
@@ -27,8 +40,13 @@ def init():
 
     try_connect()
 
-def try_connect(retry_interval=300):
-    global log_dbengine, coffeelog_tbl, reconnect_timer
+def try_connect(retry_interval=300, min_retry_interval=5):
+    """
+    Connect to the sql log. On failure try again later, with exponential
+    backoff from min_retry_interval up to retry_interval seconds, with
+    jitter. Rows spooled in the meantime are replayed once connected.
+    """
+    global log_dbengine, coffeelog_tbl, reconnect_timer, retry_delay
     if reconnect_timer:
         reconnect_timer.cancel()
 
@@ -40,21 +58,327 @@ def try_connect(retry_interval=300):
     except exc.OperationalError:
         fail_logger.error("Failed to connect to sql log", exc_info=True)
         logging.critical("Failed to connect to sql log")
-        import threading
-        reconnect_timer = threading.Timer(retry_interval, try_connect)
-        reconnect_timer.start()
+        retry_delay = min(retry_delay * 2 if retry_delay else min_retry_interval, retry_interval)
+        # between half and all of the delay
+        delay = retry_delay / 2.0 + random.uniform(0, retry_delay / 2.0)
+        reconnect_timer = timers.call_later(delay, _connector.submit, try_connect,
+                                            retry_interval, min_retry_interval)
+    else:
+        retry_delay = None
+        get_writer().replay_soon()
 
 def stop_retrying():
     if reconnect_timer:
         reconnect_timer.cancel()
 
-def log_msg(msg_type, msg):
-    try:
-        ins = coffeelog_tbl.insert().values(type=msg_type, msg=msg)
-        log_dbengine.execute(ins)
-    except Exception:
+def write_rows(rows):
+    """
+    Insert a list of (type, msg) rows with a single multi-row insert.
+    """
+    if log_dbengine is None or coffeelog_tbl is None:
+        raise IOError("not connected to the sql log")
+    log_dbengine.execute(coffeelog_tbl.insert(), [dict(type=t, msg=m) for t, m in rows])
+
+def spill_rows(rows):
+    for msg_type, msg in rows:
         fail_logger.error("failed to log msg %r: %r", msg_type, msg)
 
+class Spool(object):
+    """
+    Append-only file of log rows that could not be written. Every row is
+    a 4 byte big endian length followed by the row as JSON.
+
+    append() only writes to the file, sync() makes the appended rows
+    durable, so one fsync covers many rows. For the replay the file is
+    moved aside (path + '.replay'), so rows can be appended while it runs;
+    the moved file is deleted once all its rows are written.
+    """
+
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, path):
+        self.path = path
+        self.replay_path = path + '.replay'
+        self.spooled = self.replayed = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._replay_offset = 0
+        self._file = self._open()
+
+    def _open(self):
+        f = open(self.path, 'ab')
+        # tell() of a file opened for appending is not at the end everywhere
+        f.seek(0, os.SEEK_END)
+        return f
+
+    def append(self, rows):
+        with self._lock:
+            for row in rows:
+                data = json.dumps(list(row)).encode('utf-8')
+                self._file.write(self.HEADER.pack(len(data)) + data)
+            self._file.flush()
+            self._dirty = True
+            self.spooled += len(rows)
+
+    def sync(self):
+        with self._lock:
+            if self._dirty:
+                os.fsync(self._file.fileno())
+                self._dirty = False
+
+    def pending(self):
+        """
+        Return True if there are rows to replay.
+        """
+        with self._lock:
+            return self._file.tell() > 0 or os.path.exists(self.replay_path)
+
+    def _read(self, path, offset):
+        """
+        Yield (row, offset after the row) of the rows in path after offset.
+        A row cut off by a crash ends the file.
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self.HEADER.size)
+                if len(header) < self.HEADER.size:
+                    return
+                size, = self.HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    return
+                offset += self.HEADER.size + size
+                yield tuple(json.loads(data.decode('utf-8'))), offset
+
+    def replay(self, write, batch_size=500, max_batches=None):
+        """
+        Write the spooled rows with write(rows), batch_size at a time and at
+        most max_batches batches per call. Returns True once all rows are
+        written. If a write fails the exception is raised; the next replay
+        continues after the last written batch.
+        """
+        with self._lock:
+            if not os.path.exists(self.replay_path):
+                if self._file.tell() == 0:
+                    return True
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._file.close()
+                os.rename(self.path, self.replay_path)
+                self._file = self._open()
+                self._dirty = False
+                self._replay_offset = 0
+
+        batch = []
+        batches = 0
+        for row, offset in self._read(self.replay_path, self._replay_offset):
+            if max_batches is not None and batches >= max_batches:
+                return False
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write(batch)
+                self.replayed += len(batch)
+                self._replay_offset = offset
+                batch = []
+                batches += 1
+        if batch:
+            write(batch)
+            self.replayed += len(batch)
+        os.remove(self.replay_path)
+        self._replay_offset = 0
+        return True
+
+class LogWriter(object):
+    """
+    Bounded queue of log rows, written by a single thread in batches of up
+    to batch_size rows, at the latest flush_interval seconds after the
+    first row of a batch was queued. put() never blocks.
+
+    If the queue is full, overflow decides what happens to the oldest row:
+    'drop_oldest' drops it (counted in dropped), 'spill' hands it to spill
+    right away. Rows of failed writes are always spilled.
+
+    With a spool, rows are spilled to it instead, and replayed by the
+    writer thread after the next successful write or replay_soon(), one
+    batch of replay_batch_size rows between two batches of new rows. While
+    rows wait for their replay, rows overflowing the queue are spooled as
+    well, whatever overflow says.
+    """
+
+    def __init__(self, write=write_rows, spill=spill_rows, max_queue=1000, batch_size=50,
+                 flush_interval=1.0, overflow='drop_oldest', spool=None, replay_batch_size=500):
+        if overflow not in ('drop_oldest', 'spill'):
+            raise ValueError("unknown overflow policy %r" % overflow)
+        self.write = write
+        self.spill = spill
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spool = spool
+        self.replay_batch_size = replay_batch_size
+        if spool is not None:
+            self.spill = spool.append
+        self.written = self.batches = self.dropped = self.spilled = 0
+        self._replay = False
+        self._rows = collections.deque()
+        self._first_queued = None
+        self._cond = threading.Condition()
+        self._thread = None
+        self._writing = False
+
+    def put(self, msg_type, msg):
+        overflowed = None
+        with self._cond:
+            if len(self._rows) >= self.max_queue:
+                overflowed = self._rows.popleft()
+            if not self._rows:
+                self._first_queued = time.time()
+            self._rows.append((msg_type, msg))
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify()
+        if self._thread is None:
+            self.start()
+        if overflowed is not None:
+            if self.overflow == 'spill' or (self.spool is not None and self.spool.pending()):
+                self._spill([overflowed])
+            else:
+                self.dropped += 1
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="sqllog")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _spill(self, rows):
+        self.spilled += len(rows)
+        try:
+            self.spill(rows)
+        except Exception:
+            logging.getLogger("sqllogging").error("could not spill %d log rows", len(rows), exc_info=True)
+
+    def replay_soon(self):
+        """
+        Replay the spool (e.g. after reconnecting) without waiting for a row.
+        """
+        with self._cond:
+            self._replay = True
+            self._cond.notify()
+        if self._thread is None:
+            self.start()
+
+    def _next_batch(self):
+        """
+        Wait for the next batch of rows; an empty batch if a replay was
+        requested.
+        """
+        with self._cond:
+            while not self._replay:
+                if self._rows:
+                    remaining = self._first_queued + self.flush_interval - time.time()
+                    if len(self._rows) >= self.batch_size or remaining <= 0:
+                        break
+                else:
+                    remaining = None
+                self._cond.wait(remaining)
+            count = min(len(self._rows), self.batch_size)
+            batch = [self._rows.popleft() for i in range(count)]
+            self._first_queued = time.time() if self._rows else None
+            self._writing = True
+            self._replay = False
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                if batch:
+                    try:
+                        self.write(batch)
+                    except Exception:
+                        fail_logger.error("failed to write %d log rows", len(batch), exc_info=True)
+                        self._spill(batch)
+                        continue
+                    self.written += len(batch)
+                    self.batches += 1
+                if self.spool is not None and self.spool.pending():
+                    # the database is back. Replay a batch, then let the new
+                    # rows have their turn.
+                    try:
+                        if self.spool.replay(self.write, self.replay_batch_size, 1):
+                            fail_logger.info("replayed the spooled log rows, %d in total",
+                                             self.spool.replayed)
+                        else:
+                            with self._cond:
+                                self._replay = True
+                    except Exception:
+                        fail_logger.error("failed to replay spooled log rows", exc_info=True)
+            finally:
+                if self.spool is not None:
+                    try:
+                        self.spool.sync()
+                    except Exception:
+                        fail_logger.error("failed to sync the log spool", exc_info=True)
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Write the queued rows now and wait until they are written. Returns
+        False on timeout.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            if self._rows:
+                self._first_queued = 0
+                self._cond.notify_all()
+            while self._rows or self._writing:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """
+    Return the LogWriter of log_msg, configured from the [log] config
+    section.
+    """
+    global writer
+    if writer is None:
+        with _writer_lock:
+            if writer is None:
+                from .system import get_option
+                def option(name, default):
+                    try:
+                        return get_option('log', name, default)
+                    except ValueError:
+                        # no config file
+                        return default
+                spool_path = option('spool', 'sqllog.spool')
+                if spool_path:
+                    from .system import resolve_path
+                    spool_path = resolve_path(spool_path)
+                writer = LogWriter(max_queue=option('queue_size', 1000),
+                                   batch_size=option('batch_size', 50),
+                                   flush_interval=option('flush_interval', 1.0),
+                                   overflow=option('overflow', 'drop_oldest'),
+                                   spool=Spool(spool_path) if spool_path else None)
+    return writer
+
+def log_msg(msg_type, msg):
+    """
+    Queue a row for the sql log. Never blocks, see LogWriter.
+    """
+    get_writer().put(msg_type, msg)
+
 class SqlLogHandler(logging.Handler):
 
     def __init__(self, level=logging.NOTSET):
@@ -1,7 +1,13 @@
 import ordereddict
 import logging
+import threading
+import time
 
 from . import (
+    authcache,
+    authstore,
+    outbox,
+    pool,
     visstatus,
     amivstatus,
     vmpstatus,
@@ -15,22 +21,440 @@ org_handlers = ordereddict.OrderedDict([
 
 status_logger = logging.getLogger("status")
 
-def check_legi(leginr):
-    for org, handlers in org_handlers.items():
+# runs the get_status handlers of check_legi in parallel mode. Lookups
+# abandoned by check_legi keep their worker until they return, hence the
+# spare threads.
+_lookups = pool.WorkerPool(2 * len(org_handlers), name="status")
+
+_FAILED = object()
+
+def _option(option, default):
+    from .system import get_option
+    try:
+        return get_option('status', option, default)
+    except ValueError:
+        # no config file
+        return default
+
+class CircuitBreaker(object):
+    """
+    Stops asking a backend that keeps failing. After failures consecutive
+    failures (errors or timeouts) the breaker opens and allow() returns
+    False for cooldown seconds. Then a single trial request is allowed: if
+    it succeeds the breaker closes, otherwise it stays open for another
+    cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, name, failures=3, cooldown=30.0, clock=time.time):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = self.CLOSED
+        self.skipped = 0
+        self._failed = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.cooldown:
+                status_logger.info("probing %s again", self.name)
+                self.state = self.HALF_OPEN
+                return True
+            self.skipped += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                status_logger.info("%s is back, closing breaker", self.name)
+            self.state = self.CLOSED
+            self._failed = 0
+
+    def failure(self):
+        with self._lock:
+            self._failed += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failed >= self.failures):
+                status_logger.warning("%s failed %d times, skipping it for %s seconds",
+                                      self.name, self._failed, self.cooldown)
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(org):
+    with _breakers_lock:
+        breaker = breakers.get(org)
+        if breaker is None:
+            breaker = breakers[org] = CircuitBreaker(org, _option('breaker_failures', 3),
+                                                     _option('breaker_cooldown', 30.0))
+        return breaker
+
+def _get_status(org, get_status, leginr, timeout):
+    breaker = get_breaker(org)
+    if timeout <= 0 or not breaker.allow():
+        return _FAILED
+    try:
+        status = get_status(leginr, timeout=timeout)
+    except Exception:
+        status_logger.warning("caught exception in get_status for legi %s, org %s", leginr, org, exc_info=True)
+        breaker.failure()
+        return _FAILED
+    breaker.success()
+    return status
+
+class OrgRanking(object):
+    """
+    Learns in which order to ask the orgs. The org that last knew a legi
+    is asked first for it, the others are ordered by their recent share of
+    positive answers (decayed by decay per answer) and then by the order of
+    org_handlers.
+
+    An org that said no about a legi is not asked about it again for
+    negative_ttl seconds, as AuthCache keeps negative answers. So once the
+    orgs before the one that knows a legi have said no, a lookup needs a
+    single request, and the answer is still the first org in org_handlers
+    that knows the legi, see lookup_legi.
+
+    :param max_legis: number of legis whose answers are remembered
+    """
+
+    def __init__(self, decay=0.99, max_legis=10000, negative_ttl=60.0, clock=time.time):
+        self.decay = decay
+        self.max_legis = max_legis
+        self.negative_ttl = negative_ttl
+        self.clock = clock
+        self.hits = {}
+        # leginr -> (org that knew it or None, {org that said no: when})
+        self._legis = ordereddict.OrderedDict()
+        self._lock = threading.Lock()
+
+    def order(self, leginr, orgs):
+        """
+        Return the orgs (in their configured order) to ask, in the order to
+        ask them. Orgs that recently said no are left out.
+        """
+        now = self.clock()
+        with self._lock:
+            preferred, declined = self._legis.get(leginr, (None, {}))
+            hits = dict(self.hits)
+        position = dict((org, i) for i, org in enumerate(orgs))
+        ask = [org for org in orgs
+               if org not in declined or now - declined[org] >= self.negative_ttl]
+        return sorted(ask, key=lambda org: (org != preferred, -hits.get(org, 0), position[org]))
+
+    def record(self, leginr, org, declined=(), certain=True):
+        """
+        Record the answer for leginr: the org that knew it, or None, and
+        the orgs that said no. If the answer is None but not certain (an
+        org could not be asked), the org that knew leginr is kept.
+        """
+        now = self.clock()
+        with self._lock:
+            preferred, noes = self._legis.pop(leginr, (None, {}))
+            noes = dict((known, when) for known, when in noes.items()
+                        if now - when < self.negative_ttl)
+            for known in declined:
+                noes[known] = now
+            if org is None and not certain and preferred not in noes:
+                org = preferred
+            noes.pop(org, None)
+            if org is None and not noes:
+                return
+            self._legis[leginr] = (org, noes)
+            while len(self._legis) > self.max_legis:
+                self._legis.popitem(last=False)
+            if org is None or not certain:
+                return
+            for known in self.hits:
+                self.hits[known] *= self.decay
+            self.hits[org] = self.hits.get(org, 0) + 1
+
+ranking = OrgRanking()
+
+def lookup_legi(leginr, parallel=None, timeout=None):
+    """
+    Ask the orgs in org_handlers about leginr. Returns (org, certain): org
+    is the first org that knows leginr or None, certain is False if it is
+    None only because an org could not be asked.
+
+    All lookups have to be done within timeout seconds ([status] deadline,
+    3 by default); the time left is passed to the get_status handlers. Orgs
+    whose CircuitBreaker is open are not asked.
+
+    In parallel mode (the [status] parallel option, on by default) all orgs
+    are asked at once. The answer is returned as soon as every org before
+    the first positive one has answered, the remaining lookups are
+    abandoned.
+
+    In sequential mode with the [status] adaptive option (off by default)
+    the orgs are asked in the order learned by ranking, so the org likely
+    to know leginr gets its answer in before the deadline, and orgs that
+    recently said no about leginr are not asked again. Once an org knows
+    leginr, only the orgs before it in org_handlers are still asked.
+    """
+    if parallel is None:
+        parallel = _option('parallel', True)
+    if timeout is None:
+        timeout = _option('deadline', 3.0)
+    deadline = time.time() + timeout
+    orgs = list(org_handlers.keys())
+    if parallel:
+        results = [(org, _lookups.submit(_get_status, org, org_handlers[org][0], leginr, timeout))
+                   for org in orgs]
+        # _get_status never raises, a lookup that is not done by the
+        # deadline counts as failed
+        answers = ((org, result.value if result.wait(max(deadline - time.time(), 0)) else _FAILED)
+                   for org, result in results)
+        certain = True
+        for org, status in answers:
+            if status is _FAILED:
+                certain = False
+            elif status:
+                return org, True
+        return None, certain
+
+    adaptive = _option('adaptive', False)
+    probes = ranking.order(leginr, orgs) if adaptive else orgs
+    # position in orgs of the first org known to know leginr
+    found = None
+    certain = True
+    declined = []
+    for org in probes:
+        position = orgs.index(org)
+        if found is not None and position > found:
+            continue
+        status = _get_status(org, org_handlers[org][0], leginr, deadline - time.time())
+        if status is _FAILED:
+            certain = False
+        elif status:
+            found = position
+            if not adaptive:
+                break
+        else:
+            declined.append(org)
+    if adaptive:
+        ranking.record(leginr, None if found is None else orgs[found], declined,
+                       found is not None or certain)
+    if found is not None:
+        return orgs[found], True
+    return None, certain
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+# runs the backend lookups of lookup_with_snapshot, so it can stop waiting
+# for them
+_snapshot_lookups = pool.WorkerPool(2, name="snapshot")
+
+def get_snapshot():
+    """
+    Return the AuthStore at [status] snapshot_path, or None if no path is
+    configured.
+    """
+    global _snapshot
+    if _snapshot is None:
+        path = _option('snapshot_path', None)
+        if not path:
+            return None
+        with _snapshot_lock:
+            if _snapshot is None:
+                _snapshot = authstore.AuthStore(path, _option('snapshot_max_age', 30 * 24 * 3600.0))
+    return _snapshot
+
+def _verify(store, leginr, parallel):
+    org, certain = lookup_legi(leginr, parallel)
+    if certain:
+        store.record(leginr, org)
+    return org, certain
+
+def lookup_with_snapshot(leginr, parallel=None):
+    """
+    lookup_legi, recording the answers in the snapshot and answering from
+    it according to [status] snapshot_policy:
+
+    always: answer from the snapshot if it knows leginr and verify the
+        answer in the background
+    on_timeout: answer from the snapshot if the backends failed, or if it
+        knows leginr and they did not answer within [status]
+        snapshot_timeout seconds. Otherwise the lookup gets until its
+        deadline.
+    never: only record answers
+
+    Answers from the snapshot are not certain.
+    """
+    store = get_snapshot()
+    if store is None:
+        return lookup_legi(leginr, parallel)
+
+    policy = _option('snapshot_policy', 'on_timeout')
+    if policy == 'always':
+        org = store.get(leginr)
+        if org:
+            _snapshot_lookups.submit(_verify, store, leginr, parallel)
+            return org, False
+        return _verify(store, leginr, parallel)
+
+    elif policy == 'on_timeout':
+        start = time.time()
+        result = _snapshot_lookups.submit(_verify, store, leginr, parallel)
+        answered = result.wait(_option('snapshot_timeout', 2.0))
+        if not answered and not store.get(leginr):
+            # nothing to answer with early. The lookup returns by its
+            # deadline, give it a moment past that.
+            answered = result.wait(max(start + _option('deadline', 3.0) + 0.5 - time.time(), 0))
+        if answered:
+            org, certain = result.result()
+            if certain:
+                return org, certain
+        org = store.get(leginr)
+        if org:
+            status_logger.info("answering legi %s from the snapshot", leginr)
+            return org, False
+        return None, False
+
+    return _verify(store, leginr, parallel)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Return the AuthCache in front of lookup_with_snapshot, configured from the
+    [status] config section.
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = authcache.AuthCache(lookup_with_snapshot,
+                        ttl=_option('cache_ttl', 3600.0),
+                        negative_ttl=_option('cache_negative_ttl', 60.0),
+                        max_stale=_option('cache_max_stale', 86400.0),
+                        max_size=_option('cache_size', 1000))
+    return _cache
+
+def check_legi(leginr, parallel=None, use_cache=None):
+    """
+    Return the first org in org_handlers that knows leginr, or None.
+
+    Answers are cached unless the [status] cache option is off or use_cache
+    is False, see AuthCache.
+    """
+    if use_cache is None:
+        use_cache = _option('cache', True)
+    if use_cache:
+        return get_cache().get(leginr)
+    return lookup_with_snapshot(leginr, parallel)[0]
+
+# report a list of (rfidnr, item) at once, return the ones that failed; orgs
+# without one are billed dispense by dispense (over one pooled connection)
+org_batch_handlers = {
+    'AMIV': amivstatus.report_dispensed_batch,
+}
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+def get_outbox():
+    """
+    Return the Outbox of the dispenses to bill, at [status] outbox_path
+    (relative to the install directory, see system.resolve_path). Starts
+    delivering the dispenses left over from the last run.
+
+    Dispenses are delivered in batches per org of up to [status]
+    outbox_batch_size, waiting up to outbox_flush_window seconds for a
+    batch to fill up.
+    """
+    global _outbox
+    if _outbox is None:
+        from .system import resolve_path
+        with _outbox_lock:
+            if _outbox is None:
+                path = resolve_path(_option('outbox_path', 'dispense-outbox.log'))
+                outbox_ = outbox.Outbox(path, deliver_dispense,
+                                        _option('outbox_retry_delay', 1.0),
+                                        _option('outbox_max_retry_delay', 600.0),
+                                        deliver_batch=deliver_dispenses,
+                                        batch_key=lambda record: (record['kind'], record['org']),
+                                        batch_size=_option('outbox_batch_size', 20),
+                                        flush_window=_option('outbox_flush_window', 1.0))
+                outbox_.start()
+                _outbox = outbox_
+    return _outbox
+
+def billing_stats():
+    """
+    Return the delivery metrics of the outbox per org, see
+    outbox.BatchStats.
+    """
+    return dict((org, stats.as_dict()) for (kind, org), stats in get_outbox().stats.items()
+                if kind == 'bill')
+
+def deliver_dispense(record):
+    """
+    Deliver a record of the outbox: the DISPENSE line of the sql log or the
+    bill to the org. Raises if the line could not be written or the org
+    could not be billed.
+    """
+    rfidnr, org, item = record['legi'], record['org'], record['item']
+    if record['kind'] == 'log':
+        _write_log([record])
+    else:
         try:
-            status = handlers[0](leginr)
+            org_handlers[org][1](rfidnr, item)
         except Exception:
-            status_logger.warning("caught exception in get_status for legi %s, org %s", leginr, org, exc_info=True)
-        else:
-            if status:
-                return org
-    return None
+            status_logger.error("caught exception report_dispense for legi %s, org %s, item %s", rfidnr, org, item, exc_info=True)
+            raise
 
-def report_dispense(rfidnr, org, item):
+def _write_log(records):
+    # written directly rather than through log_msg, whose queue would
+    # acknowledge the records before they are written
     from . import sqllogging
-    sqllogging.log_msg("DISPENSE", "%s:%s:%s" % (org, rfidnr, item))
+    sqllogging.write_rows([("DISPENSE", "%s:%s:%s" % (r['org'], r['legi'], r['item']))
+                           for r in records])
 
-    try:
-        org_handlers[org][1](rfidnr, item)
-    except Exception:
-        status_logger.error("caught exception report_dispense for legi %s, org %s, item %s", rfidnr, org, item, exc_info=True)
+def deliver_dispenses(key, records):
+    """
+    Deliver records of the outbox with the same kind and org, return the
+    ones that failed.
+    """
+    kind, org = key
+    if kind == 'log':
+        try:
+            _write_log(records)
+        except Exception:
+            status_logger.error("could not log %d dispenses", len(records), exc_info=True)
+            raise
+        return []
+    if kind == 'bill' and org in org_batch_handlers:
+        try:
+            failed = org_batch_handlers[org]([(r['legi'], r['item']) for r in records])
+        except Exception:
+            status_logger.error("caught exception report_dispense for %d dispenses, org %s", len(records), org, exc_info=True)
+            raise
+        # a legi may have several records for the same item, only the
+        # failed ones are delivered again
+        return [records[i] for i in failed]
+
+    failed = []
+    for record in records:
+        try:
+            deliver_dispense(record)
+        except Exception:
+            failed.append(record)
+    return failed
+
+def report_dispense(rfidnr, org, item):
+    """
+    Record a dispense to be logged and billed to org. Returns once it is
+    stored on disk, the delivery is done by the outbox.
+    """
+    box = get_outbox()
+    for kind in ('log', 'bill'):
+        box.put({'kind': kind, 'legi': rfidnr, 'org': org, 'item': item, 'time': time.time()})
@@ -2,7 +2,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 
+import functools
 import logging
+import os
 import threading
 import serial
 import binascii
@@ -12,14 +14,21 @@ from . import (
     translator,
     mdb,
     legi,
+    httppool,
+    pool,
+    reactor,
     status,
     sqllogging,
+    timers,
     ampelstatus,
     usb_ampel,
 )
 
 config = None
 config_dirs = ['/etc/kaffi', '/etc/vis/kaffi', '~/.config/kaffi', '~/.config/vis/kaffi']
+# directory kaffi is installed in, relative paths are resolved against it
+# rather than against the working directory of the daemon
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 def get_config():
     global config
     if not config:
@@ -37,6 +46,28 @@ def get_config():
             raise ValueError("could not find config file")
     return config
 
+def get_option(section, option, default=None):
+    """
+    Return a config value, or default if the option is not set. If default
+    is a bool, int or float the value is converted to that type.
+    """
+    config = get_config()
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    if isinstance(default, int):
+        return config.getint(section, option)
+    if isinstance(default, float):
+        return config.getfloat(section, option)
+    return config.get(section, option)
+
+def resolve_path(path):
+    """
+    Return path made absolute relative to root_dir.
+    """
+    return os.path.join(root_dir, os.path.expanduser(path))
+
 tohex = binascii.hexlify
 fromhex = binascii.unhexlify
 
@@ -48,9 +79,17 @@ class SerialStream(object):
         """
         Initialize this SerialStream. args and kwargs are passed to the Serial
         constructor when connect() is called.
+
+        If the keyword argument buffered is True, reads fetch everything the
+        port has waiting in one call and read_byte() serves from that buffer.
+        The translator also uses this flag to send its ACK and the response
+        frame in a single write.
         """
+        self.buffered = kwargs.pop('buffered', False)
         self.connection = None
         self.connect_args = args, kwargs
+        self._read_buf = b""
+        self._read_pos = 0
 
     def connect(self):
         self.connection = serial.Serial(*self.connect_args[0], **self.connect_args[1])
@@ -58,14 +97,65 @@ class SerialStream(object):
     def disconnect(self):
         self.connection.close()
         self.connection = None
+        self._read_buf = b""
+        self._read_pos = 0
 
     def is_open(self):
         return bool(self.connection and self.connection.isOpen())
 
+    def fileno(self):
+        return self.connection.fileno()
+
+    def _in_waiting(self):
+        try:
+            # pyserial 3
+            return self.connection.in_waiting
+        except AttributeError:
+            # pyserial 2
+            return self.connection.inWaiting()
+
+    def read_bytes(self):
+        """
+        Read and return all bytes currently waiting (blocking for at least one)
+        if the stream is open, else return None. Bytes already buffered by
+        read_byte() are returned first.
+        """
+        if self._read_pos < len(self._read_buf):
+            data = self._read_buf[self._read_pos:]
+            self._read_buf = b""
+            self._read_pos = 0
+            return data
+        while self.connection and self.connection.isOpen():
+            data = self.connection.read(max(1, self._in_waiting()))
+            if data:
+                if serial_logger.isEnabledFor(logging.INFO):
+                    serial_logger.info("read %s", tohex(data))
+                return data
+
+    def read_available(self):
+        """
+        Read and return the bytes currently waiting without blocking (may be
+        empty). Meant to be called when the file descriptor is readable.
+        """
+        data = self.connection.read(self._in_waiting())
+        if data and serial_logger.isEnabledFor(logging.INFO):
+            serial_logger.info("read %s", tohex(data))
+        return data
+
     def read_byte(self):
         """
         Read and return a single byte if the stream is open, else return None
         """
+        if self.buffered:
+            if self._read_pos >= len(self._read_buf):
+                data = self.read_bytes()
+                if data is None:
+                    return None
+                self._read_buf, self._read_pos = data, 0
+            pos = self._read_pos
+            self._read_pos = pos + 1
+            return self._read_buf[pos:pos+1]
+
         while self.connection and self.connection.isOpen():
             byte = self.connection.read()
             if byte:
@@ -77,7 +167,8 @@ class SerialStream(object):
         Write some data to the stream. Throws ValueError if the stream is
         disconnected.
         """
-        serial_logger.info("writing %s", tohex(byte))
+        if serial_logger.isEnabledFor(logging.INFO):
+            serial_logger.info("writing %s", tohex(byte))
         if self.connection and self.connection.isOpen():
             self.connection.write(byte)
             self.connection.flush()
@@ -89,65 +180,128 @@ main_logger = logging.getLogger('main')
 
 class Main(object):
 
-    def __init__(self, mdb):
-        self._current_legi = None
-        self._legi_lock = threading.Condition()
+    def __init__(self, mdb, approve_timeout=2.0, vend_timeout=60.0, queue_timeout=120.0,
+                 debounce_window=2.0, swipe_queue_size=8, max_swipe_age=30.0):
+        """
+        :param approve_timeout: seconds the vending machine has to request
+            the vend once a session is offered for an authorization
+        :param vend_timeout: seconds to wait for the result of an approved
+            vend
+        :param queue_timeout: seconds an authorization may wait for the
+            vends authorized before it, at most until its swipe is
+            max_swipe_age seconds old
+        :param debounce_window: seconds within which repeated swipes of the
+            same legi are dropped
+        :param swipe_queue_size: number of swipes that may wait for their
+            authorization
+        :param max_swipe_age: seconds after which a waiting swipe is dropped
+        """
         self.mdb = mdb
-    
-    def _wait_for_legi(self):
-        with self._legi_lock:
-            while not self._current_legi:
-                self._legi_lock.wait()
-            legi = self._current_legi
-            self._current_legi = None
-            return legi
-    
+        self.approve_timeout = approve_timeout
+        self.vend_timeout = vend_timeout
+        self.queue_timeout = queue_timeout
+        self.debouncer = legi.SwipeDebouncer(debounce_window)
+        self.swipes = legi.SwipeQueue(swipe_queue_size, max_swipe_age,
+                                      lambda swipe: self.debouncer.release(swipe.legi))
+        # look up swipes as soon as they are queued, so the lookup of the
+        # next swipe runs while the current one is authorized
+        self._lookups = pool.WorkerPool(2, name="lookup")
+        # reports dispenses and, in multi-vend mode, waits for the vend
+        # results, so run() can go on authorizing the next swipe while a vend
+        # is running. One thread per ticket the mdb queues.
+        self._settlers = pool.WorkerPool(mdb.max_tickets if mdb.multi_vend else 1, name="settle")
+
     def _legi_receiver(self,legi):
         # runs on legi thread
-        with self._legi_lock:
-            self._current_legi = legi
-            self._legi_lock.notify()
+        if not self.debouncer.admit(legi):
+            return
+        self.swipes.put(legi, self._lookups.submit(self._lookup, legi))
+
+    def _lookup(self, leginr):
+        """
+        Return the org that pays for leginr, or None if it is denied.
+        """
+        main_logger.info("checking ampel status")
+        if not ampelstatus.get_status():
+            # deny dispense
+            sqllogging.log_msg('DENIED Ampel', leginr)
+            return None
 
+        main_logger.info("checking legi %s", leginr)
+        org = status.check_legi(leginr)
+        main_logger.info("got org %s for legi %s", org, leginr)
+        if not org:
+            # deny dispense
+            sqllogging.log_msg('DENIED', leginr)
+        return org
 
     def run(self):
         while True:
+            swipe = None
             try:
                 main_logger.info("waiting for legi")
-                leginr = self._wait_for_legi() # return current legi (may block)
-                main_logger.info("checking ampel status")
-                if not ampelstatus.get_status():
-                    # deny dispense
-                    sqllogging.log_msg('DENIED Ampel', leginr)
-                    continue
-
-                main_logger.info("checking legi %s", leginr)
-                org = status.check_legi(leginr)
-                main_logger.info("got org %s for legi %s", org, leginr)
+                swipe = self.swipes.get()
+                leginr = swipe.legi
+                org = swipe.lookup.result()
+                if org and self.swipes.is_expired(swipe):
+                    main_logger.info("dropping swipe of %s, looked up too late", leginr)
+                    org = None
                 if not org:
-                    # deny dispense
-                    sqllogging.log_msg('DENIED', leginr)
+                    self.debouncer.release(leginr)
                 else:
                     main_logger.info("Waiting for dispense...")
-                    dispensed, itemdata = self.mdb.allow_one_and_wait()
-                    main_logger.info("Dispensed: %s, itemdata: %r", dispensed, itemdata)
-                    if dispensed:
-                        try:
-                            item_number = int(tohex(itemdata), 16)
-                            status.report_dispense(leginr, org, item_number)
-                        except Exception:
-                            system_logger.error("caught exception while reporting dispense for %r, itemdata %r",
-                                                (leginr, org), itemdata, exc_info=True)
+                    # a swipe queued for max_swipe_age is dropped even if it
+                    # already got its ticket, rather than authorized when the
+                    # user is gone
+                    ticket = self.mdb.authorize(functools.partial(self._late_success, leginr, org),
+                                                self.approve_timeout, self.vend_timeout,
+                                                min(self.queue_timeout, self.swipes.remaining(swipe)))
+                    if self.mdb.multi_vend:
+                        self._settlers.submit(self._settle, ticket, leginr, org)
+                    else:
+                        # one vend at a time, the next swipe waits
+                        self._settle(ticket, leginr, org)
             except Exception:
                 main_logger.error("caught exception in main thread", exc_info=True)
+                if swipe:
+                    self.debouncer.release(swipe.legi)
+
+    def _settle(self, ticket, leginr, org):
+        """
+        Wait for the result of an authorized vend and bill it.
+        """
+        try:
+            dispensed, itemdata = ticket.wait()
+        finally:
+            self.debouncer.release(leginr)
+        main_logger.info("Dispensed: %s, itemdata: %r", dispensed, itemdata)
+        if dispensed:
+            self._bill(leginr, org, itemdata)
+
+    def _late_success(self, leginr, org, ticket):
+        # runs on the serial thread, reporting may block
+        main_logger.warning("late vend success for %s", leginr)
+        self._settlers.submit(self._bill, leginr, org, ticket.item_data)
+
+    def _bill(self, leginr, org, itemdata):
+        try:
+            item_number = int(tohex(itemdata), 16)
+            status.report_dispense(leginr, org, item_number)
+        except Exception:
+            system_logger.error("caught exception while reporting dispense for %r, itemdata %r",
+                                (leginr, org), itemdata, exc_info=True)
 
 
 system_logger = logging.getLogger("system")
 
 class System(object):
 
+    AMPEL_INTERVAL = 5
+
     def __init__(self, legi_enable=None):
         self.serial = self.trans = self.mdb = self.mdb_thread = self.main = None
         self.listener = self.legi_thread = None
+        self.reactor = self.reactor_thread = None
         self.reset_timer = None
         self.response_timer = None
         self.legi_enable = legi_enable or fromhex(get_config().get('legi', 'enable'))
@@ -157,37 +311,54 @@ class System(object):
         logging.basicConfig(filename='output.txt', level=logging.INFO)
 
     def start(self):
-        import threading
-        ampel_controller = threading.Thread(target=usb_ampel.ampel_controller)
-        ampel_controller.start()
         if self.is_running():
             system_logger.warn("system already running")
             return
+        use_reactor = get_option('system', 'runtime', 'threads') == 'reactor'
+        if not use_reactor:
+            ampel_controller = threading.Thread(target=usb_ampel.ampel_controller)
+            ampel_controller.start()
         system_logger.info("starting")
+        httppool.start_prewarm()
         import pdb
         #pdb.set_trace();
         if self.serial is None:
-            self.serial = SerialStream("/dev/ttyS0", 115200, timeout=5)
+            self.serial = SerialStream(get_option('serial', 'mdb_port', '/dev/ttyS0'), 115200,
+                                       timeout=5, buffered=True)
             self.serial.connect()
 
         if self.mdb is None:
-            self.mdb = mdb.MdbL1Stm()
+            self.mdb = mdb.MdbL1Stm(get_option('mdb', 'multi_vend', False),
+                                    get_option('mdb', 'max_tickets',
+                                               get_option('legi', 'swipe_queue_size', 8)))
 
         if self.trans is None:
             self.response_timer = translator.ResponseTimer(self.mdb.received_data)
             self.response_timer.enabled = True
-            self.trans = translator.TranslatorStm(self.serial, self.response_timer, self.mdb.received_nack)
+            self.trans = translator.TranslatorStm(self.serial, self.response_timer, self.mdb.received_nack,
+                                                  self.mdb.CONSTANT_RESPONSES)
 
         if self.main is None:
-            self.main = Main(self.mdb)
+            self.main = Main(self.mdb, get_option('mdb', 'approve_timeout', 2.0),
+                             get_option('mdb', 'vend_timeout', 60.0),
+                             get_option('mdb', 'queue_timeout', 120.0),
+                             get_option('legi', 'debounce_window', 2.0),
+                             get_option('legi', 'swipe_queue_size', 8),
+                             get_option('legi', 'max_swipe_age', 30.0))
 
         if self.listener is None:
-            self.listener = legi.LegiListener(serial.Serial('/dev/ttyS1', 38400, timeout=1),
+            self.listener = legi.LegiListener(
+                    serial.Serial(get_option('serial', 'legi_port', '/dev/ttyS1'), 38400, timeout=1),
                     self.legi_enable, self.main._legi_receiver)
 
         self.main_thread = threading.Thread(target=self.main.run)
         self.main_thread.deamon = True
 
+        if use_reactor:
+            self._start_reactor()
+            self.main_thread.start()
+            return
+
         self.mdb_thread = threading.Thread(target=self.trans.run)
         self.mdb_thread.daemon = True
 
@@ -198,9 +369,37 @@ class System(object):
         self.mdb_thread.start()
         self.legi_thread.start()
 
+    def _start_reactor(self):
+        """
+        Run the MDB line, the legi reader and the ampel updates on a single
+        event loop thread instead of one thread each.
+        """
+        if self.reactor is None:
+            self.reactor = reactor.Reactor(get_option('system', 'workers', 2))
+        self.reactor.add_reader(self.serial.fileno(),
+                lambda: self.trans.feed(self.serial.read_available()))
+        self.reactor.add_reader(self.listener.serial.fileno(),
+                lambda: self.listener.feed(self.listener.read_available()))
+        self.reactor.call_soon_threadsafe(self.listener.serial.write, self.legi_enable)
+        self.reactor.call_soon_threadsafe(self._ampel_update, None)
+
+        self.reactor_thread = threading.Thread(target=self.reactor.run)
+        self.reactor_thread.daemon = True
+        self.reactor_thread.start()
+
+    def _ampel_update(self, status):
+        def reschedule(result):
+            if result.exc_info:
+                system_logger.error("ampel update failed", exc_info=result.exc_info)
+            self.reactor.call_later(self.AMPEL_INTERVAL, self._ampel_update, result.value)
+        self.reactor.run_in_executor(usb_ampel.update, (status,), reschedule)
+
     def stop(self):
         system_logger.info("stopping")
         usb_ampel.switch(None, None)
+        if sqllogging.writer is not None:
+            # write the queued log rows
+            sqllogging.writer.flush(2)
         # todo: implement proper shutdown.
         import os
         os._exit(1)
@@ -214,6 +413,8 @@ class System(object):
             self.trans.stop()
         if self.listener is not None:
             self.listener.stop()
+        if self.reactor is not None:
+            self.reactor.stop()
         if self.reset_timer:
             self.reset_timer.cancel()
         # todo: shutdown main thread
@@ -275,7 +476,8 @@ class System(object):
 
     def is_running(self):
         return (self.mdb_thread is not None and self.mdb_thread.isAlive() or
-                self.legi_thread is not None and self.legi_thread.isAlive())
+                self.legi_thread is not None and self.legi_thread.isAlive() or
+                self.reactor_thread is not None and self.reactor_thread.isAlive())
 
     def _dispense_timeout(self):
         try:
@@ -301,5 +503,4 @@ class System(object):
         self.dispense_permitted = allow
         if allow:
             # start timer if necessary
-            self.reset_timer = threading.Timer(8, self._dispense_timeout)
-            self.reset_timer.start()
+            self.reset_timer = timers.call_later(8, self._dispense_timeout)
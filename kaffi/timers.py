@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+timer_logger = logging.getLogger("timers")
+
+class Timer(object):
+    """
+    Handle for a callback scheduled on a TimerQueue. Re-arming and
+    cancelling only update the handle; stale heap entries are skipped when
+    they come up.
+    """
+
+    def __init__(self, queue, deadline, callback, args):
+        self._queue = queue
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        # sequence number of the heap entry that is currently valid for this
+        # timer, None if it has none
+        self._seq = None
+
+    def cancel(self):
+        self._queue.cancel(self)
+
+    def rearm(self, delay):
+        """
+        Fire delay seconds from now instead, even if already cancelled or
+        fired.
+        """
+        self._queue.rearm(self, time.time() + delay)
+
+    def active(self):
+        return not self.cancelled and self._seq is not None
+
+class TimerQueue(object):
+    """
+    Heap of timers with lazy cancel and re-arm.
+
+    Pushing a deadline back (the common case for watchdogs that are re-armed
+    on every event) costs one attribute update: the existing heap entry is
+    moved when it comes up. Only moving a deadline forward pushes a new
+    entry.
+
+    Not thread safe by itself. If lock is given it is held for every
+    operation, and wakeup() is called (with the lock held) whenever the
+    earliest deadline moved forward.
+    """
+
+    def __init__(self, lock=None, wakeup=None):
+        self._heap = []
+        self._seq = itertools.count()
+        self._lock = lock or _NoLock()
+        self._wakeup = wakeup
+
+    def _push(self, timer):
+        timer._seq = next(self._seq)
+        heapq.heappush(self._heap, (timer.deadline, timer._seq, timer))
+        if self._wakeup and self._heap[0][2] is timer:
+            self._wakeup()
+
+    def call_later(self, delay, callback, *args):
+        """
+        Call callback(*args) delay seconds from now. Returns a Timer.
+        """
+        with self._lock:
+            timer = Timer(self, time.time() + delay, callback, args)
+            self._push(timer)
+            return timer
+
+    def cancel(self, timer):
+        with self._lock:
+            timer.cancelled = True
+
+    def rearm(self, timer, deadline):
+        with self._lock:
+            previous = timer.deadline
+            timer.deadline = deadline
+            timer.cancelled = False
+            if timer._seq is None or deadline < previous:
+                self._push(timer)
+
+    def next_deadline(self):
+        """
+        Return the time of the earliest (possibly stale) entry, or None.
+        """
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Remove and return the timers that are due at now.
+        """
+        now = time.time() if now is None else now
+        due = []
+        with self._lock:
+            heap = self._heap
+            while heap and heap[0][0] <= now:
+                deadline, seq, timer = heapq.heappop(heap)
+                if seq != timer._seq:
+                    # superseded by an earlier re-arm
+                    continue
+                if timer.cancelled:
+                    timer._seq = None
+                elif timer.deadline > deadline:
+                    # re-armed to a later time, move the entry
+                    timer._seq = next(self._seq)
+                    heapq.heappush(heap, (timer.deadline, timer._seq, timer))
+                else:
+                    timer._seq = None
+                    due.append(timer)
+        return due
+
+    def run_due(self, now=None):
+        for timer in self.pop_due(now):
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                timer_logger.error("caught exception in timer %r", timer.callback, exc_info=True)
+
+class _NoLock(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+class TimerService(TimerQueue):
+    """
+    TimerQueue run by a single daemon thread. Callbacks are run on that
+    thread and should return quickly; hand anything slow to a WorkerPool.
+    """
+
+    def __init__(self, name="timers"):
+        self._cond = threading.Condition()
+        TimerQueue.__init__(self, self._cond, self._cond.notify)
+        self.name = name
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = self._heap[0][0] if self._heap else None
+                timeout = None if deadline is None else deadline - time.time()
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+            self.run_due()
+
+_service = None
+_service_lock = threading.Lock()
+
+def get_service():
+    """
+    Return the process wide TimerService, starting it on first use.
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                service = TimerService()
+                service.start()
+                _service = service
+    return _service
+
+def call_later(delay, callback, *args):
+    """
+    Call callback(*args) on the shared timer thread after delay seconds.
+    Returns a Timer that can be cancelled or re-armed.
+    """
+    return get_service().call_later(delay, callback, *args)
@@ -3,7 +3,8 @@ from __future__ import absolute_import
 
 import binascii
 import logging
-import threading
+
+from . import alerts, timers
 
 tohex = binascii.hexlify
 fromhex = binascii.unhexlify
@@ -19,14 +20,18 @@ class TranslatorStm(object):
     ACK = '\x06'
     NAK = '\x15'
 
-    def __init__(self, serial_stream, data_handler, nack_handler):
+    def __init__(self, serial_stream, data_handler, nack_handler, constant_responses=()):
         """
         Initialize the Translator.
 
-        :param serial_stream: object with read_byte() and write_bytes(bytes)
+        :param serial_stream: object with read_byte() and write_bytes(bytes).
+            If it has a true ``buffered`` attribute, run() reads whole chunks
+            from its read_bytes() instead and feeds them to feed().
         :param data_handler: callable that takes newly received data and responds
             with data to be sent
         :param nack_andler: callable that will be called when a NACK is received
+        :param constant_responses: responses data_handler returns over and
+            over again. Their encoded frames are built once and reused.
         """
         super(TranslatorStm, self).__init__()
         self.serial_stream = serial_stream
@@ -34,7 +39,25 @@ class TranslatorStm(object):
         self.nack_handler = nack_handler
         self.state_fn = self._transaction_idle
         self.running = False
-        self.received_data = ""
+        # reused for every frame, cleared on frame completion
+        self.received_data = bytearray()
+        # a buffered stream gets the ACK and the response frame in one write
+        self.coalesce_writes = getattr(serial_stream, 'buffered', False)
+        # response -> encoded frame, ready to be written
+        self.frame_cache = {}
+        for data in constant_responses:
+            self.frame_cache[data] = self._encode_frame(data)
+
+    def _encode_frame(self, data):
+        """
+        Internal method. Escape data and wrap it in a transaction (preceded
+        by the ACK if it is written together with the frame).
+        """
+        frame = self.STX + data.replace(self.DLE, self.DLE + self.DLE) + self.DLE + self.ETX
+        if self.coalesce_writes:
+            # ACK and response go out in one write
+            frame = self.ACK + frame
+        return frame
 
     def _transaction_running(self, c):
         """
@@ -52,20 +75,23 @@ class TranslatorStm(object):
         """
         if c == self.ETX:
             # receive complete, forward to data_handler
-            logger.info("received %s", tohex(self.received_data))
-            
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("received %s", tohex(self.received_data))
+
             # why send ack?
-            self.serial_stream.write_bytes(self.ACK)
-            
-            data = self.data_handler(self.received_data)
-            self.received_data = ""
+            if not self.coalesce_writes:
+                self.serial_stream.write_bytes(self.ACK)
 
-            # prepare to send data
-            logger.info("sending %s", tohex(data))
-            data = data.replace(self.DLE, self.DLE + self.DLE)
+            data = self.data_handler(bytes(self.received_data))
+            del self.received_data[:]
 
-            # wrap data in transaction
-            self.serial_stream.write_bytes(self.STX + data + self.DLE + self.ETX)
+            # prepare to send data
+            if logger.isEnabledFor(logging.INFO):
+                logger.info("sending %s", tohex(data))
+            frame = self.frame_cache.get(data)
+            if frame is None:
+                frame = self._encode_frame(data)
+            self.serial_stream.write_bytes(frame)
 
             # update state
             self.state_fn = self._transaction_idle
@@ -93,6 +119,31 @@ class TranslatorStm(object):
         else:
             logger.warn("mega komisch: %s im idle" % tohex(c))
 
+    def feed(self, chunk):
+        """
+        Process a chunk of received bytes.
+
+        Equivalent to passing every byte of chunk to the current state
+        handler, but the frame payload (the bulk of the traffic) is located
+        with find() and copied into received_data in one slice instead of
+        dispatching per byte. Only the framing bytes (STX, the byte after a
+        DLE and anything between transactions) go through the state handlers.
+        """
+        pos, end = 0, len(chunk)
+        running = self._transaction_running
+        while pos < end:
+            if self.state_fn == running:
+                idx = chunk.find(self.DLE, pos)
+                if idx < 0:
+                    self.received_data += chunk[pos:]
+                    return
+                self.received_data += chunk[pos:idx]
+                self.state_fn = self._escape_received
+                pos = idx + 1
+            else:
+                self.state_fn(chunk[pos:pos+1])
+                pos += 1
+
     def run(self):
         """
         Run this state machine. Does not terminate until stop() has been
@@ -100,6 +151,9 @@ class TranslatorStm(object):
         """
         self.running = True
         try:
+            if getattr(self.serial_stream, 'buffered', False):
+                while self.running:
+                    self.feed(self.serial_stream.read_bytes())
             while self.running:
                 c = self.serial_stream.read_byte()
                 self.state_fn(c)
@@ -114,12 +168,6 @@ class TranslatorStm(object):
         """
         self.running = False
 
-# email shit taken from snowdayz
-from email import Charset
-# without adding the utf-8+qp charset, utf-8 is always encoded base64
-Charset.add_charset('utf-8', Charset.QP, Charset.QP, 'utf-8')
-from email.mime.text import MIMEText
-from smtplib import SMTP
 RESPONSE_TIMEOUT = 5
 
 class ResponseTimer(object):
@@ -130,35 +178,17 @@ class ResponseTimer(object):
 
     def _timeout(self):
         logger.warning("no data received within %s seconds", RESPONSE_TIMEOUT)
-        text = "No data received within %s seconds\n" % RESPONSE_TIMEOUT
-        buf = ""
-        with open("/var/log/kaffi.log", "r") as f:
-            f.seek(0, 2) # end
-            while buf.count('\n') <= 10:
-                f.seek(-1024) # seek back
-                buf = f.read(1024) + buf # read
-                f.seek(-1024) # undo position change from read
-                if f.tell() == 0:
-                    break
-            while buf.count('\n') > 10:
-                buf = buf[buf.index('\n')+1:]
-        text += "log tail:\n"
-        text += buf
-        msg = MIMEText(text, 'plain', 'utf-8')
-        msg['Subject'] = "Kaffeemaschine receive timeout"
-        msg['From'] = 'root@kafi.vis.ethz.ch'
-        msg['To'] = 'nev@vis.ethz.ch'
-
-        s = SMTP('mail.vis.ethz.ch')
-        s.sendmail('root@kafi.vis.ethz.ch', 'nev@vis.ethz.ch', msg.as_string())
-        s.quit()
+        alerts.alert("Kaffeemaschine receive timeout",
+                     "No data received within %s seconds\n" % RESPONSE_TIMEOUT)
 
     def __call__(self, *args, **kwargs):
         if self.timer:
             self.timer.cancel()
         res = self.to_call(*args, **kwargs)
         if self.enabled:
-            self.timer = threading.Timer(RESPONSE_TIMEOUT, self._timeout)
-            self.timer.start()
+            if self.timer:
+                self.timer.rearm(RESPONSE_TIMEOUT)
+            else:
+                self.timer = timers.call_later(RESPONSE_TIMEOUT, self._timeout)
         return res
 
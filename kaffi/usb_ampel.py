@@ -1,9 +1,10 @@
 #-*- coding: utf-8 -*- 
-import httplib
 import subprocess
 import time
 import logging
 
+from .httppool import urlopen
+
 logger = logging.getLogger("usb_ampel")
 
 clewarecontrol = '/opt/vis/clewarecontrol'
@@ -24,21 +25,25 @@ def get_status():
     ampel_host = config.get('ampel', 'host')
     ampel_suffix = config.get('ampel', 'suffix')
     try:
-        connection = httplib.HTTPSConnection(ampel_host, timeout=5.0)
-        connection.request('GET', ampel_suffix)
-        response = connection.getresponse()
-        result = response.read()
+        result = urlopen('https://' + ampel_host + ampel_suffix, timeout=5.0).read()
         return result
     except Exception as e:
         logger.warn(e)
         return False
 
+def update(old_status):
+    """
+    Fetch the current ampel status and switch the light accordingly. Returns
+    the new status.
+    """
+    status = get_status()
+    switch(status, old_status)
+    return status
+
 def ampel_controller():
     status = None
     while True:
-        old_status = status
-        status = get_status()
-        switch(status, old_status)
+        status = update(status)
         time.sleep(5)
         
 
@@ -2,17 +2,13 @@
 from __future__ import absolute_import
 
 import logging
-try:
-    # python3
-    from urllib.request import urlopen
-except ImportError:
-    # python2
-    from urllib import urlopen
 try:
     import json
 except ImportError:
     import simplejson as json
 
+from .httppool import urlopen
+
 logger = logging.getLogger("status.vis")
 
 def get_url(rfid, route):
@@ -22,15 +18,15 @@ def get_url(rfid, route):
     apikey = config.get('visstatus', 'key')
 
     if base and apikey:
-        return base + '/coffee/' + route + '/' + rfid + '?key=' apikey
+        return base + '/coffee/' + route + '/' + rfid + '?key=' + apikey
     else:
         None
 
-def get_status(rfid):
+def get_status(rfid, timeout=None):
 
     status_url = get_url(rfid, 'status')
     logger.debug("looking up status at %s", status_url)
-    response = urlopen(status_url)
+    response = urlopen(status_url, timeout)
 
     if response.getcode() != 200:
         logger.warning("got status %d from VIS's status url", response.getcode())
@@ -47,3 +43,4 @@ def report_dispensed(rfidnr, item):
     response = urlopen(report_url)
     if response.getcode() != 200:
         logger.warn("vis report url returned status %s" % response.getcode())
+        raise IOError("vis report url returned status %s" % response.getcode())
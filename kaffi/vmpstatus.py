@@ -2,25 +2,21 @@
 from __future__ import absolute_import
 
 import logging
-try:
-    # python3
-    from urllib.request import urlopen
-except ImportError:
-    # python2
-    from urllib import urlopen
 try:
     import json
 except ImportError:
     import simplejson as json
 
+from .httppool import urlopen
+
 logger = logging.getLogger("status.vmp")
 
 status_url = 'https://vmp.ethz.ch/coffee/vmp_coffee_check.php?rfidnr=%(rfidnr)s'
 report_url = 'https://vmp.ethz.ch/coffee/vmp_coffee_billing.php?rfidnr=%(rfidnr)s&slot_id=%(item)s'
 
-def get_status(rfid):
+def get_status(rfid, timeout=None):
     url = status_url % dict(rfidnr=rfid)
-    res = urlopen(url)
+    res = urlopen(url, timeout)
     if res.getcode() == 404:
         return None
     elif res.getcode() != 200:
@@ -37,3 +33,4 @@ def report_dispensed(rfid, item):
     res = urlopen(url)
     if res.getcode() != 200:
         logger.warn("vmp report url returned status %s" % res.getcode())
+        raise IOError("vmp report url returned status %s" % res.getcode())
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import tempfile
+import time
+import sys, os, os.path
+
+class TailLinesTests(unittest.TestCase):
+
+    def write(self, data):
+        fd, path = tempfile.mkstemp()
+        os.write(fd, data)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_tail_across_blocks(self):
+        from kaffi.alerts import tail_lines
+        lines = [b'line %d\n' % i for i in range(1000)]
+        path = self.write(b''.join(lines))
+        for block_size in (1, 7, 64, 4096):
+            self.assertEqual(tail_lines(path, 10, block_size), b''.join(lines[-10:]).decode())
+
+    def test_short_and_empty_files(self):
+        from kaffi.alerts import tail_lines
+        self.assertEqual(tail_lines(self.write(b'a\nb'), 10, 2), u'a\nb')
+        self.assertEqual(tail_lines(self.write(b''), 10), u'')
+
+class AlertMailerTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import alerts
+        alerts.LoggingSMTP.sent = []
+        self.alerts = alerts
+
+    def wait_sent(self, mailer, count):
+        for i in range(100):
+            if mailer.sent >= count:
+                return
+            time.sleep(0.02)
+
+    def test_repeated_alerts_are_coalesced(self):
+        mailer = self.alerts.AlertMailer('from@x', 'to@x', 'debug', min_interval=0.3,
+                                         smtp_factory=self.alerts.LoggingSMTP)
+        mailer.alert("timeout", "no data\n")
+        self.wait_sent(mailer, 1)
+        for i in range(5):
+            mailer.alert("timeout", "no data\n")
+        self.wait_sent(mailer, 2)
+        time.sleep(0.1)
+        sent = self.alerts.LoggingSMTP.sent
+        self.assertEqual(len(sent), 2)
+        self.assertTrue("5x timeout: no data" in sent[1][2])
+
+    def test_alert_does_not_block(self):
+        def slow_smtp(host):
+            time.sleep(1)
+            return self.alerts.LoggingSMTP(host)
+        mailer = self.alerts.AlertMailer('from@x', 'to@x', 'debug', smtp_factory=slow_smtp)
+        start = time.time()
+        for i in range(100):
+            mailer.alert("timeout", "no data\n")
+        self.assertTrue(time.time() - start < 0.5)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
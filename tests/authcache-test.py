@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import sys, os, os.path
+
+class ImmediatePool(object):
+
+    def submit(self, fn, *args):
+        fn(*args)
+
+class AuthCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi.authcache import AuthCache
+        self.now = 0
+        self.answers = {'a': ('VIS', True), 'b': (None, True)}
+        self.lookups = []
+        self.cache = AuthCache(self.lookup, ttl=100, negative_ttl=10, max_stale=1000, max_size=3,
+                               refresher=ImmediatePool(), clock=lambda: self.now)
+
+    def lookup(self, key):
+        self.lookups.append(key)
+        return self.answers.get(key, (None, False))
+
+    def test_positive_and_negative_ttl(self):
+        c = self.cache
+        for i in range(2):
+            self.assertEqual(c.get('a'), 'VIS')
+            self.assertEqual(c.get('b'), None)
+        self.assertEqual(self.lookups, ['a', 'b'])
+        self.now = 20
+        self.assertEqual(c.get('a'), 'VIS')
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(self.lookups, ['a', 'b', 'b'])
+        self.assertEqual((c.hits, c.misses), (3, 3))
+
+    def test_uncertain_answers_are_not_cached(self):
+        self.assertEqual(self.cache.get('c'), None)
+        self.assertEqual(self.cache.get('c'), None)
+        self.assertEqual(self.lookups, ['c', 'c'])
+
+    def test_stale_while_revalidate(self):
+        c = self.cache
+        c.get('a')
+        self.answers['a'] = ('AMIV', True)
+        self.now = 150
+        # stale answer served, refreshed in the background
+        self.assertEqual(c.get('a'), 'VIS')
+        self.assertEqual(c.get('a'), 'AMIV')
+        self.assertEqual(c.stale_hits, 1)
+        # backend down: the stale answer is kept
+        self.answers['a'] = (None, False)
+        self.now = 300
+        self.assertEqual(c.get('a'), 'AMIV')
+        self.assertEqual(c.get('a'), 'AMIV')
+        # too stale
+        self.now = 2000
+        self.assertEqual(c.get('a'), None)
+
+    def test_lru_eviction(self):
+        c = self.cache
+        for key in 'wxy':
+            c.put(key, 'VIS')
+        c.get('w')
+        c.put('z', 'VIS')
+        self.assertEqual(sorted(c._entries), ['w', 'y', 'z'])
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import tempfile
+import shutil
+import sys, os, os.path
+
+class AuthStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'auth.db')
+        self.now = 1000
+
+    def open(self):
+        from kaffi.authstore import AuthStore
+        return AuthStore(self.path, max_age=100, clock=lambda: self.now)
+
+    def test_survives_restart(self):
+        store = self.open()
+        store.record('123456', 'VIS')
+        store.record('654321', 'AMIV')
+        store.flush(5)
+        store = self.open()
+        self.assertEqual(store.get('123456'), 'VIS')
+        self.assertEqual(store.get('654321'), 'AMIV')
+        self.assertEqual(store.get('000000'), None)
+        self.assertEqual(len(store), 2)
+
+    def test_denied_and_old_entries(self):
+        store = self.open()
+        store.record('123456', 'VIS')
+        store.record('654321', 'VIS')
+        store.record('654321', None)
+        store.flush(5)
+        self.assertEqual(store.get('654321'), None)
+        self.now += 200
+        self.assertEqual(store.get('123456'), None)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import sys, os, os.path
+import socket
+try:
+    # python3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    # python2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        body = self.path.encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ConnectionPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi.httppool import ConnectionPool
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.connections = set()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.pool = ConnectionPool(max_per_host=2, idle_timeout=60, timeout=2)
+        self.addCleanup(self.pool.close)
+
+    def test_connections_are_reused(self):
+        for i in range(5):
+            response = self.pool.request('GET', self.url + '/status/%d?key=x' % i)
+            self.assertEqual((response.getcode(), response.read()), (200, b'/status/%d?key=x' % i))
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 4))
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_idle_connections_are_evicted(self):
+        self.pool.request('GET', self.url + '/')
+        self.pool.idle_timeout = 0
+        self.pool.evict_idle()
+        self.pool.idle_timeout = 60
+        self.pool.request('GET', self.url + '/')
+        self.assertEqual(self.pool.created, 2)
+
+    def test_reconnect_when_server_closed_connection(self):
+        self.pool.request('GET', self.url + '/')
+        for idle in self.pool._idle.values():
+            for conn, since in idle:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.pool.request('GET', self.url + '/again').read(), b'/again')
+        self.assertEqual(self.pool.created, 2)
+
+    def test_prewarm(self):
+        self.assertTrue(self.pool.prewarm(self.url + '/'))
+        self.assertFalse(self.pool.prewarm(self.url + '/'))
+        self.pool.request('GET', self.url + '/')
+        self.assertEqual((self.pool.created, self.pool.reused), (1, 1))
+
+    def test_connection_limit(self):
+        from kaffi.httppool import PoolTimeout
+        self.pool._in_use[('http', '127.0.0.1', self.server.server_address[1])] = 2
+        self.pool.timeout = 0.1
+        self.assertRaises(PoolTimeout, self.pool.request, 'GET', self.url + '/')
+
+class SSLContextTests(unittest.TestCase):
+
+    def test_contexts_are_shared(self):
+        from kaffi import httplibssl
+        a = httplibssl.HTTPSClientAuthConnection('localhost', 443, None, None, None)
+        b = httplibssl.HTTPSClientAuthConnection('localhost', 443, None, None, None)
+        c = httplibssl.HTTPSClientAuthConnection('localhost', 443, None, None, None, verify=True)
+        self.assertTrue(a.context is b.context)
+        self.assertFalse(a.context is c.context)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import binascii
+import threading
+import time
+import sys, os, os.path
+
+from mock import Mock
+
+fromhex = binascii.unhexlify
+
+def frame(legi):
+    return fromhex('0d80' + '00' * 8 + legi + '00')
+
+class LegiFrameDecoderTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi.legi import LegiFrameDecoder
+        self.now = 0
+        self.decoder = LegiFrameDecoder(stale_after=0.5, clock=lambda: self.now)
+
+    def legis(self, data):
+        return [self.decoder.legi(f) for f in self.decoder.feed(data)]
+
+    def test_any_chunking(self):
+        data = frame('123456') + frame('abcdef') + frame('000001')
+        for size in (1, 5, 13, 14, 15, 42):
+            legis = []
+            for i in range(0, len(data), size):
+                legis += self.legis(data[i:i+size])
+            self.assertEqual(legis, [b'123456', b'abcdef', b'000001'])
+        self.assertEqual(self.decoder.resyncs, 0)
+
+    def test_resync_after_garbage(self):
+        self.assertEqual(self.legis(b'\x01\x0d\x02' + frame('123456')[:7]), [])
+        self.assertEqual(self.legis(frame('123456')[7:] + b'\x0d'), [b'123456'])
+        self.assertEqual(self.legis(b'\xff' + frame('abcdef')), [b'abcdef'])
+        self.assertEqual(self.decoder.resyncs, 2)
+        self.assertEqual(self.decoder.discarded, 5)
+
+    def test_stale_partial_frame_is_dropped(self):
+        self.assertEqual(self.legis(frame('123456')[:9]), [])
+        self.now = 1
+        self.assertEqual(self.legis(frame('abcdef')), [b'abcdef'])
+        self.assertEqual(self.decoder.resyncs, 1)
+
+class SwipeDebouncerTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi.legi import SwipeDebouncer
+        self.now = 0
+        self.debouncer = SwipeDebouncer(window=2, clock=lambda: self.now)
+
+    def test_repeats_within_window(self):
+        d = self.debouncer
+        self.assertTrue(d.admit('a'))
+        d.release('a')
+        self.now = 1
+        self.assertFalse(d.admit('a'))
+        self.assertTrue(d.admit('b'))
+        # holding the legi on the reader keeps extending the window
+        self.now = 2.5
+        self.assertFalse(d.admit('a'))
+        self.now = 5
+        self.assertTrue(d.admit('a'))
+        self.assertEqual(d.debounced, 2)
+
+    def test_in_flight(self):
+        d = self.debouncer
+        self.assertTrue(d.admit('a'))
+        self.now = 10
+        self.assertFalse(d.admit('a'))
+        self.assertEqual(d.in_flight_dropped, 1)
+        d.release('a')
+        self.now = 20
+        self.assertTrue(d.admit('a'))
+
+class SwipeQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi.legi import SwipeQueue
+        self.now = 0
+        self.dropped = []
+        self.queue = SwipeQueue(maxlen=2, max_age=10, clock=lambda: self.now,
+                                on_drop=lambda swipe: self.dropped.append(swipe.legi))
+
+    def test_fifo_and_overflow(self):
+        q = self.queue
+        for legi in 'abc':
+            q.put(legi)
+        self.assertEqual(self.dropped, ['a'])
+        self.assertEqual(q.get().legi, 'b')
+        self.assertEqual(q.get().legi, 'c')
+        self.assertEqual(q.get(timeout=0.01), None)
+        self.assertEqual(q.dropped, 1)
+
+    def test_expiry_and_wait(self):
+        q = self.queue
+        q.put('a')
+        self.now = 5
+        q.put('b')
+        self.now = 12
+        self.assertEqual(q.get().legi, 'b')
+        self.assertEqual(self.dropped, ['a'])
+        self.assertEqual((q.expired, q.wait_count, q.wait_max), (1, 1, 7))
+
+    def test_remaining(self):
+        swipe = self.queue.put('a')
+        self.now = 4
+        self.assertEqual(self.queue.remaining(swipe), 6)
+        self.now = 12
+        self.assertEqual(self.queue.remaining(swipe), -2)
+        self.assertTrue(self.queue.is_expired(swipe))
+
+class BlockingSerial(object):
+    """
+    Serial port with pyserial's blocking read: returns once size bytes
+    arrived or after timeout seconds with what is there.
+    """
+
+    def __init__(self, timeout=1):
+        self.timeout = timeout
+        self.written = []
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+
+    def arrive(self, data):
+        with self._cond:
+            self._buf.extend(data)
+            self._cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        with self._cond:
+            return len(self._buf)
+
+    def read(self, size=1):
+        deadline = time.time() + self.timeout
+        with self._cond:
+            while len(self._buf) < size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            data = bytes(self._buf[:size])
+            del self._buf[:size]
+            return data
+
+    def write(self, data):
+        self.written.append(data)
+
+class LegiListenerTests(unittest.TestCase):
+
+    def test_enable_only_after_frame(self):
+        from kaffi.legi import LegiListener
+        serial, receiver = Mock(), Mock()
+        listener = LegiListener(serial, b'on', receiver)
+        listener.feed(b'\x00\x01' + frame('123456')[:5])
+        self.assertFalse(serial.write.called)
+        listener.feed(frame('123456')[5:])
+        receiver.assert_called_once_with(b'123456')
+        serial.write.assert_called_once_with(b'on')
+
+    def test_frame_after_garbage_with_blocking_reads(self):
+        from kaffi.legi import LegiListener
+        serial = BlockingSerial(timeout=1)
+        legis = []
+        got_legi = threading.Event()
+        def receiver(legi):
+            legis.append(legi)
+            got_legi.set()
+        listener = LegiListener(serial, b'on', receiver)
+        thread = threading.Thread(target=listener.run)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 2)
+        self.addCleanup(listener.stop)
+        serial.arrive(b'\x01\x02\x03' + frame('123456'))
+        self.assertTrue(got_legi.wait(0.5))
+        # a frame arriving in pieces, the pause shorter than stale_after
+        got_legi.clear()
+        serial.arrive(frame('abcdef')[:6])
+        time.sleep(0.2)
+        serial.arrive(frame('abcdef')[6:])
+        self.assertTrue(got_legi.wait(0.5))
+        self.assertEqual(legis, [b'123456', b'abcdef'])
+        self.assertEqual(serial.written, [b'on'] * 3)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
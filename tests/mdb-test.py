@@ -2,8 +2,10 @@
 from __future__ import absolute_import
 
 import unittest
-from mock import Mock
 import binascii
+import random
+import threading
+import time
 import sys, os, os.path
 tohex = binascii.hexlify
 fromhex = binascii.unhexlify
@@ -12,106 +14,525 @@ class MdbL1StmEnabledTests(unittest.TestCase):
 
     def assertResponse(self, value, res):
         self.assertEqual(value[:len(res)+1], '\x00'+res)
-    def assertCalled(self, call_mock, *args, **kwargs):
-        self.assertEqual(call_mock.call_args, (args, kwargs))
 
     def setUp(self):
         from kaffi import mdb
-        self.status, self.dispensed, self.denied, self.info_o = Mock(), Mock(), Mock(), '_obj'
-        self.stm = mdb.MdbL1Stm(self.status, self.dispensed, self.denied)
+        self.stm = mdb.MdbL1Stm()
         self.stm._set_state(self.stm.st_enabled)
 
     def tearDown(self):
         self.stm = None
 
-    def test_dispense_polledclose(self):
-        self.status.return_value = (True, self.info_o)
+    def send(self, data):
+        return self.stm.received_data(self.stm.ACK + data)
 
-        res = self.stm.received_data(self.stm.CMD_POLL)
+    def vend(self):
+        ticket = self.stm.authorize()
+        res = self.send(self.stm.CMD_POLL)
         self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
+        res = self.send(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
         self.assertResponse(res, self.stm.RES_VEND_APPROVED+fromhex('FFFF'))
-        res = self.stm.received_data(self.stm.CMD_VEND_SUCCESS+fromhex('0001'))
-        self.assertCalled(self.dispensed, self.info_o, fromhex('0001'))
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_SESS_CANCEL_REQ)
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
-        self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertEqual(self.stm.current_dispense, None)
-
-    def test_dispense_autoclose(self):
-        self.status.return_value = (True, self.info_o)
+        res = self.send(self.stm.CMD_VEND_SUCCESS+fromhex('0001'))
+        self.assertEqual(res, self.stm.ACK)
+        self.assertEqual(ticket.state, ticket.SUCCEEDED)
+        self.assertEqual(ticket.item_data, fromhex('0001'))
+        return ticket
 
-        res = self.stm.received_data(self.stm.CMD_POLL)
+    def deny(self):
+        ticket = self.stm.authorize()
+        res = self.send(self.stm.CMD_POLL)
         self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
-        self.assertResponse(res, self.stm.RES_VEND_APPROVED+fromhex('FFFF'))
-        res = self.stm.received_data(self.stm.CMD_VEND_SUCCESS+fromhex('0001'))
-        self.assertCalled(self.dispensed, self.info_o, fromhex('0001'))
-        #self.dispensed.mockCheckCall(self, 0, "__call__", fromhex('0001'))
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
-        self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertEqual(self.stm.state, self.stm.st_enabled)
-        self.assertEqual(self.stm.current_dispense, None)
+        # the authorizing side gave up
+        self.assertTrue(ticket.expire())
+        res = self.send(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
+        self.assertResponse(res, self.stm.RES_VEND_DENIED)
+        self.assertEqual(self.stm.state, self.stm.st_session_ending)
 
-    def test_nodispense_polledclose(self):
-        self.status.return_value = (False, self.info_o)
+    def poll_until_cancel(self):
+        for i in range(12):
+            res = self.send(self.stm.CMD_POLL)
+            if res != self.stm.ACK:
+                self.assertResponse(res, self.stm.RES_SESS_CANCEL_REQ)
+                return
+        self.fail("session was not cancelled")
 
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
-        self.assertResponse(res, self.stm.RES_VEND_DENIED)
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_SESS_CANCEL_REQ)
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
+    def complete(self):
+        res = self.send(self.stm.CMD_VEND_SESS_COMPLETE)
         self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertCalled(self.denied, self.info_o)
-        #self.denied.mockCheckCall(self, 0, "__call__", None)
         self.assertEqual(self.stm.state, self.stm.st_enabled)
-        self.assertEqual(self.stm.current_dispense, None)
-
-    def test_nodispense_autoclose(self):
-        self.status.return_value = (False, self.info_o)
 
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
-        self.assertResponse(res, self.stm.RES_VEND_DENIED)
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
-        self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertCalled(self.denied, self.info_o)
+    def test_no_session_without_authorization(self):
+        self.assertEqual(self.send(self.stm.CMD_POLL), self.stm.ACK)
         self.assertEqual(self.stm.state, self.stm.st_enabled)
-        self.assertEqual(self.stm.current_dispense, None)
+
+    def test_dispense_polledclose(self):
+        self.vend()
+        self.poll_until_cancel()
+        self.complete()
+
+    def test_dispense_autoclose(self):
+        self.vend()
+        self.complete()
+
+    def test_nodispense_polledclose(self):
+        self.deny()
+        self.poll_until_cancel()
+        self.complete()
+
+    def test_nodispense_autoclose(self):
+        self.deny()
+        self.complete()
 
     def test_changedispense_autoclose(self):
-        self.status.return_value = (False, self.info_o)
-        res = self.stm.received_data(self.stm.CMD_POLL)
+        self.deny()
+        ticket = self.stm.authorize()
+        self.complete()
+        res = self.send(self.stm.CMD_POLL)
         self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
-        self.assertResponse(res, self.stm.RES_VEND_DENIED)
-        self.status.return_value = (True, self.info_o)
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
-        self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertCalled(self.denied, self.info_o)
-        #self.denied.mockCheckCall(self, 0, "__call__", None)
-        self.assertEqual(self.stm.state, self.stm.st_enabled)
-        self.assertEqual(self.stm.current_dispense, None)
+        self.assertTrue(ticket.activated is not None)
 
     def test_changedispense_polledclose(self):
-        self.status.return_value = (False, self.info_o)
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_BEGIN_SESS)
-        res = self.stm.received_data(self.stm.CMD_VEND_REQUEST+fromhex('0001'))
-        self.assertResponse(res, self.stm.RES_VEND_DENIED)
-        self.status.return_value = (True, self.info_o)
-        res = self.stm.received_data(self.stm.CMD_POLL)
-        self.assertResponse(res, self.stm.RES_SESS_CANCEL_REQ)
-        res = self.stm.received_data(self.stm.CMD_VEND_SESS_COMPLETE)
-        self.assertResponse(res, self.stm.RES_END_SESSION)
-        self.assertCalled(self.denied, self.info_o)
-        #self.denied.mockCheckCall(self, 0, "__call__", None)
+        self.deny()
+        self.stm.authorize()
+        # a new authorization does not revive the ending session
+        self.poll_until_cancel()
+        self.complete()
+
+class VendTicketTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import mdb
+        self.late = []
+        self.ticket = mdb.VendTicket(late_success_callback=self.late.append)
+
+    def later(self, delay, fn, *args):
+        timer = threading.Timer(delay, fn, args)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def test_succeeded(self):
+        self.ticket.activate()
+        self.later(0.05, self.ticket.approve)
+        self.later(0.1, self.ticket.succeed, fromhex('0001'))
+        self.assertEqual(self.ticket.wait(1, 1, 1), (True, fromhex('0001')))
+        self.assertEqual(self.ticket.state, self.ticket.SUCCEEDED)
+        self.assertEqual(self.late, [])
+
+    def test_failed(self):
+        self.ticket.activate()
+        self.assertTrue(self.ticket.approve())
+        self.later(0.05, self.ticket.fail)
+        self.assertEqual(self.ticket.wait(1, 1, 1), (False, None))
+        self.assertEqual(self.ticket.state, self.ticket.FAILED)
+
+    def test_queue_timeout(self):
+        start = time.time()
+        self.assertEqual(self.ticket.wait(1, 1, 0.05), (False, None))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEqual(self.ticket.state, self.ticket.EXPIRED)
+        self.assertFalse(self.ticket.approve())
+
+    def test_approve_timeout(self):
+        self.later(0.05, self.ticket.activate)
+        start = time.time()
+        self.assertEqual(self.ticket.wait(0.1, 1, 1), (False, None))
+        self.assertTrue(0.1 <= time.time() - start < 0.5)
+        self.assertEqual(self.ticket.state, self.ticket.EXPIRED)
+        self.assertFalse(self.ticket.approve())
+        # never approved, so a success for it is not billed
+        self.assertFalse(self.ticket.succeed(fromhex('0001')))
+        self.assertEqual(self.late, [])
+
+    def test_vend_timeout_and_late_success(self):
+        self.ticket.activate()
+        self.ticket.approve()
+        self.assertEqual(self.ticket.wait(1, 0.05, 1), (False, None))
+        self.assertEqual(self.ticket.state, self.ticket.EXPIRED)
+        self.assertTrue(self.ticket.succeed(fromhex('0002')))
+        self.assertEqual(self.ticket.state, self.ticket.SUCCEEDED)
+        self.assertTrue(self.ticket.late)
+        self.assertEqual(self.late, [self.ticket])
+        self.assertEqual(self.ticket.item_data, fromhex('0002'))
+        # reported once
+        self.assertFalse(self.ticket.succeed(fromhex('0002')))
+        self.assertEqual(self.late, [self.ticket])
+
+    def test_late_success_is_not_reported_by_wait(self):
+        self.ticket.activate()
+        self.ticket.approve()
+        self.ticket.fail()
+        self.ticket.succeed(fromhex('0001'))
+        self.assertEqual(self.ticket.wait(1, 1, 1), (False, None))
+        self.assertEqual(self.late, [self.ticket])
+
+class VendSequenceTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import mdb
+        self.stm = mdb.MdbL1Stm()
+        self.stm._set_state(self.stm.st_enabled)
+        self.late = []
+
+    def send(self, data):
+        return self.stm.received_data(self.stm.ACK + data)
+
+    def approve(self):
+        ticket = self.stm.authorize(self.late.append)
+        self.send(self.stm.CMD_POLL)
+        self.assertEqual(self.send(self.stm.CMD_VEND_REQUEST + fromhex('0001')),
+                         self.stm.ACK + self.stm.VEND_APPROVED_DATA)
+        self.assertEqual(ticket.state, ticket.APPROVED)
+        return ticket
+
+    def test_out_of_sequence_fails_vend(self):
+        ticket = self.approve()
+        self.assertEqual(self.send(self.stm.CMD_READER_ENABLE), self.stm.ACK + self.stm.RES_MALFUNCTION)
+        self.assertEqual(ticket.state, ticket.FAILED)
+        self.assertEqual(ticket.wait(0.1, 0.1, 0.1), (False, None))
+        # the reset that should follow
+        self.assertEqual(self.send(self.stm.CMD_RESET), self.stm.ACK + self.stm.RES_RESET)
+        self.assertEqual(self.stm.state, self.stm.st_inactive)
+        self.assertEqual(self.late, [])
+
+    def test_success_after_out_of_sequence_is_billed_late(self):
+        ticket = self.approve()
+        self.send(self.stm.CMD_READER_ENABLE)
+        self.assertEqual(self.send(self.stm.CMD_VEND_SUCCESS + fromhex('0003')), self.stm.ACK)
+        self.assertEqual(self.late, [ticket])
+        self.assertEqual(ticket.item_data, fromhex('0003'))
+        self.assertEqual(self.stm.state, self.stm.st_session_ending)
+
+    def test_success_after_vend_timeout_is_billed_late(self):
+        ticket = self.approve()
+        self.assertEqual(ticket.wait(0.1, 0.05, 0.1), (False, None))
+        self.send(self.stm.CMD_VEND_SUCCESS + fromhex('0001'))
+        self.assertEqual(self.late, [ticket])
+
+    def test_expired_ticket_is_not_offered(self):
+        ticket = self.stm.authorize()
+        ticket.expire()
+        self.assertEqual(self.stm._pending_auth, None)
+        self.assertEqual(self.send(self.stm.CMD_POLL), self.stm.ACK)
         self.assertEqual(self.stm.state, self.stm.st_enabled)
-        self.assertEqual(self.stm.current_dispense, None)
+
+class TicketQueueTests(unittest.TestCase):
+
+    def send(self, stm, data):
+        return stm.received_data(stm.ACK + data)
+
+    def enabled(self, **kwargs):
+        from kaffi import mdb
+        stm = mdb.MdbL1Stm(**kwargs)
+        stm._set_state(stm.st_enabled)
+        return stm
+
+    def test_single_vend_replaces_pending_authorization(self):
+        stm = self.enabled()
+        first = stm.authorize()
+        second = stm.authorize()
+        self.assertEqual(first.state, first.EXPIRED)
+        self.assertTrue(stm._pending_auth is second)
+        self.assertEqual(list(stm._tickets), [second])
+
+    def test_multi_vend_queue_is_bounded(self):
+        stm = self.enabled(multi_vend=True, max_tickets=2)
+        tickets = [stm.authorize() for i in range(3)]
+        self.assertEqual([t.state for t in tickets], ['pending', 'pending', 'expired'])
+        self.assertEqual(len(stm._tickets), 2)
+
+    def test_queued_tickets_expire_without_waiter(self):
+        stm = self.enabled(multi_vend=True)
+        first = stm.authorize()
+        second = stm.authorize(queue_timeout=0.05)
+        self.assertEqual(self.send(stm, stm.CMD_POLL), stm.ACK + stm.BEGIN_SESS_DATA)
+        self.send(stm, stm.CMD_VEND_REQUEST + fromhex('0001'))
+        self.assertEqual(first.state, first.APPROVED)
+        time.sleep(0.1)
+        # polls during the vend expire the queued ticket
+        self.send(stm, stm.CMD_POLL)
+        self.assertEqual(second.state, second.EXPIRED)
+        self.send(stm, stm.CMD_VEND_SUCCESS + fromhex('0001'))
+        self.assertEqual(stm.state, stm.st_session_ending)
+
+    def test_vend_timeout_without_waiter(self):
+        stm = self.enabled()
+        ticket = stm.authorize(vend_timeout=0.05)
+        self.send(stm, stm.CMD_POLL)
+        self.send(stm, stm.CMD_VEND_REQUEST + fromhex('0001'))
+        time.sleep(0.1)
+        self.send(stm, stm.CMD_POLL)
+        self.assertEqual(ticket.state, ticket.EXPIRED)
+
+    def test_multi_vend_session(self):
+        stm = self.enabled(multi_vend=True)
+        tickets = [stm.authorize() for i in range(2)]
+        self.send(stm, stm.CMD_POLL)
+        for ticket in tickets:
+            self.assertEqual(self.send(stm, stm.CMD_VEND_REQUEST + fromhex('0001')),
+                             stm.ACK + stm.VEND_APPROVED_DATA)
+            self.send(stm, stm.CMD_VEND_SUCCESS + fromhex('0001'))
+            self.assertEqual(ticket.state, ticket.SUCCEEDED)
+        self.assertEqual(stm.state, stm.st_session_ending)
+
+class FastPollTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import mdb
+        self.mdb = mdb
+        self.stm = mdb.MdbL1Stm()
+        self.poll = self.stm.ACK + self.stm.CMD_POLL
+
+    def fast(self):
+        return self.stm._fast_poll_token is not self.mdb._NO_FAST_POLL
+
+    def test_idle_poll_is_cached_until_authorized(self):
+        self.stm._set_state(self.stm.st_enabled)
+        self.assertFalse(self.fast())
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK)
+        self.assertTrue(self.fast())
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK)
+        self.stm.authorize()
+        # the token no longer matches, the poll begins a session
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK + self.stm.BEGIN_SESS_DATA)
+        self.assertEqual(self.stm.state, self.stm.st_session_idle)
+        self.assertFalse(self.fast())
+
+    def test_not_used_while_a_ticket_is_pending(self):
+        self.stm._set_state(self.stm.st_enabled)
+        ticket = self.stm.authorize(approve_timeout=0.05)
+        self.stm.received_data(self.poll)
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK)
+        # every poll checks the ticket's deadlines
+        self.assertFalse(self.fast())
+        time.sleep(0.1)
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK + self.stm.RES_SESS_CANCEL_REQ)
+        self.assertEqual(ticket.state, ticket.EXPIRED)
+        self.assertEqual(self.stm.state, self.stm.st_session_ending)
+
+    def test_dropped_on_state_change(self):
+        self.stm._set_state(self.stm.st_enabled)
+        self.stm.received_data(self.poll)
+        self.assertTrue(self.fast())
+        self.stm.received_data(self.stm.ACK + self.stm.CMD_READER_DISABLE)
+        self.assertFalse(self.fast())
+        self.stm.received_data(self.poll)
+        self.assertTrue(self.fast())
+        self.stm.received_data(self.stm.ACK + self.stm.CMD_RESET)
+        self.assertEqual(self.stm.state, self.stm.st_inactive)
+        self.assertFalse(self.fast())
+        self.stm.received_data(self.poll)
+        self.stm.received_nack()
+        self.assertFalse(self.fast())
+
+    def test_not_used_outside_fast_states(self):
+        # st_inactive answers the first poll with a reset
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK + self.stm.RES_RESET)
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK)
+        self.assertFalse(self.fast())
+        # st_vend waits for the vend result
+        self.stm._set_state(self.stm.st_enabled)
+        self.stm.authorize()
+        self.stm.received_data(self.poll)
+        self.stm.received_data(self.stm.ACK + self.stm.CMD_VEND_REQUEST + fromhex('0001'))
+        self.assertEqual(self.stm.state, self.stm.st_vend)
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK)
+        self.assertFalse(self.fast())
+        # st_session_ending counts polls down before cancelling
+        self.stm._set_state(self.stm.st_session_ending)
+        replies = [self.stm.received_data(self.poll) for i in range(11)]
+        self.assertFalse(self.fast())
+        self.assertEqual(replies[:10], [self.stm.ACK] * 10)
+        self.assertEqual(replies[10], self.stm.ACK + self.stm.RES_SESS_CANCEL_REQ)
+
+    def test_not_used_with_response_data(self):
+        self.stm._set_state(self.stm.st_enabled)
+        self.stm.received_data(self.poll)
+        self.stm.response_data = self.stm.RES_CANCELLED
+        self.assertEqual(self.stm.received_data(self.poll), self.stm.ACK + self.stm.RES_CANCELLED)
+
+    def test_same_replies_as_slow_path(self):
+        from kaffi import mdb
+        class SlowStm(mdb.MdbL1Stm):
+            _FAST_POLL_STATES = frozenset()
+        fast, slow = self.stm, SlowStm()
+        rnd = random.Random(1)
+        tickets = []
+        commands = [self.stm.CMD_POLL] * 8 + [self.stm.CMD_READER_ENABLE, self.stm.CMD_READER_DISABLE,
+                    self.stm.CMD_VEND_REQUEST + fromhex('0001'), self.stm.CMD_VEND_SUCCESS + fromhex('0001'),
+                    self.stm.CMD_VEND_SESS_COMPLETE, self.stm.CMD_RESET]
+        for step in range(2000):
+            action = rnd.random()
+            if action < 0.05:
+                tickets.append((fast.authorize(), slow.authorize()))
+            elif action < 0.08 and tickets:
+                for ticket in rnd.choice(tickets):
+                    ticket.expire()
+            else:
+                data = self.stm.ACK + rnd.choice(commands)
+                self.assertEqual(fast.received_data(data), slow.received_data(data), step)
+            self.assertEqual(fast.state.__name__, slow.state.__name__)
+
+class ChainedMdbL1Stm(object):
+    """
+    The states of MdbL1Stm written as chains of is_command() tests in the
+    order the state machine used before the dispatch tables, calling the same
+    handlers. Used as reference for the tables.
+    """
+
+    def default_handler(self, data):
+        if self.is_command(data, self.CMD_SETUP_CONF_DATA):
+            return self._setup_conf_data(data)
+        elif self.is_command(data, self.CMD_SETUP_MAXMIN_PRICE):
+            return self._setup_maxmin_price(data)
+        elif self.is_command(data, self.CMD_EXP_REQUEST_ID):
+            return self._request_id(data)
+        else:
+            return self._out_of_sequence(data)
+
+    def st_inactive(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return self._inactive_poll(data)
+        elif self.is_command(data, self.CMD_READER_ENABLE):
+            return self._enable(data)
+        elif self.is_command(data, self.CMD_RESET):
+            return self._inactive_reset(data)
+        else:
+            return self.default_handler(data)
+
+    def st_disabled(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return
+        elif self.is_command(data, self.CMD_RESET):
+            return self._reset(data)
+        elif self.is_command(data, self.CMD_READER_ENABLE):
+            return self._enable(data)
+        else:
+            return self.default_handler(data)
+
+    def st_enabled(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return self._enabled_poll(data)
+        elif self.is_command(data, self.CMD_READER_DISABLE):
+            return self._disable(data)
+        elif self.is_command(data, self.CMD_READER_CANCEL):
+            return self._enabled_reader_cancel(data)
+        elif self.is_command(data, self.CMD_RESET):
+            return self._reset(data)
+        elif self.is_command(data, self.CMD_SETUP_CONF_DATA):
+            return self._enabled_setup_conf_data(data)
+        else:
+            return self.default_handler(data)
+
+    def st_session_idle(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return self._session_idle_poll(data)
+        elif self.is_command(data, self.CMD_VEND_REQUEST):
+            return self._session_idle_vend_request(data)
+        elif self.is_command(data, self.CMD_VEND_CANCEL):
+            return self._session_vend_cancel(data)
+        elif self.is_command(data, self.CMD_VEND_SESS_COMPLETE):
+            return self._session_complete(data)
+        elif self.is_command(data, self.CMD_READER_CANCEL):
+            return self._session_reader_cancel(data)
+        elif self.is_command(data, self.CMD_RESET):
+            return self._reset(data)
+        else:
+            return self._out_of_sequence(data)
+
+    def st_session_ending(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return self._session_ending_poll(data)
+        elif self.is_command(data, self.CMD_VEND_SESS_COMPLETE):
+            return self._session_complete(data)
+        elif self.is_command(data, self.CMD_VEND_REQUEST):
+            return self._session_ending_vend_request(data)
+        elif self.is_command(data, self.CMD_VEND_CANCEL):
+            return self._session_vend_cancel(data)
+        elif self.is_command(data, self.CMD_READER_CANCEL):
+            return self._session_reader_cancel(data)
+        elif self.is_command(data, self.CMD_VEND_SUCCESS):
+            return self._session_ending_vend_success(data)
+        elif self.is_command(data, self.CMD_RESET):
+            return self._reset(data)
+        else:
+            return self._out_of_sequence(data)
+
+    def st_vend(self, data):
+        if self.is_command(data, self.CMD_POLL):
+            return
+        elif self.is_command(data, self.CMD_VEND_FAILURE):
+            return self._vend_failure(data)
+        elif self.is_command(data, self.CMD_VEND_CANCEL):
+            return self._vend_cancel(data)
+        elif self.is_command(data, self.CMD_VEND_SUCCESS):
+            return self._vend_success(data)
+        elif self.is_command(data, self.CMD_RESET):
+            return self._vend_reset(data)
+        else:
+            return self._vend_out_of_sequence(data)
+
+class DispatchTableTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import mdb
+        self.mdb = mdb
+        self.commands = [value for name, value in vars(mdb.MdbL1Stm).items()
+                         if name.startswith('CMD_')]
+        self.reference_class = type('Reference', (ChainedMdbL1Stm, mdb.MdbL1Stm), {})
+
+    def random_command(self, rnd):
+        kind = rnd.random()
+        if kind < 0.05:
+            return ''.join(chr(rnd.randrange(256)) for i in range(rnd.randint(1, 4)))
+        command = rnd.choice(self.commands)
+        if kind < 0.2:
+            # the alias of the command byte
+            command = chr(ord(command[0]) + 50) + command[1:]
+        if kind > 0.8:
+            command += ''.join(chr(rnd.randrange(256)) for i in range(rnd.randint(1, 4)))
+        return command
+
+    def run_both(self, seed, steps=500):
+        rnd = random.Random(seed)
+        tables = self.mdb.MdbL1Stm(multi_vend=rnd.random() < 0.5)
+        chains = self.reference_class(multi_vend=tables.multi_vend)
+        for stm in (tables, chains):
+            stm.tickets = []
+        for step in range(steps):
+            action = rnd.random()
+            if action < 0.1:
+                for stm in (tables, chains):
+                    stm.tickets.append(stm.authorize())
+            elif action < 0.15 and tables.tickets:
+                i = rnd.randrange(len(tables.tickets))
+                for stm in (tables, chains):
+                    stm.tickets[i].expire()
+            elif action < 0.17:
+                for stm in (tables, chains):
+                    stm.received_nack()
+            else:
+                data = self.random_command(rnd)
+                responses = [stm.received_data(stm.ACK + data) for stm in (tables, chains)]
+                self.assertEqual(responses[0], responses[1],
+                                 "seed %s step %d: %s answered with %s instead of %s" %
+                                 (seed, step, tohex(data), tohex(responses[0]), tohex(responses[1])))
+            self.assertEqual(tables.state.__name__, chains.state.__name__)
+            self.assertEqual([t.state for t in tables.tickets], [t.state for t in chains.tickets])
+            self.assertEqual((tables.maxmin_data, tables.item_data, tables.cancel_countdown),
+                             (chains.maxmin_data, chains.item_data, chains.cancel_countdown))
+
+    def test_tables_match_chained_commands(self):
+        for seed in range(50):
+            self.run_both(seed)
+
+    def test_aliases_and_subcommands(self):
+        stm = self.mdb.MdbL1Stm()
+        # +50 alias of the command byte, subcommand kept
+        self.assertEqual(stm.received_data(stm.ACK + fromhex('44')), stm.ACK + stm.RES_RESET)
+        self.assertEqual(stm.received_data(stm.ACK + fromhex('43') + fromhex('00') + fromhex('01')),
+                         stm.ACK + stm.READER_CONF_DATA)
+        # unknown subcommand falls back to the state's default
+        self.assertEqual(stm.received_data(stm.ACK + fromhex('1109')), stm.ACK + stm.RES_MALFUNCTION)
 
 if __name__ == '__main__':
     sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
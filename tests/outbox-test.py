@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import tempfile
+import shutil
+import threading
+import sys, os, os.path
+
+class OutboxTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'outbox.log')
+        self.delivered = []
+        self.down = set()
+
+    def deliver(self, record):
+        if record['n'] in self.down:
+            raise IOError("backend down")
+        self.delivered.append(record['n'])
+
+    def open(self, **kwargs):
+        from kaffi.outbox import Outbox
+        return Outbox(self.path, self.deliver, base_delay=0.01, **kwargs)
+
+    def test_delivers_in_order(self):
+        box = self.open()
+        for n in range(5):
+            box.put({'n': n})
+        self.assertTrue(box.flush(5))
+        self.assertEqual(self.delivered, list(range(5)))
+
+    def test_retries_failed_records(self):
+        box = self.open()
+        self.down.add(1)
+        for n in range(3):
+            box.put({'n': n})
+        timer = threading.Timer(0.2, self.down.clear)
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertTrue(box.flush(5))
+        self.assertEqual(self.delivered, [0, 2, 1])
+        self.assertTrue(box.failures >= 2)
+
+    def test_undelivered_records_survive_restart(self):
+        box = self.open()
+        self.down.update([1, 2])
+        for n in range(3):
+            box.put({'n': n})
+        while not self.delivered:
+            box.flush(0.01)
+        box.stop()
+        with open(self.path, 'ab') as f:
+            # a record cut off by a crash
+            f.write(b'{"id": 7, "rec')
+        self.down.clear()
+        self.delivered = []
+        box = self.open()
+        self.assertEqual(len(box), 2)
+        box.put({'n': 3})
+        self.assertTrue(box.flush(5))
+        self.assertEqual(self.delivered, [1, 2, 3])
+        box.stop()
+        self.assertEqual(len(self.open()), 0)
+
+    def test_compaction(self):
+        box = self.open(compact_after=3)
+        self.down.add(0)
+        for n in range(4):
+            box.put({'n': n})
+        while len(self.delivered) < 3:
+            box.flush(0.01)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(len(f.readlines()), 1)
+        self.down.clear()
+        self.assertTrue(box.flush(5))
+        self.assertEqual(len(self.open()), 0)
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.batches = []
+
+    def deliver_batch(self, key, records):
+        self.batches.append((key, [r['n'] for r in records]))
+        # 3 fails the first time
+        return [r for r in records if r['n'] == 3 and len(self.batches) == 1]
+
+    def test_batches_per_key(self):
+        from kaffi.outbox import Outbox
+        box = Outbox(os.path.join(self.dir, 'outbox.log'), None, base_delay=0.01,
+                     deliver_batch=self.deliver_batch, batch_key=lambda r: r['org'],
+                     batch_size=3, flush_window=0.2)
+        for n, org in enumerate(['VIS', 'AMIV', 'AMIV', 'AMIV', 'VIS']):
+            box.put({'n': n, 'org': org})
+        self.assertTrue(box.flush(5))
+        self.assertEqual(sorted(self.batches), [('AMIV', [1, 2, 3]), ('AMIV', [3]), ('VIS', [0, 4])])
+        stats = box.stats['AMIV']
+        self.assertEqual((stats.batches, stats.records, stats.failed, stats.max_batch), (2, 4, 1, 3))
+        self.assertTrue(box.stats['VIS'].wait_max >= 0.15)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import time
+import sys, os, os.path
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import pool
+        self.pool = pool.WorkerPool(2, name="test")
+        self.addCleanup(self.pool.stop)
+
+    def test_submit_returns_value(self):
+        result = self.pool.submit(lambda a, b=0: a + b, 1, b=2)
+        self.assertEqual(result.result(2), 3)
+        self.assertTrue(result.done())
+        self.assertEqual(result.value, 3)
+
+    def test_exception_is_propagated(self):
+        def fail():
+            raise KeyError('x')
+        result = self.pool.submit(fail)
+        self.assertTrue(result.wait(2))
+        self.assertRaises(KeyError, result.result)
+        self.assertTrue(result.exc_info[0] is KeyError)
+        # the worker survives
+        self.assertEqual(self.pool.submit(lambda: 1).result(2), 1)
+
+    def test_result_timeout(self):
+        from kaffi import pool
+        release = threading.Event()
+        self.addCleanup(release.set)
+        result = self.pool.submit(release.wait, 5)
+        self.assertFalse(result.wait(0.05))
+        self.assertRaises(pool.TimeoutError, result.result, 0.05)
+        release.set()
+        self.assertEqual(result.result(2), True)
+
+    def test_jobs_run_concurrently(self):
+        started = [threading.Event(), threading.Event()]
+        def meet(i):
+            # only returns True if the other job runs at the same time
+            started[i].set()
+            return started[1 - i].wait(2)
+        results = [self.pool.submit(meet, i) for i in range(2)]
+        self.assertEqual([r.result(5) for r in results], [True, True])
+
+    def test_done_callbacks(self):
+        called = []
+        release = threading.Event()
+        result = self.pool.submit(release.wait, 5)
+        result.add_done_callback(lambda r: called.append(('before', r.value)))
+        release.set()
+        result.wait(2)
+        result.add_done_callback(lambda r: called.append(('after', r.value)))
+        self.assertEqual(called, [('before', True), ('after', True)])
+
+    def test_failing_callback_does_not_break_others(self):
+        from kaffi import pool
+        result = pool.Result()
+        called = []
+        result.add_done_callback(lambda r: 1 / 0)
+        result.add_done_callback(lambda r: called.append(r.value))
+        result.set(5)
+        self.assertEqual(called, [5])
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import time
+import sys, os, os.path
+
+class ReactorTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import reactor
+        self.reactor = reactor.Reactor()
+        self.thread = threading.Thread(target=self.reactor.run)
+        self.thread.daemon = True
+        self.addCleanup(self.thread.join, 2)
+        self.addCleanup(self.reactor.stop)
+
+    def start(self):
+        self.thread.start()
+
+    def test_add_reader(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        read = []
+        done = threading.Event()
+        def on_readable():
+            read.append(os.read(r, 10))
+            done.set()
+        self.reactor.add_reader(r, on_readable)
+        self.start()
+        os.write(w, b'abc')
+        self.assertTrue(done.wait(2))
+        self.assertEqual(read, [b'abc'])
+        self.assertTrue(threading.current_thread() is not self.reactor.thread)
+
+    def test_remove_reader(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        called = []
+        self.reactor.add_reader(r, called.append, 1)
+        self.reactor.remove_reader(r)
+        self.start()
+        os.write(w, b'x')
+        time.sleep(0.1)
+        self.assertEqual(called, [])
+
+    def test_call_later_in_order(self):
+        fired = []
+        done = threading.Event()
+        self.reactor.call_later(0.1, fired.append, 'b')
+        self.reactor.call_later(0.05, fired.append, 'a')
+        self.reactor.call_later(0.2, done.set)
+        self.reactor.call_later(0.05, fired.append, 'cancelled').cancel()
+        start = time.time()
+        self.start()
+        self.assertTrue(done.wait(2))
+        self.assertTrue(time.time() - start >= 0.15)
+        self.assertEqual(fired, ['a', 'b'])
+
+    def test_call_soon_threadsafe_runs_on_loop_thread(self):
+        threads = []
+        done = threading.Event()
+        self.start()
+        def callback():
+            threads.append(threading.current_thread())
+            done.set()
+        self.reactor.call_soon_threadsafe(callback)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(threads, [self.thread])
+
+    def test_run_in_executor_calls_back_on_loop_thread(self):
+        got = []
+        done = threading.Event()
+        def callback(result):
+            got.append((result.value, threading.current_thread()))
+            done.set()
+        self.start()
+        self.reactor.run_in_executor(lambda a: a * 2, (21,), callback)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(got, [(42, self.thread)])
+
+    def test_failing_callback_keeps_loop_running(self):
+        done = threading.Event()
+        self.start()
+        self.reactor.call_soon_threadsafe(lambda: 1 / 0)
+        self.reactor.call_soon_threadsafe(done.set)
+        self.assertTrue(done.wait(2))
+        self.assertTrue(self.reactor.running)
+
+    def test_stop(self):
+        self.start()
+        self.reactor.stop()
+        self.thread.join(2)
+        self.assertFalse(self.thread.is_alive())
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import time
+import sys, os, os.path
+
+class LogWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.written = []
+        self.spilled = []
+        self.block = threading.Event()
+        self.block.set()
+        self.addCleanup(self.block.set)
+
+    def write(self, rows):
+        self.block.wait(5)
+        self.written.append(list(rows))
+
+    def writer(self, **kwargs):
+        from kaffi.sqllogging import LogWriter
+        return LogWriter(self.write, self.spilled.extend, **kwargs)
+
+    def test_batches_by_size_and_time(self):
+        w = self.writer(batch_size=3, flush_interval=0.2)
+        for i in range(4):
+            w.put('INFO', str(i))
+        time.sleep(0.1)
+        self.assertEqual(self.written, [[('INFO', '0'), ('INFO', '1'), ('INFO', '2')]])
+        time.sleep(0.3)
+        self.assertEqual(self.written[1:], [[('INFO', '3')]])
+        self.assertEqual((w.written, w.batches), (4, 2))
+
+    def test_put_does_not_block(self):
+        self.block.clear()
+        w = self.writer(batch_size=1, max_queue=2)
+        start = time.time()
+        for i in range(10):
+            w.put('INFO', str(i))
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertTrue(w.dropped >= 7)
+        self.block.set()
+        self.assertTrue(w.flush(5))
+        self.assertEqual(self.written[-1], [('INFO', '9')])
+
+    def test_spill_on_overflow_and_failure(self):
+        self.block.clear()
+        w = self.writer(batch_size=1, max_queue=1, overflow='spill')
+        w.put('INFO', 'a')
+        # wait for the writer to take 'a'
+        while w._rows:
+            time.sleep(0.01)
+        w.put('INFO', 'b')
+        w.put('INFO', 'c')
+        self.assertEqual(self.spilled, [('INFO', 'b')])
+        w.write = None
+        self.block.set()
+        self.assertTrue(w.flush(5))
+        self.assertEqual(self.spilled, [('INFO', 'b'), ('INFO', 'c')])
+
+class SpoolTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile, shutil
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'sqllog.spool')
+        self.written = []
+        self.down = False
+
+    def write(self, rows):
+        if self.down:
+            raise IOError("database down")
+        self.written.append(list(rows))
+
+    def spool(self):
+        from kaffi.sqllogging import Spool
+        return Spool(self.path)
+
+    def test_replay_and_truncate(self):
+        self.down = False
+        spool = self.spool()
+        spool.append([('INFO', u'caf\xe9'), ('ERROR', 'b')])
+        spool.append([('INFO', 'c')])
+        spool.sync()
+        self.assertTrue(spool.pending())
+        spool.replay(self.write, batch_size=2)
+        self.assertEqual(self.written, [[('INFO', u'caf\xe9'), ('ERROR', 'b')], [('INFO', 'c')]])
+        self.assertFalse(spool.pending())
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_rows_survive_restart_and_failed_replay(self):
+        self.down = True
+        spool = self.spool()
+        spool.append([('INFO', str(i)) for i in range(5)])
+        spool.sync()
+        self.assertRaises(IOError, spool.replay, self.write)
+        spool.append([('INFO', 'late')])
+        spool.sync()
+        # a row cut off by a crash
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00\x00\x00\x20["INFO"')
+        self.down = False
+        spool = self.spool()
+        spool.replay(self.write)
+        spool.replay(self.write)
+        self.assertEqual(self.written, [[('INFO', str(i)) for i in range(5)], [('INFO', 'late')]])
+        self.assertFalse(spool.pending())
+
+    def test_writer_spools_and_replays(self):
+        from kaffi.sqllogging import LogWriter
+        self.down = True
+        w = LogWriter(self.write, spool=self.spool(), batch_size=2, flush_interval=0.05)
+        for i in range(3):
+            w.put('INFO', str(i))
+        self.assertTrue(w.flush(5))
+        self.assertEqual((w.spilled, w.spool.spooled), (3, 3))
+        self.down = False
+        w.replay_soon()
+        deadline = time.time() + 5
+        while w.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.written, [[('INFO', '0'), ('INFO', '1'), ('INFO', '2')]])
+
+    def wait_replayed(self, w):
+        deadline = time.time() + 5
+        while w.spool.pending() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(w.flush(5))
+
+    def test_replay_in_chunks(self):
+        spool = self.spool()
+        spool.append([('INFO', str(i)) for i in range(5)])
+        self.assertFalse(spool.replay(self.write, 2, 1))
+        spool.append([('INFO', 'new')])
+        self.assertFalse(spool.replay(self.write, 2, 1))
+        self.assertTrue(spool.replay(self.write, 2, 1))
+        self.assertEqual(self.written, [[('INFO', '0'), ('INFO', '1')], [('INFO', '2'), ('INFO', '3')],
+                                        [('INFO', '4')]])
+        self.assertTrue(spool.pending())
+        self.assertTrue(spool.replay(self.write, 2, 1))
+        self.assertEqual(self.written[-1], [('INFO', 'new')])
+        self.assertFalse(spool.pending())
+
+    def test_new_rows_between_replayed_batches(self):
+        from kaffi.sqllogging import LogWriter
+        spool = self.spool()
+        spool.append([('INFO', 'r%d' % i) for i in range(6)])
+        def write(rows):
+            self.write(rows)
+            if rows[0] == ('INFO', 'r0'):
+                w.put('INFO', 'new')
+        w = LogWriter(write, spool=spool, flush_interval=10, replay_batch_size=2)
+        w.put('INFO', 'first')
+        w.replay_soon()
+        self.wait_replayed(w)
+        self.assertEqual(self.written, [[('INFO', 'first')], [('INFO', 'r0'), ('INFO', 'r1')],
+                                        [('INFO', 'new')], [('INFO', 'r2'), ('INFO', 'r3')],
+                                        [('INFO', 'r4'), ('INFO', 'r5')]])
+
+    def test_overflow_is_spooled_while_replay_pending(self):
+        from kaffi.sqllogging import LogWriter
+        spool = self.spool()
+        spool.append([('INFO', 'old')])
+        release = threading.Event()
+        self.addCleanup(release.set)
+        def write(rows):
+            release.wait(5)
+            self.write(rows)
+        w = LogWriter(write, spool=spool, batch_size=1, max_queue=1)
+        w.put('INFO', 'a')
+        while w._rows:
+            time.sleep(0.01)
+        w.put('INFO', 'b')
+        w.put('INFO', 'c')
+        self.assertEqual((w.dropped, spool.spooled), (0, 2))
+        release.set()
+        self.wait_replayed(w)
+        rows = sum(self.written, [])
+        self.assertEqual(sorted(rows), [('INFO', x) for x in ('a', 'b', 'c', 'old')])
+
+class ReconnectTests(unittest.TestCase):
+
+    def test_backoff_with_jitter(self):
+        from kaffi import sqllogging
+        import mock
+        from sqlalchemy import exc
+        config = mock.Mock()
+        delays = []
+        # the timer thread must only hand the blocking connect to a worker
+        calls = []
+        error = exc.OperationalError("connect", {}, Exception("down"))
+        with mock.patch.object(sqllogging, 'config', config), \
+                mock.patch.object(sqllogging, 'create_engine', side_effect=error), \
+                mock.patch.object(sqllogging.timers, 'call_later',
+                                  side_effect=lambda delay, *args: delays.append(delay) or calls.append(args)), \
+                mock.patch.object(sqllogging, 'reconnect_timer', None), \
+                mock.patch.object(sqllogging, 'retry_delay', None):
+            for i in range(8):
+                sqllogging.try_connect(60, 5)
+        self.assertEqual(calls[0][:2], (sqllogging._connector.submit, sqllogging.try_connect))
+        for delay, limit in zip(delays, [5, 10, 20, 40, 60, 60, 60, 60]):
+            self.assertTrue(limit / 2.0 <= delay <= limit, (delay, limit))
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import time
+import sys, os, os.path
+
+class CheckLegiTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import status
+        self.status = status
+        self.org_handlers = status.org_handlers
+        status.ranking = status.OrgRanking()
+        status.breakers.clear()
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+
+    def tearDown(self):
+        self.status.org_handlers = self.org_handlers
+
+    def handler(self, answer, delay=0, block=False):
+        def get_status(leginr, timeout=None):
+            if block:
+                self.release.wait(5)
+            time.sleep(delay)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        return get_status, None
+
+    def set_handlers(self, *handlers):
+        import ordereddict
+        self.status.org_handlers = ordereddict.OrderedDict(
+            ('ORG%d' % i, h) for i, h in enumerate(handlers))
+
+    def test_priority_order(self):
+        self.set_handlers(self.handler(False, 0.2), self.handler(True, 0.1), self.handler(True))
+        for parallel in (True, False):
+            self.assertEqual(self.status.check_legi('123456', parallel, False), 'ORG1')
+        self.set_handlers(self.handler(ValueError()), self.handler(False))
+        for parallel in (True, False):
+            self.assertEqual(self.status.check_legi('123456', parallel, False), None)
+
+    def test_failed_lookup_is_not_certain(self):
+        self.set_handlers(self.handler(ValueError()), self.handler(False))
+        self.assertEqual(self.status.lookup_legi('123456', True), (None, False))
+        self.set_handlers(self.handler(ValueError()), self.handler(True))
+        self.assertEqual(self.status.lookup_legi('123456', False), ('ORG1', True))
+
+    def options(self, **values):
+        import mock
+        option = self.status._option
+        patcher = mock.patch.object(self.status, '_option',
+                side_effect=lambda name, default: values.get(name, option(name, default)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def snapshot(self):
+        import tempfile, shutil
+        from kaffi.authstore import AuthStore
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        self.status._snapshot = AuthStore(os.path.join(tmp, 'auth.db'))
+        self.addCleanup(setattr, self.status, '_snapshot', None)
+
+    def test_snapshot_answers_on_failure(self):
+        self.snapshot()
+        self.set_handlers(self.handler(False), self.handler(True))
+        self.assertEqual(self.status.lookup_with_snapshot('123456', True), ('ORG1', True))
+        self.status._snapshot.flush(5)
+        self.set_handlers(self.handler(ValueError()), self.handler(ValueError()))
+        self.assertEqual(self.status.lookup_with_snapshot('123456', True), ('ORG1', False))
+        self.assertEqual(self.status.lookup_with_snapshot('654321', True), (None, False))
+
+    def test_snapshot_timeout_without_entry(self):
+        self.snapshot()
+        self.options(snapshot_timeout=0.1)
+        # slower than snapshot_timeout, the snapshot has nothing to answer with
+        self.set_handlers(self.handler(False), self.handler(True, 0.3))
+        self.assertEqual(self.status.lookup_with_snapshot('123456', True), ('ORG1', True))
+        self.status._snapshot.flush(5)
+        # now it has
+        start = time.time()
+        self.assertEqual(self.status.lookup_with_snapshot('123456', True), ('ORG1', False))
+        self.assertTrue(time.time() - start < 0.3)
+
+    def adaptive(self):
+        self.options(adaptive=True)
+
+    def test_adaptive_order(self):
+        self.adaptive()
+        asked = []
+        members = {0: '', 1: 'b', 2: 'acd'}
+        def handler(org):
+            def get_status(leginr, timeout=None):
+                asked.append(org)
+                return leginr in members[org]
+            return get_status, None
+        self.set_handlers(handler(0), handler(1), handler(2))
+        for legi in 'aa':
+            self.assertEqual(self.status.check_legi(legi, False, False), 'ORG2')
+        # ORG0 and ORG1 said no about 'a' and are not asked again for now
+        self.assertEqual(asked, [0, 1, 2, 2])
+        del asked[:]
+        # ORG2 answered most often
+        self.assertEqual(self.status.check_legi('c', False, False), 'ORG2')
+        self.assertEqual(asked, [2, 0, 1])
+        # a member of several orgs is billed to the first in priority order
+        members[0] = 'd'
+        del asked[:]
+        self.assertEqual(self.status.check_legi('d', False, False), 'ORG0')
+        self.assertEqual(asked, [2, 0])
+        # and orgs after it are not asked again
+        del asked[:]
+        self.assertEqual(self.status.check_legi('d', False, False), 'ORG0')
+        self.assertEqual(asked, [0])
+
+    def test_adaptive_lookups_per_swipe(self):
+        self.now = 0
+        self.status.ranking = self.status.OrgRanking(negative_ttl=60, clock=lambda: self.now)
+        asked = []
+        members = {0: 'x', 1: 'y', 2: 'abcz'}
+        def handler(org):
+            def get_status(leginr, timeout=None):
+                asked.append(org)
+                return leginr in members[org]
+            return get_status, None
+        self.set_handlers(handler(0), handler(1), handler(2))
+        swipes = 'abcabcabcz'
+        def count():
+            del asked[:]
+            for legi in swipes:
+                self.assertEqual(self.status.check_legi(legi, False, False), 'ORG2')
+                self.now += 1
+            return len(asked)
+        fixed = count()
+        self.assertEqual(fixed, 3 * len(swipes))
+        self.adaptive()
+        # the first swipe of each legi asks every org, the others ORG2 only
+        self.assertEqual(count(), 3 * 4 + len(swipes) - 4)
+        self.assertEqual(count(), len(swipes))
+        # once the noes are older than negative_ttl the orgs before ORG2 are
+        # asked again, so a legi that joined one of them is billed there
+        members[0] += 'a'
+        self.now += 60
+        del asked[:]
+        self.assertEqual(self.status.check_legi('a', False, False), 'ORG0')
+        self.assertEqual(asked, [2, 0])
+
+    def test_adaptive_keeps_org_when_uncertain(self):
+        self.adaptive()
+        self.status.ranking.record('123456', 'ORG2', ['ORG0', 'ORG1'])
+        self.status.ranking.record('123456', None, [], certain=False)
+        self.assertEqual(self.status.ranking.order('123456', ['ORG0', 'ORG1', 'ORG2']), ['ORG2'])
+        self.status.ranking.record('123456', None, ['ORG2'])
+        self.assertEqual(self.status.ranking.order('123456', ['ORG0', 'ORG1', 'ORG2']), [])
+
+    def test_parallel_answer_ignores_ranking(self):
+        self.adaptive()
+        self.status.ranking.record('123456', 'ORG1')
+        self.set_handlers(self.handler(True, 0.1), self.handler(True))
+        self.assertEqual(self.status.check_legi('123456', True, False), 'ORG0')
+
+    def test_not_adaptive_by_default(self):
+        self.status.ranking.record('123456', 'ORG1')
+        asked = []
+        def handler(org):
+            def get_status(leginr, timeout=None):
+                asked.append(org)
+                return org == 1
+            return get_status, None
+        self.set_handlers(handler(0), handler(1), handler(2))
+        self.assertEqual(self.status.check_legi('123456', False, False), 'ORG1')
+        self.assertEqual(asked, [0, 1])
+
+    def test_deadline(self):
+        self.set_handlers(self.handler(False, block=True), self.handler(False))
+        start = time.time()
+        self.assertEqual(self.status.lookup_legi('123456', True, 0.2), (None, False))
+        self.assertTrue(time.time() - start < 0.5)
+        # sequential lookups get the time that is left
+        timeouts = []
+        def slow(leginr, timeout=None):
+            timeouts.append(timeout)
+            time.sleep(timeout)
+        self.set_handlers((slow, None), (slow, None))
+        self.assertEqual(self.status.lookup_legi('123456', False, 0.2), (None, False))
+        self.assertEqual(len(timeouts), 1)
+
+    def test_open_breaker_is_skipped(self):
+        asked = []
+        def failing(leginr, timeout=None):
+            asked.append(leginr)
+            raise IOError("down")
+        self.set_handlers((failing, None), self.handler(False))
+        for i in range(5):
+            self.assertEqual(self.status.check_legi('123456', False, False), None)
+        self.assertEqual(len(asked), 3)
+        self.assertEqual(self.status.breakers['ORG0'].state, 'open')
+
+    def test_lookups_run_at_once(self):
+        self.set_handlers(*[self.handler(i == 2, 0.2) for i in range(3)])
+        start = time.time()
+        self.assertEqual(self.status.check_legi('123456', True, False), 'ORG2')
+        self.assertTrue(time.time() - start < 0.5)
+
+    def test_slower_orgs_are_abandoned(self):
+        self.set_handlers(self.handler(True), self.handler(False, block=True))
+        start = time.time()
+        self.assertEqual(self.status.check_legi('123456', True, False), 'ORG0')
+        self.assertTrue(time.time() - start < 1)
+
+class DeliverDispenseTests(unittest.TestCase):
+
+    def test_log_records_are_written_synchronously(self):
+        import mock
+        from kaffi import status, sqllogging
+        records = [dict(kind='log', org='VIS', legi='1', item=2), dict(kind='log', org='VIS', legi='3', item=4)]
+        with mock.patch.object(sqllogging, 'write_rows') as write_rows, \
+                mock.patch.object(sqllogging, 'log_msg') as log_msg:
+            self.assertEqual(status.deliver_dispenses(('log', 'VIS'), records), [])
+            status.deliver_dispense(records[0])
+        self.assertEqual(write_rows.call_args_list,
+                         [mock.call([('DISPENSE', 'VIS:1:2'), ('DISPENSE', 'VIS:3:4')]),
+                          mock.call([('DISPENSE', 'VIS:1:2')])])
+        self.assertFalse(log_msg.called)
+
+    def test_log_records_fail_without_database(self):
+        from kaffi import status, sqllogging
+        self.assertTrue(sqllogging.log_dbengine is None)
+        record = dict(kind='log', org='VIS', legi='1', item=2)
+        self.assertRaises(IOError, status.deliver_dispenses, ('log', 'VIS'), [record])
+        self.assertRaises(IOError, status.deliver_dispense, record)
+
+    def test_batch_returns_exactly_the_failed_records(self):
+        import mock
+        from kaffi import status, amivstatus
+        records = [dict(kind='bill', org='AMIV', legi='1', item=2) for i in range(3)]
+        engine = mock.Mock()
+        with mock.patch.object(amivstatus, 'get_nethz', side_effect=[IOError("amivid down"), 'n1', 'n1']), \
+                mock.patch.object(amivstatus, 'get_connection', return_value=engine):
+            failed = status.deliver_dispenses(('bill', 'AMIV'), records)
+        # the same legi and item three times, only the first is billed again
+        self.assertEqual(len(failed), 1)
+        self.assertTrue(failed[0] is records[0])
+        self.assertEqual(len(engine.execute.call_args[0][1]), 2)
+
+class CircuitBreakerTests(unittest.TestCase):
+
+    def test_trial_after_cooldown(self):
+        from kaffi.status import CircuitBreaker
+        self.now = 0
+        breaker = CircuitBreaker('VIS', failures=2, cooldown=10, clock=lambda: self.now)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.now = 10
+        # a single trial
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.now = 15
+        self.assertFalse(breaker.allow())
+        self.now = 20
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.skipped, 3)
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import threading
+import time
+import sys, os, os.path
+
+class TimerQueueTests(unittest.TestCase):
+
+    def setUp(self):
+        from kaffi import timers
+        self.queue = timers.TimerQueue()
+        self.fired = []
+
+    def due(self, offset):
+        return [t.callback for t in self.queue.pop_due(time.time() + offset)]
+
+    def test_fires_in_order(self):
+        self.queue.call_later(2, 'b')
+        self.queue.call_later(1, 'a')
+        self.assertEqual(self.due(0), [])
+        self.assertEqual(self.due(3), ['a', 'b'])
+        self.assertEqual(self.queue.pop_due(time.time() + 10), [])
+
+    def test_rearm_later(self):
+        timer = self.queue.call_later(1, 'a')
+        timer.rearm(5)
+        self.assertEqual(self.due(2), [])
+        self.assertTrue(timer.active())
+        self.assertEqual(self.due(6), ['a'])
+        self.assertFalse(timer.active())
+
+    def test_rearm_earlier(self):
+        timer = self.queue.call_later(5, 'a')
+        timer.rearm(1)
+        self.assertEqual(self.due(2), ['a'])
+        self.assertEqual(self.due(6), [])
+
+    def test_cancel(self):
+        timer = self.queue.call_later(1, 'a')
+        timer.cancel()
+        self.assertEqual(self.due(2), [])
+        self.assertFalse(timer.active())
+
+    def test_rearm_after_cancel_and_fire(self):
+        timer = self.queue.call_later(1, 'a')
+        timer.cancel()
+        timer.rearm(3)
+        self.assertEqual(self.due(2), [])
+        self.assertEqual(self.due(4), ['a'])
+        timer.rearm(1)
+        self.assertEqual(self.due(2), ['a'])
+
+class TimerServiceTests(unittest.TestCase):
+
+    def test_service_runs_callbacks(self):
+        from kaffi import timers
+        service = timers.TimerService()
+        service.start()
+        fired = threading.Event()
+        cancelled = []
+        service.call_later(0.2, cancelled.append, True).cancel()
+        service.call_later(0.05, fired.set)
+        self.assertTrue(fired.wait(2))
+        time.sleep(0.3)
+        self.assertEqual(cancelled, [])
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()
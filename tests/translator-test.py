@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+
+import unittest
+import random
+import binascii
+import sys, os, os.path
+tohex = binascii.hexlify
+fromhex = binascii.unhexlify
+
+class RecordingStream(object):
+
+    def __init__(self, buffered=False):
+        self.buffered = buffered
+        self.written = []
+
+    def write_bytes(self, data):
+        self.written.append(data)
+
+class TranslatorFeedTests(unittest.TestCase):
+
+    def make_stm(self, buffered=False):
+        from kaffi import translator
+        received, nacks = [], []
+        def data_handler(data):
+            received.append(data)
+            return fromhex('00') + data[1:]
+        stream = RecordingStream(buffered)
+        stm = translator.TranslatorStm(stream, data_handler, lambda: nacks.append(True))
+        return stm, stream, received, nacks
+
+    def run_bytewise(self, data):
+        stm, stream, received, nacks = self.make_stm()
+        for c in data:
+            stm.state_fn(c)
+        return received, ''.join(stream.written), len(nacks)
+
+    def run_chunked(self, chunks):
+        stm, stream, received, nacks = self.make_stm()
+        for chunk in chunks:
+            stm.feed(chunk)
+        return received, ''.join(stream.written), len(nacks)
+
+    def frame(self, payload):
+        return '\x02' + payload.replace('\x10', '\x10\x10') + '\x10\x03'
+
+    def test_single_frame(self):
+        received, written, nacks = self.run_chunked([self.frame('\x00\x12')])
+        self.assertEqual(received, ['\x00\x12'])
+        self.assertEqual(written, '\x06' + self.frame('\x00\x12'))
+
+    def test_dle_unescaping(self):
+        payload = '\x00\x10\x10\x13\x00\x10'
+        received, written, nacks = self.run_chunked([self.frame(payload)])
+        self.assertEqual(received, [payload])
+
+    def test_nak_and_ack_between_frames(self):
+        data = '\x15' + self.frame('\x00\x12') + '\x06\x15'
+        received, written, nacks = self.run_chunked([data])
+        self.assertEqual(received, ['\x00\x12'])
+        self.assertEqual(nacks, 2)
+
+    def test_matches_bytewise_on_random_splits(self):
+        rnd = random.Random(4711)
+        for i in range(200):
+            parts = []
+            for j in range(rnd.randint(1, 5)):
+                payload = ''.join(chr(rnd.choice([0x00, 0x02, 0x03, 0x10, 0x12, 0x13, 0xff]))
+                                  for k in range(rnd.randint(0, 8)))
+                parts.append(self.frame(payload))
+                if rnd.random() < 0.3:
+                    parts.append(rnd.choice(['\x06', '\x15', '\x42', '\x10\x42']))
+            data = ''.join(parts)
+            cuts = sorted(rnd.sample(range(len(data) + 1), min(len(data) + 1, 4)))
+            chunks = [data[a:b] for a, b in zip([0] + cuts, cuts + [len(data)])]
+            self.assertEqual(self.run_chunked(chunks), self.run_bytewise(data), tohex(data))
+
+    def test_coalesced_write(self):
+        stm, stream, received, nacks = self.make_stm(buffered=True)
+        stm.feed(self.frame('\x00\x12'))
+        self.assertEqual(stream.written, ['\x06' + self.frame('\x00\x12')])
+
+    def test_constant_response_frames(self):
+        from kaffi import translator, mdb
+        stream = RecordingStream(buffered=True)
+        stm = translator.TranslatorStm(stream, lambda data: mdb.MdbL1Stm.ACK, lambda: None,
+                                       mdb.MdbL1Stm.CONSTANT_RESPONSES)
+        stm.feed(self.frame('\x00\x12') * 2)
+        self.assertEqual(stream.written, ['\x06' + self.frame('\x00')] * 2)
+        self.assertTrue(stream.written[0] is stream.written[1])
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    unittest.main()